@@ -4,6 +4,7 @@
 
 from . import demultiplex
 from . import rawedit
+from . import clust_store
 from . import cluster_within
 from . import jointestimate
 from . import consens_se
@@ -0,0 +1,283 @@
+#!/usr/bin/env python2
+
+"""
+Columnar HDF5 store for within-sample clusters (clustS), as an alternative
+to parsing the //-delimited gzip text in steps 4 and 5. Step 3 writes it
+next to the clustS.gz file if _hackersonly["clust_store"] is set, and
+text_to_store() and store_to_text() convert between the two formats.
+
+Datasets in the store:
+    seqs      uint8   all read sequences concatenated
+    lengths   uint32  length of each read
+    depths    uint32  replicate count (size=) of each read
+    seeds     bool    whether each read is the seed of its cluster
+    names     str     name line of each read
+    clusters  int64   offset of the first read of each cluster, plus nreads
+    seqstarts int64   offset in seqs of each cluster, plus len(seqs)
+"""
+
+from __future__ import print_function
+
+import os
+import gzip
+import h5py
+import itertools
+import numpy as np
+
+from ipyrad.assemble.util import IPyradError, clustdealer
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+
+## datasets with one entry per read, and their dtypes
+READCOLS = [("lengths", np.uint32),
+            ("depths", np.uint32),
+            ("seeds", np.bool_),
+            ("names", h5py.special_dtype(vlen=bytes))]
+
+
+
+def store_handle(clustfile):
+    """ path of the cluster store that goes with a clustS.gz file """
+    return clustfile.rsplit(".clustS.gz", 1)[0]+".clustS.hdf5"
+
+
+
+def has_store(sample):
+    """
+    True if the sample has a cluster store that is at least as new as its
+    clustS.gz file, or if the store is all there is.
+    """
+    shandle = store_handle(sample.files.clusters)
+    if not os.path.exists(shandle):
+        return False
+    if not os.path.exists(sample.files.clusters):
+        return True
+    return os.path.getmtime(shandle) >= os.path.getmtime(sample.files.clusters)
+
+
+
+class StoreWriter(object):
+    """
+    Appends clusters (as text, without the // separator) to a new cluster
+    store, writing them to disk in blocks of blocksize clusters.
+    """
+    def __init__(self, handle, blocksize=10000):
+        self.handle = handle
+        self.blocksize = blocksize
+        self.io5 = h5py.File(handle, 'w')
+        self.io5.create_dataset("seqs", (0,), maxshape=(None,),
+                                dtype=np.uint8, chunks=(2**20,))
+        for col, dtype in READCOLS:
+            self.io5.create_dataset(col, (0,), maxshape=(None,),
+                                    dtype=dtype, chunks=(2**14,))
+        for col in ["clusters", "seqstarts"]:
+            self.io5.create_dataset(col, (1,), maxshape=(None,),
+                                    dtype=np.int64, chunks=(2**14,))
+        self.nclusters = 0
+        self.nreads = 0
+        self.nbases = 0
+        self._clusts = []
+
+
+    def add(self, clust):
+        """ add one cluster """
+        piece = clust.strip().split("\n")
+        if piece[0]:
+            self._clusts.append(piece)
+            if len(self._clusts) >= self.blocksize:
+                self.flush()
+
+
+    def flush(self):
+        """ write buffered clusters to disk """
+        if not self._clusts:
+            return
+        names = [name for piece in self._clusts for name in piece[0::2]]
+        seqs = [seq for piece in self._clusts for seq in piece[1::2]]
+        sizes = np.array([len(piece) // 2 for piece in self._clusts])
+        bases = np.array([sum([len(i) for i in piece[1::2]]) \
+                          for piece in self._clusts])
+        cols = {
+            "lengths": np.array([len(i) for i in seqs], dtype=np.uint32),
+            "depths": np.array([int(i.split(";")[-2][5:]) for i in names],
+                               dtype=np.uint32),
+            "seeds": np.array([i.endswith("*") for i in names]),
+            "names": np.array(names, dtype=object),
+            }
+        seqarr = np.fromstring("".join(seqs), dtype=np.uint8)
+
+        ## append to datasets
+        _append(self.io5["seqs"], seqarr)
+        for col, _ in READCOLS:
+            _append(self.io5[col], cols[col])
+        _append(self.io5["clusters"], self.nreads + np.cumsum(sizes))
+        _append(self.io5["seqstarts"], self.nbases + np.cumsum(bases))
+        self.nreads += len(names)
+        self.nbases += seqarr.shape[0]
+        self.nclusters += len(self._clusts)
+        self._clusts = []
+
+
+    def close(self):
+        """ flush and close the store """
+        self.flush()
+        self.io5.attrs["nclusters"] = self.nclusters
+        self.io5.attrs["nreads"] = self.nreads
+        self.io5.close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def _append(dset, arr):
+    """ append array to the end of a resizable 1-d dataset """
+    size = dset.shape[0]
+    dset.resize((size + arr.shape[0],))
+    dset[size:] = arr
+
+
+
+def _iter_blocks(io5, start, stop, blocksize):
+    """
+    yields blocks of clusters from an open store as (offsets, names, depths,
+    lengths, seqarr), where offsets are the read offsets of the clusters in
+    the block, relative to its first read.
+    """
+    for bstart in xrange(start, stop, blocksize):
+        bstop = min(stop, bstart + blocksize)
+        offsets = io5["clusters"][bstart:bstop+1]
+        sstart, sstop = io5["seqstarts"][[bstart, bstop]]
+        rstart, rstop = offsets[0], offsets[-1]
+        yield (offsets - rstart,
+               io5["names"][rstart:rstop],
+               io5["depths"][rstart:rstop].astype(np.int64),
+               io5["lengths"][rstart:rstop].astype(np.int64),
+               io5["seqs"][sstart:sstop])
+
+
+
+def iter_store(handle, start=0, stop=None, blocksize=10000):
+    """
+    yields (names, reps, seqs) for clusters start to stop in a cluster
+    store, where seqs is an array (nreads, length) of single characters.
+    Shorter reads are padded with '-'.
+    """
+    with h5py.File(handle, 'r') as io5:
+        nclusters = io5.attrs["nclusters"]
+        if stop is None or stop > nclusters:
+            stop = nclusters
+
+        for offsets, names, depths, lengths, seqarr in \
+            _iter_blocks(io5, start, stop, blocksize):
+            starts = np.concatenate([[0], np.cumsum(lengths)])
+
+            ## split into clusters
+            for cidx in xrange(offsets.shape[0] - 1):
+                ridx, rend = offsets[cidx], offsets[cidx+1]
+                clens = lengths[ridx:rend]
+                width = clens.max()
+                if (clens == width).all():
+                    seqs = seqarr[starts[ridx]:starts[rend]].reshape(-1, width)
+                else:
+                    seqs = np.zeros((rend - ridx, width), dtype=np.uint8)
+                    seqs.fill(ord("-"))
+                    for row in xrange(ridx, rend):
+                        seqs[row-ridx, :lengths[row]] = \
+                            seqarr[starts[row]:starts[row+1]]
+                yield list(names[ridx:rend]), depths[ridx:rend], seqs.view("S1")
+
+
+
+def iter_text(handle):
+    """
+    yields (names, reps, seqs) for each cluster in a clustS text file, like
+    iter_store().
+    """
+    if handle.endswith(".gz"):
+        clusters = gzip.open(handle, 'rb')
+    else:
+        clusters = open(handle, 'rb')
+    pairdealer = itertools.izip(*[iter(clusters)]*2)
+
+    done = 0
+    while not done:
+        try:
+            done, chunk = clustdealer(pairdealer, 1)
+        except IndexError:
+            raise IPyradError("clustfile formatting error in %s", chunk)
+
+        if chunk:
+            piece = chunk[0].strip().split("\n")
+            names = piece[0::2]
+            seqs = piece[1::2]
+            reps = np.array([int(name.split(";")[-2][5:]) for name in names])
+            yield names, reps, np.array([list(seq) for seq in seqs])
+    clusters.close()
+
+
+
+def iter_clusters(sample, start=0, stop=None):
+    """
+    yields (names, reps, seqs) for a sample's clusters from its cluster
+    store if it has one, or else from its clustS.gz file.
+    """
+    if has_store(sample):
+        for clust in iter_store(store_handle(sample.files.clusters),
+                                start, stop):
+            yield clust
+    else:
+        for clust in itertools.islice(iter_text(sample.files.clusters),
+                                      start, stop):
+            yield clust
+
+
+
+def text_to_store(clustfile, storefile=None):
+    """
+    converts a clustS text file (gzipped or not) to a cluster store. Returns
+    the path of the store.
+    """
+    if not storefile:
+        storefile = store_handle(clustfile)
+    if clustfile.endswith(".gz"):
+        clusters = gzip.open(clustfile, 'rb')
+    else:
+        clusters = open(clustfile, 'rb')
+    pairdealer = itertools.izip(*[iter(clusters)]*2)
+
+    with StoreWriter(storefile) as store:
+        done = 0
+        while not done:
+            done, chunk = clustdealer(pairdealer, 10000)
+            for clust in chunk:
+                store.add(clust)
+    clusters.close()
+    return storefile
+
+
+
+def store_to_text(storefile, clustfile):
+    """
+    converts a cluster store to a gzipped clustS text file. Returns the
+    path of the text file.
+    """
+    with h5py.File(storefile, 'r') as io5, gzip.open(clustfile, 'wb') as out:
+        nclusters = io5.attrs["nclusters"]
+        for offsets, names, _, lengths, seqarr in \
+            _iter_blocks(io5, 0, nclusters, 10000):
+            starts = np.concatenate([[0], np.cumsum(lengths)])
+            seqs = seqarr.tostring()
+            for cidx in xrange(offsets.shape[0] - 1):
+                clust = []
+                for row in xrange(offsets[cidx], offsets[cidx+1]):
+                    clust.append(names[row])
+                    clust.append(seqs[starts[row]:starts[row+1]])
+                out.write("\n".join(clust)+"\n//\n//\n")
+    return clustfile
@@ -22,13 +22,14 @@ import numba
 import shutil
 import random
 import select
-import socket
 import datetime
 import itertools
 import numpy as np
 import dask.array as da
 import ipyrad
 from ipyrad.assemble.util import IPyradWarningExit, progressbar, clustdealer, fullcomp
+from ipyrad.assemble.util import ALIGNSTATS, get_host_inventory
+from ipyrad.assemble.cluster_within import SeedHits, get_aligner
 #from ipyrad.assemble.cluster_within import muscle_call, parsemuscle
 
 try:
@@ -59,11 +60,33 @@ def persistent_popen_align3(data, samples, chunk):
     indels = np.zeros((len(samples), len(clusts), maxlen), dtype=np.bool_)
     duples = np.zeros(len(clusts), dtype=np.bool_)
 
-    ## create a persistent shell for running muscle in. 
-    proc = sps.Popen(["bash"], 
-                    stdin=sps.PIPE, 
-                    stdout=sps.PIPE, 
-                    universal_newlines=True)
+    ## build the muscle input for each cluster: one for single-end or merged
+    ## reads, or one for read1s and one for read2s of paired reads. 
+    ## Duplicates are not aligned.
+    ispairs = np.zeros(len(clusts), dtype=np.bool_)
+    fastas = []
+    for ldx in xrange(len(clusts)):
+        lines = clusts[ldx].strip().split("\n")
+        names = lines[::2]
+        seqs = lines[1::2]
+        if len(names) != len(set([x.rsplit("_", 1)[0] for x in names])):
+            continue
+
+        ## append counter to names because muscle doesn't retain order
+        names = [">{};*{}".format(j[1:], i) for i, j in enumerate(names)]
+        splits = [i.split("nnnn") for i in seqs]
+        if all([len(i) == 2 for i in splits]):
+            clust1, clust2 = zip(*splits)
+            fastas.append("\n".join(itertools.chain(*zip(names, clust1))))
+            fastas.append("\n".join(itertools.chain(*zip(names, clust2))))
+            ispairs[ldx] = True
+        else:
+            fastas.append("\n".join(["\n".join(i) for i in zip(names, seqs)]))
+
+    ## stream the alignments back in order from a persistent muscle service,
+    ## or from the native aligner
+    service = get_aligner(data._hackersonly["clust_aligner"], tmpdir=data.tmpdir)
+    results = service.align(fastas)
 
     ## iterate over clusters until finished
     allstack = []
@@ -92,14 +115,7 @@ def persistent_popen_align3(data, samples, chunk):
             ## append counter to names because muscle doesn't retain order
             names = [">{};*{}".format(j[1:], i) for i, j in enumerate(names)]
 
-            try:
-                ## try to split names on nnnn splitter
-                clust1, clust2 = zip(*[i.split("nnnn") for i in seqs])
-
-                ## make back into strings
-                cl1 = "\n".join(itertools.chain(*zip(names, clust1)))
-                cl2 = "\n".join(itertools.chain(*zip(names, clust2)))
-
+            if ispairs[ldx]:
                 ## store allele (lowercase) info
                 shape = (len(seqs), max([len(i) for i in seqs]))
                 arrseqs = np.zeros(shape, dtype="S1")
@@ -109,33 +125,21 @@ def persistent_popen_align3(data, samples, chunk):
                 amask = np.char.islower(arrseqs)
                 save_alleles = np.any(amask)
 
-                ## send align1 to the bash shell
-                ## TODO: check for pipe-overflow here and use files for i/o                
-                cmd1 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                       .format(cl1, ipyrad.bins.muscle, "//")
-                print(cmd1, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                for line in iter(proc.stdout.readline, "//\n"):
-                    align1 += line
-
-                ## send align2 to the bash shell
-                ## TODO: check for pipe-overflow here and use files for i/o                
-                cmd2 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                       .format(cl2, ipyrad.bins.muscle, "//")
-                print(cmd2, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                for line in iter(proc.stdout.readline, "//\n"):
-                    align2 += line
+                ## get the aligned read1s and read2s
+                align1 = results.next()
+                align2 = results.next()
 
                 ## join the aligned read1 and read2 and ensure name order match
-                la1 = align1[1:].split("\n>")
-                la2 = align2[1:].split("\n>")
-                dalign1 = dict([i.split("\n", 1) for i in la1])
-                dalign2 = dict([i.split("\n", 1) for i in la2])
-                keys = sorted(dalign1.keys(), key=DEREP)
-                keys2 = sorted(dalign2.keys(), key=DEREP)
+                try:
+                    la1 = align1[1:].split("\n>")
+                    la2 = align2[1:].split("\n>")
+                    dalign1 = dict([i.split("\n", 1) for i in la1])
+                    dalign2 = dict([i.split("\n", 1) for i in la2])
+                    keys = sorted(dalign1.keys(), key=DEREP)
+                    keys2 = sorted(dalign2.keys(), key=DEREP)
+                except ValueError:
+                    LOGGER.error("Muscle alignment failed: ldx {}".format(ldx))
+                    continue
 
                 ## Make sure R1 and R2 actually exist for each sample. If not
                 ## bail out of this cluster.
@@ -182,15 +186,7 @@ def persistent_popen_align3(data, samples, chunk):
                 #        [key, 
                 #         dalign1[key].replace("\n", "")+"nnnn"+\
                 #         dalign2[key].replace("\n", "")]))
-            except IndexError as inst:
-                LOGGER.debug("Error in PE - ldx: {}".format())
-                LOGGER.debug("Vars: {}".format(dict(globals(), **locals())))
-                raise
-
-            except ValueError:
-                ## make back into strings
-                cl1 = "\n".join(["\n".join(i) for i in zip(names, seqs)])                
-
+            else:
                 ## store allele (lowercase) info
                 shape = (len(seqs), max([len(i) for i in seqs]))
                 arrseqs = np.zeros(shape, dtype="S1")
@@ -200,19 +196,17 @@ def persistent_popen_align3(data, samples, chunk):
                 amask = np.char.islower(arrseqs)
                 save_alleles = np.any(amask)
 
-                ## send align1 to the bash shell (TODO: check for pipe-overflow)
-                cmd1 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                       .format(cl1, ipyrad.bins.muscle, "//")
-                print(cmd1, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                for line in iter(proc.stdout.readline, "//\n"):
-                    align1 += line
+                ## get the aligned reads
+                align1 = results.next()
 
                 ## ensure name order match
-                la1 = align1[1:].split("\n>")
-                dalign1 = dict([i.split("\n", 1) for i in la1])
-                keys = sorted(dalign1.keys(), key=DEREP)
+                try:
+                    la1 = align1[1:].split("\n>")
+                    dalign1 = dict([i.split("\n", 1) for i in la1])
+                    keys = sorted(dalign1.keys(), key=DEREP)
+                except ValueError:
+                    LOGGER.error("Muscle alignment failed: ldx {}".format(ldx))
+                    continue
 
                 ## put into dict for writing to file
                 for kidx, key in enumerate(keys):
@@ -265,11 +259,9 @@ def persistent_popen_align3(data, samples, chunk):
             #LOGGER.debug("\n\nSTACK (%s)\n%s\n", duples[ldx], "\n".join(istack))
 
     ## cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
+    service.close()
+    LOGGER.info("aligned %s: %s", os.path.basename(chunk), 
+                ALIGNSTATS.format(**service.stats()))
 
     #LOGGER.info("\n\nALLSTACK %s\n", "\n".join(i) for i in allstack[:5]])
 
@@ -470,34 +462,16 @@ def call_cluster(data, noreverse, ipyclient):
     distributes 'cluster()' function to an ipyclient to make sure it runs
     on a high memory node. 
     """
-    ## Find host with the most engines, for now just using first.
-    lbview = ipyclient.load_balanced_view()
-
-    ## request engine data, skips busy engines.    
-    asyncs = {}
-    for eid in ipyclient.ids:
-        engine = ipyclient[eid]
-        if not engine.outstanding:
-            asyncs[eid] = engine.apply(socket.gethostname)
-    ## get results
-    hosts = {}
-    for key in asyncs:
-        hosts[key] = asyncs[key].get()
-    ## count them
-    results = {}
-    for eid, hostname in hosts.items():
-        if hostname in results:
-            results[hostname].append(eid)
-        else:
-            results[hostname] = [eid] 
-
-    ## which is largest
-    hosts = sorted(results.items(), key=lambda x: len(x[1]), reverse=True)
-    _, eids = hosts[0]
-    bighost = ipyclient[eids[0]]
-
-    ## nthreads is len eids, or ipcluster.threads, unless ipcluster.threads 
-    ## is really small, then we assume threads should not apply here.
+    ## Find the host with the most cpus that we have engines on.
+    inventory = get_host_inventory(ipyclient)
+    usable = lambda x: min(len(x["eids"]), x["ncpus"]) or len(x["eids"])
+    host = max(inventory, key=lambda x: usable(inventory[x]))
+    ncores = usable(inventory[host])
+    bighost = ipyclient[inventory[host]["eids"][0]]
+
+    ## nthreads is usable cpus on the host, or ipcluster.threads, unless 
+    ## ipcluster.threads is really small, then we assume threads should not 
+    ## apply here.
     ##    ipyrad -p params.txt -s 6 -c 20 would give:
     ##    min(20, max(2, 10)) = 8
     ## while 
@@ -509,7 +483,10 @@ def call_cluster(data, noreverse, ipyclient):
     ## and
     ##    ipyrad -p params.txt -s 6 -c 16 --MPI (on 2 X 8-core nodes) would give:
     ##    min(8, max(2, 10)) = 8
-    nthreads = min(len(eids), max(data._ipcluster["threads"], 10))
+    nthreads = min(ncores, max(data._ipcluster["threads"], 10))
+    LOGGER.info("thread plan: clustering on host %s (%s engines, %s cpus) "\
+                "with %s threads", host, len(inventory[host]["eids"]), 
+                inventory[host]["ncpus"], nthreads)
 
     ## submit job to the host with the most
     async = bighost.apply(cluster, *(data, noreverse, nthreads))
@@ -751,7 +728,7 @@ def build_tmp_h5(data, samples):
 
     ## Build an array for quickly indexing consens reads from catg files.
     ## save as a npy int binary file.
-    uhandle = os.path.join(data.dirs.across, data.name+".utemp.sort")
+    uhandle = os.path.join(data.dirs.across, data.name+".utemp")
     bseeds = os.path.join(data.dirs.across, data.name+".tmparrs.h5")
 
     ## send as first async1 job
@@ -769,40 +746,32 @@ def get_nloci(data):
 
 def get_seeds_and_hits(uhandle, bseeds, snames):
     """
-    builds a seeds and hits (uarr) array of ints from the utemp.sort file.
+    builds a seeds and hits (uarr) array of ints from the utemp file.
+    Loci are numbered in the same seed order as in sub_build_clustbits.
     Saves outputs to files ...
     """
-    ## Get max name length. Allow for trailing _ + up to 9 digits
-    ## of numbers of loci (an astronomical number of unique loci)
-    maxlen_names = np.max(map(len, snames)) + 10
-    ## read in the utemp.sort file
-    updf = np.loadtxt(uhandle, dtype="S".format(maxlen_names))
-
-    ## Get seeds for all matches from usort
-    seeds = np.unique(updf[:, 1])
+    ## group hits (query target qstrand) by seed
+    seedhits = SeedHits(uhandle, strand=2)
+
+    ## sample index and consens index of each name in the utemp
+    sidxs = {j: i for (i, j) in enumerate(snames)}
+    names = [i.rsplit("_", 1) for i in seedhits.names]
+    nsidx = np.array([sidxs[i[0]] for i in names], dtype=np.int64)
+    ncidx = np.array([int(i[1]) for i in names], dtype=np.int64)
+    del names
+
+    ## Get seeds for all matches in locus order
     seedsarr = np.column_stack([
-                    np.arange(len(seeds)),
-                   [i.rsplit("_", 1)[0] for i in seeds],
-                   [i.rsplit("_", 1)[1] for i in seeds]])
-    seedsarr[:, 1] = [snames.index(i) for i in seedsarr[:, 1]]
-    seedsarr = seedsarr.astype(np.int64)
+                    np.arange(len(seedhits)),
+                    nsidx[seedhits.seeds],
+                    ncidx[seedhits.seeds]]).astype(np.int64)
     LOGGER.info("got a seedsarr %s", seedsarr.shape)
 
-    ## Get matches from usort and create an array for fast entry
-    uarr = np.zeros((updf.shape[0], 3), dtype=np.int64)
-    idx = -1
-    lastloc = None
-    for ldx in xrange(updf.shape[0]):
-        tloc = updf[ldx, 1]
-        if tloc != lastloc:
-            idx += 1
-        uarr[ldx, 0] = idx
-        lastloc = tloc
-    ## create a column with sample index
-    uarr[:, 1] = [int(snames.index(i.rsplit("_", 1)[0])) for i in updf[:, 0]]
-    ## create a column with only consens index for sample
-    uarr[:, 2] = [int(i.rsplit("_", 1)[1]) for i in updf[:, 0]]
-    uarr = uarr.astype(np.int64)
+    ## Get matches with their locus index for fast entry
+    uarr = np.column_stack([
+                np.repeat(np.arange(len(seedhits)), seedhits.sizes()),
+                nsidx[seedhits.hits],
+                ncidx[seedhits.hits]]).astype(np.int64)
     LOGGER.info("got a uarr %s", uarr.shape)
 
     ## save as h5 to we can grab by sample slices
@@ -958,7 +927,7 @@ def multicat(data, samples, ipyclient):
 
     ## Build an array for quickly indexing consens reads from catg files.
     ## save as a npy int binary file.
-    uhandle = os.path.join(data.dirs.across, data.name+".utemp.sort")
+    uhandle = os.path.join(data.dirs.across, data.name+".utemp")
     bseeds = os.path.join(data.dirs.across, data.name+".tmparrs.h5")
 
     ## send as first async1 job
@@ -1345,34 +1314,6 @@ def fill_superseqs(data, samples):
 
 
 
-def count_seeds(usort):
-    """
-    uses bash commands to quickly count N seeds from utemp file
-    """
-    with open(usort, 'r') as insort:
-        cmd1 = ["cut", "-f", "2"]
-        cmd2 = ["uniq"]
-        cmd3 = ["wc"]
-        proc1 = sps.Popen(cmd1, stdin=insort, stdout=sps.PIPE, close_fds=True)
-        proc2 = sps.Popen(cmd2, stdin=proc1.stdout, stdout=sps.PIPE, close_fds=True)
-        proc3 = sps.Popen(cmd3, stdin=proc2.stdout, stdout=sps.PIPE, close_fds=True)
-        res = proc3.communicate()
-        nseeds = int(res[0].split()[0])
-        proc1.stdout.close()
-        proc2.stdout.close()
-        proc3.stdout.close()
-    return nseeds
-
-
-
-def sort_seeds(uhandle, usort):
-    """ sort seeds from cluster results"""
-    cmd = ["sort", "-k", "2", uhandle, "-o", usort]
-    proc = sps.Popen(cmd, close_fds=True)
-    proc.communicate()
-
-
-
 def build_clustbits(data, ipyclient, force):
     """
     Reconstitutes clusters from .utemp and htemp files and writes them
@@ -1392,43 +1333,14 @@ def build_clustbits(data, ipyclient, force):
     progressbar(3, 0, printstr.format(elapsed), spacer=data._spacer)
 
     uhandle = os.path.join(data.dirs.across, data.name+".utemp")
-    usort = os.path.join(data.dirs.across, data.name+".utemp.sort")
-
-    async1 = ""
-    ## skip usorting if not force and already exists
-    if not os.path.exists(usort) or force:
 
-        ## send sort job to engines. Sorted seeds allows us to work through
-        ## the utemp file one locus at a time instead of reading all into mem.
-        LOGGER.info("building reads file -- loading utemp file into mem")
-        async1 = lbview.apply(sort_seeds, *(uhandle, usort))
-        while 1:
-            elapsed = datetime.timedelta(seconds=int(time.time()-start))
-            progressbar(3, 0, printstr.format(elapsed), spacer=data._spacer)
-            if async1.ready():
-                break
-            else:
-                time.sleep(0.1)
-
-    ## send count seeds job to engines.
-    async2 = lbview.apply(count_seeds, usort)
+    ## send the clust bit building job to work and track progress. Hits are
+    ## grouped by seed in memory, so the utemp file is no longer sorted.
+    async = lbview.apply(sub_build_clustbits, *(data, uhandle))
     while 1:
         elapsed = datetime.timedelta(seconds=int(time.time()-start))
         progressbar(3, 1, printstr.format(elapsed), spacer=data._spacer)
-        if async2.ready():
-            break
-        else:
-            time.sleep(0.1)
-
-    ## wait for both to finish while printing progress timer
-    nseeds = async2.result()
-
-    ## send the clust bit building job to work and track progress
-    async3 = lbview.apply(sub_build_clustbits, *(data, usort, nseeds))
-    while 1:
-        elapsed = datetime.timedelta(seconds=int(time.time()-start))
-        progressbar(3, 2, printstr.format(elapsed), spacer=data._spacer)
-        if async3.ready():
+        if async.ready():
             break
         else:
             time.sleep(0.1)
@@ -1437,17 +1349,12 @@ def build_clustbits(data, ipyclient, force):
     print("")
 
     ## check for errors
-    for job in [async1, async2, async3]:
-        try:
-            if not job.successful():
-                raise IPyradWarningExit(job.result())
-        except AttributeError:
-            ## If we skip usorting then async1 == "" so the call to
-            ## successful() raises, but we can ignore it.
-            pass
+    if not async.successful():
+        raise IPyradWarningExit(async.result())
+
 
 
-def sub_build_clustbits(data, usort, nseeds):
+def sub_build_clustbits(data, uhandle):
     """
     A subfunction of build_clustbits to allow progress tracking. This func
     splits the unaligned clusters into bits for aligning on separate cores.
@@ -1464,75 +1371,63 @@ def sub_build_clustbits(data, usort, nseeds):
             nnn, sss = [i.strip() for i in namestr, seq]
             allcons[nnn[1:]] = sss
 
+    ## group hits (query target qstrand) by seed
+    seedhits = SeedHits(uhandle, strand=2)
+    names = seedhits.names
+    nseeds = len(seedhits)
+
     ## set optim to approximately 4 chunks per core. Smaller allows for a bit
     ## cleaner looking progress bar. 40 cores will make 160 files.
     optim = ((nseeds // (data.cpus*4)) + (nseeds % (data.cpus*4)))
     LOGGER.info("building clustbits, optim=%s, nseeds=%s, cpus=%s",
                 optim, nseeds, data.cpus)
 
-    ## iterate through usort grabbing seeds and matches
-    with open(usort, 'rb') as insort:
-        ## iterator, seed null, and seqlist null
-        isort = iter(insort)
-        loci = 0
-        lastseed = 0
+    ## iterate through the seeds and their matches
+    loci = 0
+    seqlist = []
+    seqsize = 0
+    for seed, hits, revcomp, _, _ in seedhits:
+        ## the seed goes on top of fseq, then its matches
+        cnames = [names[seed]] + [names[i] for i in hits.tolist()]
+        crevs = [False] + revcomp.tolist()
         fseqs = []
-        seqlist = []
-        seqsize = 0
-
-        while 1:
-            ## grab the next line
-            try:
-                hit, seed, ori = isort.next().strip().split()
-            except StopIteration:
-                break
-
+        for name, rev in itertools.izip(cnames, crevs):
             try:
-                ## if same seed, append match
-                if seed != lastseed:
-                    ## store the last fseq, count it, and clear it
-                    if fseqs:
-                        seqlist.append("\n".join(fseqs))
-                        seqsize += 1
-                        fseqs = []
-                    ## occasionally write to file
-                    if seqsize >= optim:
-                        if seqlist:
-                            loci += seqsize
-                            with open(os.path.join(data.tmpdir,
-                                data.name+".chunk_{}".format(loci)), 'w') as clustsout:
-                                LOGGER.debug("writing chunk - seqsize {} loci {} {}".format(seqsize, loci, clustsout.name))
-                                clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
-                            ## reset list and counter
-                            seqlist = []
-                            seqsize = 0
-    
-                    ## store the new seed on top of fseq
-                    fseqs.append(">{}\n{}".format(seed, allcons[seed]))
-                    lastseed = seed
-    
-                ## add match to the seed
-                seq = allcons[hit]
-                ## revcomp if orientation is reversed
-                if ori == "-":
-                    seq = fullcomp(seq)[::-1]
-                fseqs.append(">{}\n{}".format(hit, seq))
-            except KeyError as inst:
+                seq = allcons[name]
+            except KeyError:
                 ## Caught bad seed or hit? Log and continue.
-                LOGGER.error("Bad Seed/Hit: seqsize {}\tloci {}\tseed {}\thit {}".format(seqsize, loci, seed, hit))
-
-    ## write whatever is left over to the clusts file
-    if fseqs:
+                LOGGER.error("Bad Seed/Hit: seqsize {}\tloci {}\tname {}"\
+                             .format(seqsize, loci, name))
+                continue
+            ## revcomp if orientation is reversed
+            if rev:
+                seq = fullcomp(seq)[::-1]
+            fseqs.append(">{}\n{}".format(name, seq))
+
+        ## store the fseq and count it
         seqlist.append("\n".join(fseqs))
         seqsize += 1
-        loci += seqsize
+
+        ## occasionally write to file
+        if seqsize >= optim:
+            loci += seqsize
+            with open(os.path.join(data.tmpdir,
+                data.name+".chunk_{}".format(loci)), 'w') as clustsout:
+                LOGGER.debug("writing chunk - seqsize {} loci {} {}".format(seqsize, loci, clustsout.name))
+                clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
+            ## reset list and counter
+            seqlist = []
+            seqsize = 0
+
+    ## write whatever is left over to the clusts file
     if seqlist:
+        loci += seqsize
         with open(os.path.join(data.tmpdir,
             data.name+".chunk_{}".format(loci)), 'w') as clustsout:
             clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
 
     ## final progress and cleanup
-    del allcons
+    del allcons, seedhits
     clustbits = glob.glob(os.path.join(data.tmpdir, data.name+".chunk_*"))
 
     ## return stuff
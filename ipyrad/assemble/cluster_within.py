@@ -19,17 +19,22 @@ import os
 import io
 import gzip
 import glob
+import mmap
+import heapq
 import itertools
 
 import numpy as np
+import numba
 import ipyrad
 import time
 import datetime
 import warnings
 import networkx as nx
 import ipyparallel as ipp
+from collections import Counter
 
 from refmap import *
+from clust_store import StoreWriter, store_handle
 from util import *
 
 ## Python3 subprocess is faster for muscle-align
@@ -43,8 +48,38 @@ LOGGER = logging.getLogger(__name__)
 
 
 
+def depths_handle(sample):
+    """ 
+    path of the sidecar array of a sample's clustS file, which holds the 
+    aligned length and depth of each cluster as rows (maxlen, depth).
+    """
+    return sample.files.clusters.rsplit(".clustS.gz", 1)[0]+".depths.npy"
+
+
+
+def clust_depths(clust):
+    """ returns (length, depth) of a cluster, or None if it's empty """
+    piece = clust.strip().split("\n")
+    if not piece[0]:
+        return None
+    depth = sum([int(name.split(";")[-2][5:]) for name in piece[0::2]])
+    return len(piece[-1]), depth
+
+
+
+def save_depths(sample, stats):
+    """ writes list of (length, depth) to the depths sidecar of a sample """
+    arr = np.array(stats, dtype=np.int64).reshape(-1, 2)
+    with open(depths_handle(sample), 'wb') as out:
+        np.save(out, arr)
+
+
+
 def get_quick_depths(data, sample):
-    """ iterate over clustS files to get data """
+    """ 
+    get maxlen and depth of each cluster from the depths sidecar, or by
+    iterating over the clustS file if the sidecar is missing or stale.
+    """
 
     ## use existing sample cluster path if it exists, since this
     ## func can be used in step 4 and that can occur after merging
@@ -69,6 +104,14 @@ def get_quick_depths(data, sample):
 
     ## get new clustered loci
     fclust = data.samples[sample.name].files.clusters
+
+    ## the sidecar is written with the clustS file, use it if it's not older
+    dhandle = depths_handle(sample)
+    if os.path.exists(dhandle) and \
+        os.path.getmtime(dhandle) >= os.path.getmtime(fclust):
+        arr = np.load(dhandle)
+        return arr[:, 0], arr[:, 1]
+
     clusters = gzip.open(fclust, 'r')
     pairdealer = itertools.izip(*[iter(clusters)]*2)
 
@@ -98,10 +141,16 @@ def get_quick_depths(data, sample):
 
         else:
             tdepth += int(name.split(";")[-2][5:])
-            tlen = len(seq)
+            tlen = len(seq.rstrip())
 
-    ## return
+    ## write the sidecar so the next call doesn't need to parse clusters
     clusters.close()
+    try:
+        save_depths(sample, zip(maxlen, depths))
+    except (IOError, OSError) as inst:
+        LOGGER.warning("could not write depths for %s: %s", sample.name, inst)
+
+    ## return
     return np.array(maxlen), np.array(depths)
 
 
@@ -186,15 +235,14 @@ def sample_cleanup(data, sample):
 
     if not log_level == "DEBUG":
         ## Clean up loose files only if not in DEBUG
-        ##- edits/*derep, utemp, *utemp.sort, *htemp, *clust.gz
+        ##- edits/*derep, utemp, *htemp, *clust.gz
         derepfile = os.path.join(data.dirs.edits, sample.name+"_derep.fastq")
         mergefile = os.path.join(data.dirs.edits, sample.name+"_merged_.fastq")
         uhandle = os.path.join(data.dirs.clusts, sample.name+".utemp")
-        usort = os.path.join(data.dirs.clusts, sample.name+".utemp.sort")
         hhandle = os.path.join(data.dirs.clusts, sample.name+".htemp")
         clusters = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
 
-        for f in [derepfile, mergefile, uhandle, usort, hhandle, clusters]:
+        for f in [derepfile, mergefile, uhandle, hhandle, clusters]:
             try:
                 os.remove(f)
             except:
@@ -202,119 +250,86 @@ def sample_cleanup(data, sample):
 
 
 
-## winner, rigorously testing in sequential and parallel against other funcs
-def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
-    """ keeps a persistent bash shell open and feeds it muscle alignments """
-
-    ## create a separate shell for running muscle in, this is much faster
-    ## than spawning a separate subprocess for each muscle call
-    proc = sps.Popen(["bash"], 
-                     stdin=sps.PIPE, 
-                     stdout=sps.PIPE, 
-                     universal_newlines=True)
+def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False, service=None):
+    """ 
+    aligns clusters with muscle through an AlignService (a new one is 
+    started if None), splitting pairs at the nnnn separator.
+    """
 
-    ## iterate over clusters in this file until finished
-    aligned = []
+    ## build the muscle input for each cluster: one for single-end or merged
+    ## reads, or one for read1s and one for read2s of paired reads.
+    kinds = []
+    fastas = []
     for clust in clusts:
-
-        ## new alignment string for read1s and read2s
-        align1 = ""
-        align2 = ""
-
         ## don't bother aligning if only one seq
         if clust.count(">") == 1:
-            aligned.append(clust.replace(">", "").strip())
-        else:
+            kinds.append(0)
+            continue
 
-            ## do we need to split the alignment? (is there a PE insert?)
-            try:
-                ## make into list (only read maxseqs lines, 2X cuz names)
-                lclust = clust.split()[:maxseqs*2]
-
-                ## try to split cluster list at nnnn separator for each read
-                lclust1 = list(itertools.chain(*zip(\
-                     lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
-                lclust2 = list(itertools.chain(*zip(\
-                     lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
-
-                ## put back into strings
-                clust1 = "\n".join(lclust1)
-                clust2 = "\n".join(lclust2)
-
-                ## Align the first reads.
-                ## The muscle command with alignment as stdin and // as splitter
-                cmd1 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                        .format(clust1, ipyrad.bins.muscle, "//")
-
-                ## send cmd1 to the bash shell
-                print(cmd1, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                ## meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, '//\n'):
-                    align1 += line
-
-                ## Align the second reads.
-                ## The muscle command with alignment as stdin and // as splitter
-                cmd2 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                        .format(clust2, ipyrad.bins.muscle, "//")
-
-                ## send cmd2 to the bash shell
-                print(cmd2, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                ## meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, '//\n'):
-                    align2 += line
-
-                ## join up aligned read1 and read2 and ensure names order matches
-                la1 = align1[1:].split("\n>")
-                la2 = align2[1:].split("\n>")
-                dalign1 = dict([i.split("\n", 1) for i in la1])
-                dalign2 = dict([i.split("\n", 1) for i in la2])
-                align1 = []
-                try:
-                    keys = sorted(dalign1.keys(), key=DEREP, reverse=True)
-                except ValueError as inst:
-                    ## Lines is empty. This means the call to muscle alignment failed.
-                    ## Not sure how to handle this, but it happens only very rarely.
-                    LOGGER.error("Muscle alignment failed: Bad clust - {}\nBad lines - {}"\
-                                .format(clust, lines))
-                    continue
+        ## make into list (only read maxseqs lines, 2X cuz names)
+        lclust = clust.split()[:maxseqs*2]
 
-                ## put seed at top of alignment
-                seed = [i for i in keys if i.split(";")[-1][0]=="*"][0]
-                keys.pop(keys.index(seed))
-                keys = [seed] + keys
-                for key in keys:
-                    align1.append("\n".join([key, 
-                                    dalign1[key].replace("\n", "")+"nnnn"+\
-                                    dalign2[key].replace("\n", "")]))
+        ## do we need to split the alignment? (is there a PE insert?)
+        try:
+            ## try to split cluster list at nnnn separator for each read
+            lclust1 = list(itertools.chain(*zip(\
+                 lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
+            lclust2 = list(itertools.chain(*zip(\
+                 lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
+            fastas.append("\n".join(lclust1))
+            fastas.append("\n".join(lclust2))
+            kinds.append(2)
+
+        ## Either reads are SE, or at least some pairs are merged.
+        except IndexError:
+            fastas.append("\n".join(lclust))
+            kinds.append(1)
+
+    ## stream the alignments back in order
+    own = service is None
+    if own:
+        service = AlignService()
+    results = service.align(fastas)
 
-                ## append aligned cluster string
-                aligned.append("\n".join(align1).strip())
+    ## iterate over clusters in this file until finished
+    aligned = []
+    try:
+        for clust, kind in itertools.izip(clusts, kinds):
+            if not kind:
+                aligned.append(clust.replace(">", "").strip())
 
-            ## Malformed clust. Dictionary creation with only 1 element will raise.
-            except ValueError as inst:
-                LOGGER.debug("Bad PE cluster - {}\nla1 - {}\nla2 - {}".format(\
-                                clust, la1, la2))
+            elif kind == 2:
+                align1 = results.next()
+                align2 = results.next()
+                try:
+                    ## join up aligned read1 and read2 and ensure names order matches
+                    la1 = align1[1:].split("\n>")
+                    la2 = align2[1:].split("\n>")
+                    dalign1 = dict([i.split("\n", 1) for i in la1])
+                    dalign2 = dict([i.split("\n", 1) for i in la2])
+                    align1 = []
+                    keys = sorted(dalign1.keys(), key=DEREP, reverse=True)
 
-            ## Either reads are SE, or at least some pairs are merged.
-            except IndexError:
-                    
-                ## limit the number of input seqs
-                lclust = "\n".join(clust.split()[:maxseqs*2])
+                    ## put seed at top of alignment
+                    seed = [i for i in keys if i.split(";")[-1][0]=="*"][0]
+                    keys.pop(keys.index(seed))
+                    keys = [seed] + keys
+                    for key in keys:
+                        align1.append("\n".join([key, 
+                                        dalign1[key].replace("\n", "")+"nnnn"+\
+                                        dalign2[key].replace("\n", "")]))
 
-                ## the muscle command with alignment as stdin and // as splitter
-                cmd = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                            .format(lclust, ipyrad.bins.muscle, "//")
+                    ## append aligned cluster string
+                    aligned.append("\n".join(align1).strip())
 
-                ## send cmd to the bash shell (TODO: PIPE could overflow here!)
-                print(cmd, file=proc.stdin)
+                ## Malformed clust or failed muscle alignment. Dictionary 
+                ## creation with only 1 element will raise.
+                except (ValueError, IndexError, KeyError):
+                    LOGGER.debug("Bad PE cluster - {}\nla1 - {}\nla2 - {}"\
+                                 .format(clust, align1, align2))
 
-                ## read the stdout by line until // is reached. This BLOCKS.
-                for line in iter(proc.stdout.readline, '//\n'):
-                    align1 += line
+            else:
+                align1 = results.next()
 
                 ## remove '>' from names, and '\n' from inside long seqs                
                 lines = align1[1:].split("\n>")
@@ -324,7 +339,7 @@ def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
                     seed = [i for i in lines if i.split(";")[-1][0]=="*"][0]
                     lines.pop(lines.index(seed))
                     lines = [seed] + sorted(lines, key=DEREP, reverse=True)
-                except ValueError as inst:
+                except (ValueError, IndexError):
                     ## Lines is empty. This means the call to muscle alignment failed.
                     ## Not sure how to handle this, but it happens only very rarely.
                     LOGGER.error("Muscle alignment failed: Bad clust - {}\nBad lines - {}"\
@@ -341,13 +356,11 @@ def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
 
                 ## append to aligned
                 aligned.append("\n".join(align1).strip())
-               
-    # cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
+
+    ## cleanup
+    finally:
+        if own:
+            service.close()
 
     ## return the aligned clusters
     return aligned   
@@ -403,12 +416,245 @@ def gbs_trim(align1):
 ## quick lambda func to get derep number from reads
 DEREP = lambda x: int(x.split("=")[-1].split(";")[0])
 
+## first line of clusters that build_clusters found to be gap-free
+GAPFREE = "#gapfree"
+
+
+def gapfree_align(clust, maxseqs=200, is_gbs=False):
+    """ 
+    returns a cluster flagged as GAPFREE by build_clusters, in which every
+    hit covers the seed with no gaps, as an alignment in the same format as
+    persistent_popen_align3 without calling muscle.
+    """
+    ## drop the flag, and only read maxseqs seqs (2X cuz names)
+    lclust = clust.split()[1:maxseqs*2+1]
+    align1 = [i[1:]+"\n"+j for i, j in zip(lclust[::2], lclust[1::2])]
+    align1 = [align1[0]] + sorted(align1[1:], key=DEREP, reverse=True)
+
+    ## trim edges in sloppy gbs/ezrad data, as muscle does for unsplit reads
+    if is_gbs and not all(["nnnn" in i for i in lclust[1::2]]):
+        align1 = gbs_trim(align1)
+    return "\n".join(align1).strip()
+
+
+
+## nucleotide codes for the native aligner, anything not ACGT is 4 (N)
+NTCODES = np.zeros(256, dtype=np.uint8) + 4
+NTCODES[[ord(i) for i in "ACGT"]] = np.arange(4)
+NTCODES[[ord(i) for i in "acgt"]] = np.arange(4)
+
+
+@numba.jit(nopython=True)
+def banded_nw(read, prof, band, match, mismatch, gapopen, gapext):
+    """
+    Seed-anchored banded Needleman-Wunsch with affine gaps and free end gaps
+    (Gotoh) of read against a profile consensus, both as NTCODES arrays.
+    The band allows 'band' indels around both the left- and right-justified
+    placements of the read. Returns the alignment as an array of ops, where
+    0 = read base on a profile column, 1 = gap in read, 2 = read insertion.
+    """
+    nrd = read.shape[0]
+    npr = prof.shape[0]
+    neg = -1000000000
+    lo = min(0, npr - nrd) - band
+    hi = max(0, npr - nrd) + band
+
+    ## score and pointer matrices for states 0=match, 1=insert, 2=delete
+    scores = np.empty((3, nrd + 1, npr + 1), dtype=np.int32)
+    scores[:] = neg
+    ptrs = np.zeros((3, nrd + 1, npr + 1), dtype=np.int8)
+
+    ## leading gaps are free
+    scores[0, 0, 0] = 0
+    for idx in range(1, min(nrd, -lo) + 1):
+        scores[1, idx, 0] = 0
+        ptrs[1, idx, 0] = -1
+    for jdx in range(1, min(npr, hi) + 1):
+        scores[2, 0, jdx] = 0
+        ptrs[2, 0, jdx] = -1
+
+    ## fill the band
+    for idx in range(1, nrd + 1):
+        for jdx in range(max(1, idx + lo), min(npr, idx + hi) + 1):
+            ## match/mismatch, N scores zero
+            if (read[idx-1] == 4) or (prof[jdx-1] == 4):
+                sub = 0
+            elif read[idx-1] == prof[jdx-1]:
+                sub = match
+            else:
+                sub = mismatch
+            best = 0
+            for state in range(1, 3):
+                if scores[state, idx-1, jdx-1] > scores[best, idx-1, jdx-1]:
+                    best = state
+            scores[0, idx, jdx] = scores[best, idx-1, jdx-1] + sub
+            ptrs[0, idx, jdx] = best
+
+            ## read base against a gap in the profile
+            best = 1
+            bscore = scores[1, idx-1, jdx] - gapext
+            for state in (0, 2):
+                if scores[state, idx-1, jdx] - gapopen > bscore:
+                    best = state
+                    bscore = scores[state, idx-1, jdx] - gapopen
+            scores[1, idx, jdx] = bscore
+            ptrs[1, idx, jdx] = best
+
+            ## gap in the read against a profile base
+            best = 2
+            bscore = scores[2, idx, jdx-1] - gapext
+            for state in (0, 1):
+                if scores[state, idx, jdx-1] - gapopen > bscore:
+                    best = state
+                    bscore = scores[state, idx, jdx-1] - gapopen
+            scores[2, idx, jdx] = bscore
+            ptrs[2, idx, jdx] = best
+
+    ## trailing gaps are free: best end in the last row or last column, 
+    ## where ties go to the end with no trailing gaps
+    bidx, bjdx, bstate = nrd, npr, 0
+    bscore = neg
+    for state in range(3):
+        if scores[state, nrd, npr] > bscore:
+            bscore = scores[state, nrd, npr]
+            bstate = state
+    for jdx in range(max(0, nrd + lo), min(npr, nrd + hi) + 1):
+        for state in range(3):
+            if scores[state, nrd, jdx] > bscore:
+                bscore = scores[state, nrd, jdx]
+                bidx, bjdx, bstate = nrd, jdx, state
+    for idx in range(max(0, npr - hi), min(nrd, npr - lo) + 1):
+        for state in range(3):
+            if scores[state, idx, npr] > bscore:
+                bscore = scores[state, idx, npr]
+                bidx, bjdx, bstate = idx, npr, state
+
+    ## traceback, ops are filled in reverse
+    ops = np.zeros(nrd + npr, dtype=np.uint8)
+    nops = 0
+    for idx in range(nrd, bidx, -1):
+        ops[nops] = 2
+        nops += 1
+    for jdx in range(npr, bjdx, -1):
+        ops[nops] = 1
+        nops += 1
+    idx, jdx, state = bidx, bjdx, bstate
+    while (idx > 0) and (jdx > 0):
+        prev = ptrs[state, idx, jdx]
+        if state == 0:
+            ops[nops] = 0
+            idx -= 1
+            jdx -= 1
+        elif state == 1:
+            ops[nops] = 2
+            idx -= 1
+        else:
+            ops[nops] = 1
+            jdx -= 1
+        nops += 1
+        if prev < 0:
+            break
+        state = prev
+    while idx > 0:
+        ops[nops] = 2
+        nops += 1
+        idx -= 1
+    while jdx > 0:
+        ops[nops] = 1
+        nops += 1
+        jdx -= 1
+    return ops[:nops][::-1]
+
+
+
+def star_align(seqs, band=20, match=5, mismatch=-4, gapopen=12, gapext=2):
+    """
+    Progressive star alignment of seqs (the seed first) for short, similar
+    reads. Each read is aligned with banded_nw() to the consensus of the
+    alignment so far, and bases it inserts become new gap columns for the
+    other rows. Returns the aligned seqs as uppercase strings, like muscle.
+    """
+    arrs = [np.fromstring(i.upper(), dtype=np.uint8) for i in seqs]
+    msa = arrs[0].reshape(1, -1)
+
+    ## base counts per column, the consensus is the most common ACGT
+    counts = np.zeros((msa.shape[1], 5), dtype=np.int32)
+    counts[np.arange(msa.shape[1]), NTCODES[arrs[0]]] += 1
+
+    for arr in arrs[1:]:
+        cons = counts[:, :4].argmax(axis=1).astype(np.uint8)
+        cons[counts[:, :4].max(axis=1) == 0] = 4
+        ops = banded_nw(NTCODES[arr], cons, band, match, mismatch, gapopen, gapext)
+
+        ## expand the alignment by the columns that the read inserts
+        oldcols = np.where(ops != 2)[0]
+        newmsa = np.zeros((msa.shape[0] + 1, ops.size), dtype=np.uint8) + 45
+        newmsa[:-1, oldcols] = msa
+        readcols = np.where(ops != 1)[0]
+        newmsa[-1, readcols] = arr
+        newcounts = np.zeros((ops.size, 5), dtype=np.int32)
+        newcounts[oldcols] = counts
+        newcounts[readcols, NTCODES[arr]] += 1
+        msa, counts = newmsa, newcounts
+
+    return [i.tostring() for i in msa]
+
+
+
+class NativeAligner(AlignService):
+    """
+    In-process drop-in for AlignService that aligns clusters with the 
+    numba star_align() instead of muscle. Selected with the hackersonly
+    'clust_aligner' parameter (native or muscle).
+    """
+    def __init__(self, band=20):
+        self.band = band
+        self.times = []
+        self.sizes = []
+
+
+    def align(self, fastas):
+        """ yields the alignment of each fasta string as muscle would """
+        for fasta in fastas:
+            start = time.time()
+            lines = fasta.strip().split("\n")
+            names, seqs = lines[::2], lines[1::2]
+            try:
+                aseqs = star_align(seqs, self.band)
+                result = "".join(["{}\n{}\n".format(i, j) for i, j in zip(names, aseqs)])
+            except (ValueError, IndexError) as inst:
+                LOGGER.error("native alignment failed: %s\n%s", inst, fasta)
+                result = ""
+            self.times.append(time.time() - start)
+            self.sizes.append(len(names))
+            yield result
+
+
+    def close(self):
+        pass
+
+
+
+def get_aligner(name, tmpdir=None):
+    """ returns the cluster alignment service for clust_aligner 'name' """
+    if name == "native":
+        return NativeAligner()
+    elif name == "muscle":
+        return AlignService(tmpdir=tmpdir)
+    raise IPyradError(
+        "clust_aligner must be 'muscle' or 'native', not {}".format(name))
+
+
 
 ## max-internal-indels could be modified if we add it to hackerz dict.
-def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
-    """ much faster implementation for aligning chunks """
+def align_and_parse(handle, max_internal_indels=5, is_gbs=False, aligner="muscle"):
+    """ 
+    much faster implementation for aligning chunks, with muscle or with the
+    native star aligner (see get_aligner)
+    """
 
     ## data are already chunked, read in the whole thing. bail if no data.
+    start = time.time()
     try:
         with open(handle, 'rb') as infile:
             clusts = infile.read().split("//\n//\n")
@@ -419,18 +665,35 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
                 raise IPyradError
     except (IOError, IPyradError):
         LOGGER.debug("skipping empty chunk - {}".format(handle))
-        return 0
+        return Counter()
 
-    ## count discarded clusters for printing to stats later
+    ## count discarded clusters for printing to stats later, and which 
+    ## clusters were aligned by muscle or were already gap-free.
     highindels = 0
+    counts = Counter()
+    counts["align_cost"] = sum([cluster_cost(i) for i in clusts])
+    counts["align_clusters"] = len(clusts)
+
+    ## clusters flagged as gap-free are already aligned
+    aligned = [gapfree_align(i, 200, is_gbs) for i in clusts if i.startswith(GAPFREE)]
+    clusts = [i for i in clusts if not i.startswith(GAPFREE)]
+    counts["aligned_gapfree"] = len(aligned)
+    counts["aligned_muscle"] = sum(1 for i in clusts if i.count(">") > 1)
+    counts["aligned_single"] = len(clusts) - counts["aligned_muscle"]
 
     ## iterate over clusters sending each to muscle, splits and aligns pairs
+    service = get_aligner(aligner, tmpdir=os.path.dirname(handle))
     try:
-        aligned = persistent_popen_align3(clusts, 200, is_gbs)
+        aligned += persistent_popen_align3(clusts, 200, is_gbs, service)
     except Exception as inst:
         LOGGER.debug("Error in handle - {} - {}".format(handle, inst))
         #raise IPyradWarningExit("error hrere {}".format(inst))
         aligned = []        
+    finally:
+        service.close()
+    LOGGER.info("aligned %s: %s gap-free, %s %s: %s", os.path.basename(handle),
+                counts["aligned_gapfree"], counts["aligned_muscle"], aligner,
+                ALIGNSTATS.format(**service.stats()))
 
     ## store good alignments to be written to file
     refined = []
@@ -460,7 +723,9 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
     log_level = logging.getLevelName(LOGGER.getEffectiveLevel())
     if not log_level == "DEBUG":
         os.remove(handle)
-    return highindels
+    counts["filtered_bad_align"] = highindels
+    counts["align_seconds"] = time.time() - start
+    return counts
 
 
 
@@ -490,6 +755,188 @@ def aligned_indel_filter(clust, max_internal_indels):
 
 
 
+## value of each hex character, 16 marks anything that is not hex
+HEXCODES = np.zeros(256, dtype=np.uint64) + 16
+HEXCODES[[ord(i) for i in "0123456789abcdef"]] = np.arange(16)
+HEXCODES[[ord(i) for i in "ABCDEF"]] = np.arange(10, 16)
+HEXSHIFTS = np.arange(60, -1, -4).astype(np.uint64)
+
+
+class DerepStore(object):
+    """
+    Integer-indexed view of a two-line derep fasta. The file is memory-mapped
+    rather than loaded, and reads are stored as offset arrays into the map.
+    vsearch md5 names (--relabel_md5) are indexed by a sorted array of 64-bit
+    keys parsed from their first 16 hex characters, other names (e.g., the
+    unmapped reads in reference assemblies) fall back to a name->index dict.
+    """
+    def __init__(self, derepfile):
+        self.ioderep = open(derepfile, 'rb')
+        if os.path.getsize(derepfile):
+            self.mmap = mmap.mmap(self.ioderep.fileno(), 0, access=mmap.ACCESS_READ)
+            arr = np.frombuffer(self.mmap, dtype=np.uint8)
+        else:
+            self.mmap = ""
+            arr = np.zeros(0, dtype=np.uint8)
+
+        ## line ends, with the end of file if the last line has no newline
+        ends = np.where(arr == 10)[0]
+        if arr.size and arr[-1] != 10:
+            ends = np.append(ends, arr.size)
+        starts = np.zeros(ends.size, dtype=np.int64)
+        starts[1:] = ends[:-1] + 1
+
+        ## name lines (skip the '>') and seq lines, stripping any '\r'
+        self.nstarts = starts[0::2] + 1
+        self.nends = ends[0::2]
+        self.sstarts = starts[1::2]
+        self.sends = ends[1::2]
+        self.nstarts = self.nstarts[:self.sends.size]
+        self.nends = self.nends[:self.sends.size]
+        if self.sends.size and arr[self.sends[0] - 1] == 13:
+            self.nends = self.nends - 1
+            self.sends = self.sends - 1
+        self.nreads = self.sends.size
+
+        ## build keys from the md5 names, or a dict if names are not md5
+        self.lookup = None
+        self.keys = None
+        if self.nreads and np.all(self.nends - self.nstarts >= 16):
+            hexs = HEXCODES[arr[self.nstarts[:, None] + np.arange(16)]]
+            if not np.any(hexs > 15):
+                keys = np.bitwise_or.reduce(hexs << HEXSHIFTS, axis=1)
+                self.order = np.argsort(keys, kind="mergesort")
+                self.keys = keys[self.order]
+                if np.any(self.keys[1:] == self.keys[:-1]):
+                    self.keys = None
+            del hexs
+        if self.keys is None:
+            self.lookup = {self.name(i): i for i in xrange(self.nreads)}
+        del arr
+
+
+    def name(self, idx):
+        """ returns the name of read idx without the '>' """
+        return self.mmap[self.nstarts[idx]:self.nends[idx]]
+
+
+    def seq(self, idx):
+        """ returns the sequence of read idx """
+        return self.mmap[self.sstarts[idx]:self.sends[idx]]
+
+
+    def index(self, names):
+        """ returns an array with the read index of each name in names """
+        if self.lookup is not None:
+            return np.array([self.lookup[i] for i in names], dtype=np.int64)
+
+        query = np.array([int(i[:16], 16) for i in names], dtype=np.uint64)
+        pos = np.searchsorted(self.keys, query)
+        pos[pos == self.keys.size] = 0
+        idxs = self.order[pos]
+        ## check the key and the full name so a miss never passes silently
+        for name, key, idx in itertools.izip(names, self.keys[pos] == query, idxs):
+            if not key or self.name(idx) != name:
+                raise KeyError(name)
+        return idxs
+
+
+    def close(self):
+        """ unmaps and closes the derep file """
+        if self.mmap:
+            self.mmap.close()
+        self.ioderep.close()
+
+
+
+class SeedHits(object):
+    """
+    Seed->hits grouping of a vsearch .utemp file, built in one pass without
+    sorting the file. Reads get integer ids from index(names), or else in
+    order of first appearance (their names are then kept in .names). Seeds
+    are stored in ascending id order and the hits of the i-th seed are
+    hits[offsets[i]:offsets[i+1]] in file order, along with their strand
+    (revcomp), indels and qcov columns (0 indels and 100 qcov if the file
+    has no such column).
+    """
+    def __init__(self, uhandle, strand, indels=None, qcov=None, index=None, 
+                 batch=100000):
+        self.names = []
+        self._ids = {}
+        if index is None:
+            index = self._name_ids
+
+        ## parse the file in batches of lines
+        hits, seeds, revcomp, nindels, qcovs = [], [], [], [], []
+        with open(uhandle, 'rb') as infile:
+            while 1:
+                lines = [i.split() for i in itertools.islice(infile, batch)]
+                if not lines:
+                    break
+                hits.append(index([i[0] for i in lines]))
+                seeds.append(index([i[1] for i in lines]))
+                revcomp.append(np.array([i[strand] == "-" for i in lines], dtype=np.bool_))
+                if indels is not None:
+                    nindels.append(np.array([i[indels] for i in lines], dtype=np.int64))
+                else:
+                    nindels.append(np.zeros(len(lines), dtype=np.int64))
+                if qcov is not None:
+                    qcovs.append(np.array([i[qcov] for i in lines], dtype=np.float64))
+                else:
+                    qcovs.append(np.zeros(len(lines), dtype=np.float64) + 100)
+
+        hits = np.concatenate(hits or [np.zeros(0, dtype=np.int64)])
+        seeds = np.concatenate(seeds or [np.zeros(0, dtype=np.int64)])
+        revcomp = np.concatenate(revcomp or [np.zeros(0, dtype=np.bool_)])
+        nindels = np.concatenate(nindels or [np.zeros(0, dtype=np.int64)])
+        qcovs = np.concatenate(qcovs or [np.zeros(0, dtype=np.float64)])
+
+        ## group hits by seed (CSR), a stable sort keeps hits in file order
+        self.seeds, inverse = np.unique(seeds, return_inverse=True)
+        order = np.argsort(inverse, kind="mergesort")
+        self.hits = hits[order]
+        self.revcomp = revcomp[order]
+        self.indels = nindels[order]
+        self.qcov = qcovs[order]
+        self.offsets = np.zeros(self.seeds.size + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(
+            np.bincount(inverse, minlength=self.seeds.size))
+
+        ## the name lookup is only needed while parsing
+        self._ids = {}
+
+
+    def _name_ids(self, names):
+        """ assigns ids to names in order of first appearance """
+        ids = np.zeros(len(names), dtype=np.int64)
+        for idx, name in enumerate(names):
+            nid = self._ids.get(name)
+            if nid is None:
+                nid = self._ids[name] = len(self.names)
+                self.names.append(name)
+            ids[idx] = nid
+        return ids
+
+
+    def __len__(self):
+        return self.seeds.size
+
+
+    def __iter__(self):
+        """ yields (seed, hits, revcomp, indels, qcov) for each seed """
+        for sidx in xrange(self.seeds.size):
+            start, end = self.offsets[sidx], self.offsets[sidx + 1]
+            yield (self.seeds[sidx], self.hits[start:end],
+                   self.revcomp[start:end], self.indels[start:end],
+                   self.qcov[start:end])
+
+
+    def sizes(self):
+        """ returns the number of hits for each seed """
+        return np.diff(self.offsets)
+
+
+
 def build_clusters(data, sample, maxindels):
     """
     Combines information from .utemp and .htemp files to create .clust files,
@@ -505,117 +952,97 @@ def build_clusters(data, sample, maxindels):
         derepfile = os.path.join(data.dirs.edits, sample.name+"_derep.fastq")
     ## i/o vsearch files
     uhandle = os.path.join(data.dirs.clusts, sample.name+".utemp")
-    usort = os.path.join(data.dirs.clusts, sample.name+".utemp.sort")
     hhandle = os.path.join(data.dirs.clusts, sample.name+".htemp")
 
     ## create an output file to write clusters to
     sample.files.clusters = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
-    clustsout = gzip.open(sample.files.clusters, 'wb')
-
-    ## Sort the uhandle file so we can read through matches efficiently
-    cmd = ["sort", "-k", "2", uhandle, "-o", usort]
-    proc = sps.Popen(cmd, close_fds=True)
-    _ = proc.communicate()[0]
-
-    ## load ALL derep reads into a dictionary (this can be a few GB of RAM)
-    ## and is larger if names are larger. We are grabbing two lines at a time.
-    alldereps = {}
-    with open(derepfile, 'rb') as ioderep:
-        dereps = itertools.izip(*[iter(ioderep)]*2)
-        for namestr, seq in dereps:
-            nnn, sss = [i.strip() for i in namestr, seq]
-            alldereps[nnn[1:]] = sss
-
-    ## store observed seeds (this could count up to >million in bad data sets)
-    seedsseen = set()
-
-    ## Iterate through the usort file grabbing matches to build clusters
-    with open(usort, 'rb') as insort:
-        ## iterator, seed null, seqlist null
-        isort = iter(insort)
-        lastseed = 0
-        fseqs = []
-        seqlist = []
-        seqsize = 0
-        while 1:
-            ## grab the next line
-            try:
-                hit, seed, _, ind, ori, _ = isort.next().strip().split()
-                LOGGER.debug(">{} {} {}".format(hit, seed, ori, seq))
-            except StopIteration:
-                break
-
-            ## same seed, append match
-            if seed != lastseed:
-                seedsseen.add(seed)
-                ## store the last cluster (fseq), count it, and clear fseq
-                if fseqs:
-                    ## sort fseqs by derep after pulling out the seed
-                    fseqs = [fseqs[0]] + sorted(fseqs[1:], key=lambda x: \
-                        int(x.split(";size=")[1].split(";")[0]), reverse=True)                    
-                    seqlist.append("\n".join(fseqs))
-                    seqsize += 1
-                    fseqs = []
+    clustsout = bgzopen(data, sample.files.clusters)
 
-                ## occasionally write/dump stored clusters to file and clear mem
-                if not seqsize % 10000:
-                    if seqlist:
-                        clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
-                        ## reset list and counter
-                        seqlist = []
+    ## index the derep reads. They are memory-mapped instead of loaded into
+    ## a dict, so RAM use no longer scales with the number of reads per sample
+    derep = DerepStore(derepfile)
 
-                ## store the new seed on top of fseq list
-                fseqs.append(">{}*\n{}".format(seed, alldereps[seed]))
-                lastseed = seed
+    ## group the utemp hits (query target id gaps qstrand qcov) by their seed
+    seedhits = SeedHits(uhandle, strand=4, indels=3, qcov=5, index=derep.index)
 
-            ## add match to the seed
+    ## store observed seeds (this could count up to >million in bad data sets)
+    seedsseen = np.zeros(derep.nreads, dtype=np.bool_)
+    seedsseen[seedhits.seeds] = True
+
+    ## build a cluster for each seed
+    seqlist = []
+    for seed, hits, revcomp, indels, qcovs in seedhits:
+        ## store the seed on top of the cluster
+        seedseq = derep.seq(seed)
+        fseqs = [">{}*\n{}".format(derep.name(seed), seedseq)]
+        hseqs = []
+        gapfree = True
+        for hit, rev, ind, qcov in itertools.izip(hits.tolist(), revcomp, indels, qcovs):
             ## revcomp if orientation is reversed (comp preserves nnnn)
-            if ori == "-":
-                seq = comp(alldereps[hit])[::-1]
+            if rev:
+                ori, seq = "-", comp(derep.seq(hit))[::-1]
             else:
-                seq = alldereps[hit]
+                ori, seq = "+", derep.seq(hit)
             ## only save if not too many indels
-            if int(ind) <= maxindels:
-                fseqs.append(">{}{}\n{}".format(hit, ori, seq))
+            if ind <= maxindels:
+                hseqs.append(">{}{}\n{}".format(derep.name(hit), ori, seq))
+                ## still gap-free if the hit covers the whole seed without
+                ## gaps (so is already aligned to it), pair splits included
+                gapfree = gapfree and (not ind) and (qcov >= 100) and \
+                          (len(seq) == len(seedseq)) and \
+                          (seq.find("nnnn") == seedseq.find("nnnn"))
             else:
                 LOGGER.info("filtered by maxindels: %s %s", ind, seq)
 
-    ## write whatever is left over to the clusts file
-    if fseqs:
+        ## sort hits by derep size below the seed
+        fseqs += sorted(hseqs, key=lambda x: \
+            int(x.split(";size=")[1].split(";")[0]), reverse=True)
+
+        ## flag clusters that don't need to be aligned by muscle
+        if hseqs and gapfree:
+            fseqs.insert(0, GAPFREE)
         seqlist.append("\n".join(fseqs))
+
+        ## occasionally write/dump stored clusters to file and clear mem
+        if len(seqlist) == 10000:
+            clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
+            seqlist = []
+
+    ## write whatever is left over to the clusts file
     if seqlist:
         clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
+    del seedhits
 
-    ## now write the seeds that had no hits. Make dict from htemp
+    ## now write the seeds that had no hits, reading htemp in batches
     with open(hhandle, 'rb') as iotemp:
-        nohits = itertools.izip(*[iter(iotemp)]*2)
         seqlist = []
         seqsize = 0
         while 1:
-            try:
-                nnn, _ = [i.strip() for i in nohits.next()]
-            except StopIteration:
+            names = [i.strip() for i in itertools.islice(iotemp, 200000)][::2]
+            if not names:
                 break
+            idxs = derep.index([i[1:] for i in names])
 
-            ## occasionally write to file
-            if not seqsize % 10000:
-                if seqlist:
-                    clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
-                    ## reset list and counter
-                    seqlist = []
+            for nnn, idx in itertools.izip(names, idxs):
+                ## occasionally write to file
+                if not seqsize % 10000:
+                    if seqlist:
+                        clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
+                        ## reset list and counter
+                        seqlist = []
 
-            ## append to list if new seed
-            if nnn[1:] not in seedsseen:
-                seqlist.append("{}*\n{}".format(nnn, alldereps[nnn[1:]]))
-                seqsize += 1
+                ## append to list if new seed
+                if not seedsseen[idx]:
+                    seqlist.append("{}*\n{}".format(nnn, derep.seq(idx)))
+                    seqsize += 1
 
     ## write whatever is left over to the clusts file
     if seqlist:
         clustsout.write("\n//\n//\n".join(seqlist))#+"\n//\n//\n")
 
-    ## close the file handle
+    ## close the file handles
     clustsout.close()
-    del alldereps
+    derep.close()
 
 
 
@@ -662,22 +1089,19 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
     #printstr = " {}      | {} | s3 |".format(PRINTSTR[], elapsed)
     progressbar(10, 0, printstr, spacer=data._spacer)
 
-    ## TODO: for HPC systems this should be done to make sure targets are spread
-    ## among different nodes.
+    ## threaded jobs (vsearch, bwa) go to a view with one target engine per
+    ## thread slot, and each host gets as many slots as it has cpus for.
+    inventory = get_host_inventory(ipyclient)
     if nthreads:
-        if nthreads < len(ipyclient.ids):
-            thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::nthreads])
-        elif nthreads == 1:
-            thview = ipyclient.load_balanced_view()
-        else:
-            if len(ipyclient) > 40:
-                thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::4])
-            else:
-                thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::2])
+        thview = ipyclient.load_balanced_view(
+            targets=get_thread_slots(inventory, nthreads))
 
 
-    ## get list of jobs/dependencies as a DAG for all pre-align funcs.
-    dag, joborder = build_dag(data, samples)
+    ## get list of jobs/dependencies as a DAG for all pre-align funcs, with
+    ## the number of align chunks per sample set by the number of engines.
+    nchunks = get_align_nchunks(data, samples, len(ipyclient))
+    nslots = get_clust_slots(data, samples, inventory)
+    dag, joborder = build_dag(data, samples, nchunks, nslots)
 
     ## dicts for storing submitted jobs and results
     results = {}
@@ -701,10 +1125,12 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
             args = [data, sample, nthreads, force]
         elif funcstr in ["build_clusters"]:
             args = [data, sample, maxindels]
+        elif funcstr in ["muscle_chunker", "ref_build_and_muscle_chunk"]:
+            args = [data, sample, nchunks]
         elif funcstr in ["muscle_align"]:
             handle = os.path.join(data.tmpdir, 
                         "{}_chunk_{}.ali".format(sample.name, chunk))
-            args = [handle, maxindels, is_gbs]
+            args = [handle, maxindels, is_gbs, data._hackersonly["clust_aligner"]]
         else:
             args = [data, sample]
 
@@ -738,18 +1164,32 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
 
     ## Cleanup of successful samples, skip over failed samples
     badaligns = {}
+    chunkstats = []
     for sample in samples:
-        ## The muscle_align step returns the number of excluded bad alignments
+        ## The muscle_align step returns counts of excluded bad alignments
+        ## and of the clusters that took each alignment path. Sum the chunks.
         for async in results:
             func, chunk, sname = async.split("-", 2)
             if (func == "muscle_align") and (sname == sample.name):
                 if results[async].successful():
-                    badaligns[sample] = int(results[async].get())
+                    badaligns.setdefault(sample, Counter())
+                    badaligns[sample].update(results[async].get())
+                    chunkstats.append((sname, int(chunk), results[async].get()))
+
+    ## report the time and estimated cost of each align chunk for tuning
+    write_chunk_report(data, chunkstats)
 
     ## for the samples that were successful:
     for sample in badaligns:
         ## store the result
-        sample.stats_dfs.s3.filtered_bad_align = badaligns[sample]
+        counts = badaligns[sample]
+        sample.stats_dfs.s3.filtered_bad_align = counts["filtered_bad_align"]
+        nmulti = counts["aligned_gapfree"] + counts["aligned_muscle"]
+        LOGGER.info("%s: %s of %s clusters (%.1f%%) were gap-free and not "\
+                    "aligned by muscle, %s were singletons", sample.name, 
+                    counts["aligned_gapfree"], nmulti,
+                    100. * counts["aligned_gapfree"] / max(1, nmulti),
+                    counts["aligned_single"])
         ## store all results
         try:
             sample_cleanup(data, sample)
@@ -767,9 +1207,59 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
 
 
 
-def build_dag(data, samples):
+def estimate_clust_memory(sample):
+    """
+    Rough peak memory (bytes) of a sample while it is being clustered and
+    chunked (vsearch, build_clusters, muscle_chunker), which all scale with
+    the size of its edited reads.
+    """
+    size = 0
+    for edits in sample.files.edits:
+        for handle in edits:
+            if handle and os.path.exists(str(handle)):
+                fsize = os.path.getsize(handle)
+                if handle.endswith(".gz"):
+                    fsize *= 4
+                size += fsize
+    return 3 * size
+
+
+
+def get_clust_slots(data, samples, inventory):
+    """
+    Returns how many samples can be between clustering and chunking at the 
+    same time without running out of memory. Each host can hold as many of 
+    the largest samples as fit in its memory, which is 80% of the RAM 
+    detected on the host, or _hackersonly["clust_max_memory"] (MB) if set.
+    Returns len(samples) if memory is not a limit.
+    """
+    ## memory of each host
+    hostmem = {host: hinfo["mem"] for host, hinfo in inventory.iteritems()}
+    ceiling = data._hackersonly["clust_max_memory"]
+    if ceiling:
+        hostmem = {host: int(ceiling * 1e6) for host in hostmem}
+    else:
+        hostmem = {host: int(0.8 * mem) for host, mem in hostmem.iteritems()}
+
+    ## how many of the largest samples fit on each host
+    maxmem = max([estimate_clust_memory(i) for i in samples] + [1])
+    if not all(hostmem.values()):
+        nslots = len(samples)
+    else:
+        nslots = sum([max(1, mem // maxmem) for mem in hostmem.values()])
+        nslots = int(min(len(samples), nslots))
+    LOGGER.info("clustering up to %s samples at a time; %s hosts, "
+                "largest sample ~%.1f MB", nslots, len(hostmem), maxmem / 1e6)
+    return nslots
+
+
+
+def build_dag(data, samples, nchunks=10, nslots=None):
     """
-    build a directed acyclic graph describing jobs to be run in order.
+    build a directed acyclic graph describing jobs to be run in order, with
+    nchunks align jobs for each sample. Jobs depend only on the earlier
+    jobs of their own sample, except that at most nslots samples can be 
+    between clustering/mapping and chunking at once, to limit memory use.
     """
 
     ## Create DAGs for the assembly method being used, store jobs in nodes
@@ -785,8 +1275,8 @@ def build_dag(data, samples):
         for func in joborder:
             dag.add_node("{}-{}-{}".format(func, 0, sname))
 
-        ## append align func jobs, each will have max 10
-        for chunk in xrange(10):
+        ## append align func jobs, one for each chunk
+        for chunk in xrange(nchunks):
             dag.add_node("{}-{}-{}".format("muscle_align", chunk, sname))
 
         ## append final reconcat jobs
@@ -794,28 +1284,26 @@ def build_dag(data, samples):
 
     ## ORDER OF JOBS: add edges/dependency between jobs: (first-this, then-that)
     for sname in snames:
-        for sname2 in snames:
-            ## enforce that clust/map cannot start until derep is done for ALL
-            ## samples. This is b/c...
-            dag.add_edge("{}-{}-{}".format(joborder[0], 0, sname2),
-                         "{}-{}-{}".format(joborder[1], 0, sname))
-
-        ## add remaining pre-align jobs 
-        for idx in xrange(2, len(joborder)):
+        ## pre-align jobs run in order
+        for idx in xrange(1, len(joborder)):
             dag.add_edge("{}-{}-{}".format(joborder[idx-1], 0, sname),
                          "{}-{}-{}".format(joborder[idx], 0, sname))
 
-        ## Add 10 align jobs, none of which can start until all chunker jobs
-        ## are finished. Similarly, reconcat jobs cannot start until all align
-        ## jobs are finished.
-        for sname2 in snames:
-            for chunk in range(10):
-                dag.add_edge("{}-{}-{}".format("muscle_chunker", 0, sname2),
-                             "{}-{}-{}".format("muscle_align", chunk, sname))
-                ## add that the final reconcat job can't start until after
-                ## each chunk of its own sample has finished aligning.
-                dag.add_edge("{}-{}-{}".format("muscle_align", chunk, sname),
-                             "{}-{}-{}".format("reconcat", 0, sname))
+        ## align jobs start when the sample is chunked, and the final 
+        ## reconcat job can't start until each chunk has finished aligning.
+        for chunk in xrange(nchunks):
+            dag.add_edge("{}-{}-{}".format(joborder[-1], 0, sname),
+                         "{}-{}-{}".format("muscle_align", chunk, sname))
+            dag.add_edge("{}-{}-{}".format("muscle_align", chunk, sname),
+                         "{}-{}-{}".format("reconcat", 0, sname))
+
+    ## memory throttle: samples pass through clustering to chunking in 
+    ## nslots lanes, the next sample in a lane starts when the last finishes.
+    if nslots and (nslots < len(snames)):
+        for idx in xrange(nslots, len(snames)):
+            dag.add_edge("{}-{}-{}".format(joborder[-1], 0, snames[idx-nslots]),
+                         "{}-{}-{}".format(joborder[1], 0, snames[idx]))
+
     ## return the dag
     return dag, joborder
 
@@ -1121,6 +1609,29 @@ def data_cleanup(data):
 
 
 
+def write_chunk_report(data, chunkstats):
+    """ 
+    writes the number of clusters, estimated cost and run time of each 
+    align chunk to s3_align_chunks.txt, and logs the slowest chunks.
+    """
+    if not chunkstats:
+        return
+    chunkstats.sort(key=lambda x: (x[0], x[1]))
+    handle = os.path.join(data.dirs.clusts, "s3_align_chunks.txt")
+    with open(handle, 'w') as out:
+        out.write("{:<30} {:>6} {:>10} {:>14} {:>10}\n".format(
+                  "sample", "chunk", "clusters", "cost", "seconds"))
+        for sname, chunk, counts in chunkstats:
+            out.write("{:<30} {:>6} {:>10} {:>14} {:>10.2f}\n".format(
+                      sname, chunk, counts["align_clusters"], 
+                      counts["align_cost"], counts["align_seconds"]))
+    secs = np.array([i[2]["align_seconds"] for i in chunkstats])
+    LOGGER.info("align chunks: %s, mean %.2fs, max %.2fs (%s chunk %s)", 
+                len(secs), secs.mean(), secs.max(), 
+                *chunkstats[secs.argmax()][:2])
+
+
+
 def concat_multiple_edits(data, sample):
     """
     if multiple fastq files were appended into the list of fastqs for samples
@@ -1173,9 +1684,8 @@ def cluster(data, sample, nthreads, force):
             ## In this case you do have to create empty, dummy vsearch output
             ## files so building_clusters will not fail.
             uhandle = os.path.join(data.dirs.clusts, sample.name+".utemp")
-            usort = os.path.join(data.dirs.clusts, sample.name+".utemp.sort")
             hhandle = os.path.join(data.dirs.clusts, sample.name+".htemp")
-            for f in [uhandle, usort, hhandle]:
+            for f in [uhandle, hhandle]:
                 open(f, 'a').close()
             return
     else:
@@ -1264,14 +1774,36 @@ def cluster(data, sample, nthreads, force):
 
 
 
-def muscle_chunker(data, sample):
+def cluster_cost(clust):
+    """
+    Estimated cost of aligning a cluster: nreads x seed length. Clusters
+    that are not aligned (singletons and GAPFREE clusters) cost 1.
+    """
+    nreads = clust.count(">")
+    if (nreads < 2) or clust.startswith(GAPFREE):
+        return 1
+    return nreads * len(clust.lstrip().split("\n", 2)[1])
+
+
+
+def get_align_nchunks(data, samples, nengines):
     """
-    Splits the muscle alignment into chunks. Each chunk is run on a separate
-    computing core. Because the largest clusters are at the beginning of the 
-    clusters file, assigning equal clusters to each file would put all of the 
-    large cluster, that take longer to align, near the top. So instead we 
-    randomly distribute the clusters among the files. If assembly method is
-    reference then this step is just a placeholder and nothing happens. 
+    Number of align chunks per sample, such that all samples together make
+    about _hackersonly["align_tasks_per_engine"] align jobs for each engine.
+    """
+    ntasks = nengines * data._hackersonly["align_tasks_per_engine"]
+    return int(max(1, np.ceil(ntasks / float(max(1, len(samples))))))
+
+
+
+def muscle_chunker(data, sample, nchunks=10):
+    """
+    Splits the muscle alignment into nchunks chunks. Each chunk is run on a 
+    separate computing core. The largest clusters are at the beginning of the
+    clusters file and take much longer to align, so instead of equal numbers
+    of clusters, each chunk gets about the same total cluster_cost(). If 
+    assembly method is reference then this step is just a placeholder and 
+    nothing happens. 
     """
     ## log our location for debugging
     LOGGER.info("inside muscle_chunker")
@@ -1279,44 +1811,31 @@ def muscle_chunker(data, sample):
     ## only chunk up denovo data, refdata has its own chunking method which 
     ## makes equal size chunks, instead of uneven chunks like in denovo
     if data.paramsdict["assembly_method"] != "reference":
-        ## get the number of clusters
+        ## get the clusters, each ending in a newline
         clustfile = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
-        with iter(gzip.open(clustfile, 'rb')) as clustio:
-            nloci = sum(1 for i in clustio if "//" in i) // 2
-            #tclust = clustio.read().count("//")//2
-            optim = (nloci//20) + (nloci%20)
-            LOGGER.info("optim for align chunks: %s", optim)
-
-        ## write optim clusters to each tmp file
-        clustio = gzip.open(clustfile, 'rb')
-        inclusts = iter(clustio.read().strip().split("//\n//\n"))
-        
-        ## splitting loci so first file is smaller and last file is bigger
-        inc = optim // 10
-        for idx in range(10):
-            ## how big is this chunk?
-            this = optim + (idx * inc)
-            left = nloci-this
-            if idx == 9:
-                ## grab everything left
-                grabchunk = list(itertools.islice(inclusts, int(1e9)))
-            else:
-                ## grab next chunks-worth of data
-                grabchunk = list(itertools.islice(inclusts, this))
-                nloci = left
-
-            ## write the chunk to file
+        with gzip.open(clustfile, 'rb') as clustio:
+            clusts = [i.strip()+"\n" for i in clustio.read().split("//\n//\n")]
+            clusts = [i for i in clusts if i.strip()]
+        costs = np.array([cluster_cost(i) for i in clusts], dtype=np.int64)
+
+        ## clusters that will be aligned go, largest first, to the chunk with
+        ## the least cost so far. The cheap ones are just dealt out in turn.
+        assign = np.arange(len(clusts)) % nchunks
+        loads = [(0, idx) for idx in xrange(nchunks)]
+        costly = np.where(costs > 1)[0]
+        for cidx in costly[np.argsort(costs[costly], kind="mergesort")[::-1]]:
+            load, idx = heapq.heappop(loads)
+            assign[cidx] = idx
+            heapq.heappush(loads, (load + costs[cidx], idx))
+        LOGGER.info("align chunk costs for %s: %s", sample.name, 
+                    np.bincount(assign, weights=costs, minlength=nchunks))
+
+        ## write the chunks to file
+        for idx in xrange(nchunks):
             tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_{}.ali".format(idx))
             with open(tmpfile, 'wb') as out:
-                out.write("//\n//\n".join(grabchunk))
-
-        ## write the chunk to file
-        #grabchunk = list(itertools.islice(inclusts, left))
-        #if grabchunk:
-        #    tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_9.ali")
-        #    with open(tmpfile, 'a') as out:
-        #        out.write("\n//\n//\n".join(grabchunk))
-        clustio.close()
+                out.write("//\n//\n".join([clusts[i] for i in np.where(assign == idx)[0]]))
+        del clusts
 
 
 
@@ -1326,7 +1845,7 @@ def reconcat(data, sample):
     try:
         ## get chunks
         chunks = glob.glob(os.path.join(data.tmpdir,
-                 sample.name+"_chunk_[0-9].aligned"))
+                 sample.name+"_chunk_[0-9]*.aligned"))
 
         ## sort by chunk number, cuts off last 8 =(aligned)
         chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-8]))
@@ -1334,8 +1853,12 @@ def reconcat(data, sample):
         ## concatenate finished reads
         sample.files.clusters = os.path.join(data.dirs.clusts,
                                              sample.name+".clustS.gz")
-        ## reconcats aligned clusters
-        with gzip.open(sample.files.clusters, 'wb') as out:
+        ## reconcats aligned clusters, and records their lengths and depths
+        stats = []
+        store = None
+        if data._hackersonly["clust_store"]:
+            store = StoreWriter(store_handle(sample.files.clusters))
+        with bgzopen(data, sample.files.clusters) as out:
             for fname in chunks:
                 with open(fname) as infile:
                     dat = infile.read()
@@ -1344,7 +1867,17 @@ def reconcat(data, sample):
                         out.write(dat+"//\n//\n")
                     else:
                         out.write(dat+"\n//\n//\n")
+                    for clust in dat.split("//\n//\n"):
+                        clen = clust_depths(clust)
+                        if clen:
+                            stats.append(clen)
+                            if store:
+                                store.add(clust)
                 os.remove(fname)
+        ## the store is closed last so it is never older than the clustS file
+        if store:
+            store.close()
+        save_depths(sample, stats)
     except Exception as inst:
         LOGGER.error("Error in reconcat {}".format(inst))
         raise
@@ -14,13 +14,17 @@ import itertools
 import datetime
 import pandas as pd
 import numpy as np
+import numba
 import time
 import gzip
 import glob
 import io
 import os
 from ipyrad.assemble.jointestimate import recal_hidepth
-from util import TRANSFULL, progressbar, IPyradError, IPyradWarningExit, clustdealer, PRIORITY, MINOR
+from ipyrad.assemble.clust_store import has_store, store_handle, \
+                                        iter_clusters, iter_text
+from util import TRANSFULL, progressbar, IPyradWarningExit, clustdealer, PRIORITY, MINOR
+from util import site_counts
 
 from collections import Counter
 
@@ -35,7 +39,8 @@ with warnings.catch_warnings():
 
 def get_binom(base1, base2, estE, estH):
     """
-    return probability of base call
+    return (ishet, probability) of base call. base1 and base2 can be 
+    ints or arrays of allele depths, see binom_table().
     """
         
     prior_homo = (1. - estH) / 2.
@@ -47,28 +52,25 @@ def get_binom(base1, base2, estE, estH):
     homoa = scipy.stats.binom.pmf(base2, bsum, estE)
     homob = scipy.stats.binom.pmf(base1, bsum, estE)
     
-    ## calculate probs
+    ## weight by priors
     hetprob *= prior_hete
     homoa *= prior_homo
     homob *= prior_homo
     
     ## final 
-    probabilities = [homoa, homob, hetprob]
-    bestprob = max(probabilities)/float(sum(probabilities))
-
-    ## return
-    if hetprob > homoa:
-        return True, bestprob
-    else:
-        return False, bestprob
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bestprob = np.maximum(np.maximum(homoa, homob), hetprob) / \
+                   (homoa + homob + hetprob)
+    return hetprob > homoa, bestprob
 
 
 
-def removerepeats(consens, arrayed):
+def removerepeats(consens, arrayed, reps):
     """
     Checks for interior Ns in consensus seqs and removes those that are at
     low depth, here defined as less than 1/3 of the average depth. The prop 1/3
     is chosen so that mindepth=6 requires 2 base calls that are not in [N,-].
+    arrayed holds the unique reads of the cluster, each with reps copies.
     """
 
     ## default trim no edges
@@ -129,11 +131,11 @@ def removerepeats(consens, arrayed):
         arrayed = arr1
 
     ## get column counts of Ns and -s
-    ndepths = np.sum(arrayed == 'N', axis=0)
-    idepths = np.sum(arrayed == '-', axis=0)
+    ndepths = np.sum((arrayed == 'N') * reps[:, None], axis=0)
+    idepths = np.sum((arrayed == '-') * reps[:, None], axis=0)
 
     ## get proportion of bases that are N- at each site
-    nons = ((ndepths + idepths) / float(arrayed.shape[0])) >= 0.75
+    nons = ((ndepths + idepths) / float(reps.sum())) >= 0.75
     ## boolean of whether base was called N
     isn = consens == "N"
     ## make ridx
@@ -157,13 +159,17 @@ def newconsensus(data, sample, tmpchunk, optim):
     ## temporarily store the mean estimates to Assembly
     data._este = data.stats.error_est.mean()
     data._esth = data.stats.hetero_est.mean()
+    bintable, cached = get_binom_table(data._este, data._esth)
 
     ## get number relative to tmp file
     tmpnum = int(tmpchunk.split(".")[-1])
 
-    ## prepare data for reading
-    clusters = open(tmpchunk, 'rb')
-    pairdealer = itertools.izip(*[iter(clusters)]*2)    
+    ## prepare data for reading. With a cluster store there is no tmp file,
+    ## the chunk is the optim clusters starting at tmpnum.
+    if has_store(sample):
+        clusters = iter_clusters(sample, tmpnum, tmpnum+optim)
+    else:
+        clusters = iter_text(tmpchunk)
     maxlen = data._hackersonly["max_fragment_length"]
 
     ## write to tmp cons to file to be combined later
@@ -191,7 +197,9 @@ def newconsensus(data, sample, tmpchunk, optim):
     counters = {"name" : tmpnum,
                 "heteros": 0,
                 "nsites" : 0,
-                "nconsens" : 0}
+                "nconsens" : 0,
+                "binom_hits" : int(cached),
+                "binom_misses" : int(not cached)}
 
     ## store data for what got filtered
     filters = {"depth" : 0,
@@ -210,112 +218,88 @@ def newconsensus(data, sample, tmpchunk, optim):
         maxn = data.paramsdict["max_Ns_consens"][0]
 
     ## load the refmap dictionary if refmapping
-    done = 0
-    while not done:
-        try:
-            done, chunk = clustdealer(pairdealer, 1)
-        except IndexError:
-            raise IPyradError("clustfile formatting error in %s", chunk)
-
-        if chunk:
-            ## get names and seqs
-            piece = chunk[0].strip().split("\n")
-            names = piece[0::2]
-            seqs = piece[1::2]
-
-            ## pull replicate read info from seqs
-            reps = [int(sname.split(";")[-2][5:]) for sname in names]
-
-            ## IF this is a reference mapped read store the chrom and pos info
-            ## -1 defaults to indicating an anonymous locus, since we are using
-            ## the faidict as 0 indexed. If chrompos fails it defaults to -1
-            ref_position = (-1, 0, 0)
-            if isref:
-                try:
-                    ## parse position from name string
-                    name, _, _ = names[0].rsplit(";", 2)
-                    chrom, pos0, pos1 = name.rsplit(":", 2)
-                    
-                    ## pull idx from .fai reference dict 
-                    chromint = faidict[chrom] + 1
-                    ref_position = (int(chromint), int(pos0), int(pos1))
-                    
-                except Exception as inst:
-                    LOGGER.debug("Reference sequence chrom/pos failed for {}".format(names[0]))
-                    LOGGER.debug(inst)
-                    
-            ## apply read depth filter
-            if nfilter1(data, reps):
-
-                ## get stacks of base counts
-                sseqs = [list(seq) for seq in seqs]
-                arrayed = np.concatenate(
-                    [[seq]*rep for seq, rep in zip(sseqs, reps)])
-                arrayed = arrayed[:, :maxlen]
+    for names, reps, seqs in clusters:
+        ## IF this is a reference mapped read store the chrom and pos info
+        ## -1 defaults to indicating an anonymous locus, since we are using
+        ## the faidict as 0 indexed. If chrompos fails it defaults to -1
+        ref_position = (-1, 0, 0)
+        if isref:
+            try:
+                ## parse position from name string
+                name, _, _ = names[0].rsplit(";", 2)
+                chrom, pos0, pos1 = name.rsplit(":", 2)
                 
-                ## get consens call for each site, applies paralog-x-site filter
-                #consens = np.apply_along_axis(basecall, 0, arrayed, data)
-                consens = basecaller(
-                    arrayed, 
-                    data.paramsdict["mindepth_majrule"], 
-                    data.paramsdict["mindepth_statistical"],
-                    data._esth, 
-                    data._este,
-                    )
-
-                ## apply a filter to remove low coverage sites/Ns that
-                ## are likely sequence repeat errors. This is only applied to
-                ## clusters that already passed the read-depth filter (1)
-                if "N" in consens:
-                    try:
-                        consens, arrayed = removerepeats(consens, arrayed)
-
-                    except ValueError as _:
-                        LOGGER.info("Caught a bad chunk w/ all Ns. Skip it.")
-                        continue
-
-                ## get hetero sites
-                hidx = [i for (i, j) in enumerate(consens) \
-                            if j in list("RKSYWM")]
-                nheteros = len(hidx)
+                ## pull idx from .fai reference dict 
+                chromint = faidict[chrom] + 1
+                ref_position = (int(chromint), int(pos0), int(pos1))
                 
-                ## filter for max number of hetero sites
-                if nfilter2(nheteros, maxhet):
-                    ## filter for maxN, & minlen
-                    if nfilter3(consens, maxn):
-                        ## counter right now
-                        current = counters["nconsens"]
-                        ## get N alleles and get lower case in consens
-                        consens, nhaps = nfilter4(consens, hidx, arrayed)
-                        ## store the number of alleles observed
-                        nallel[current] = nhaps
-
-                        ## store a reduced array with only CATG
-                        catg = np.array(\
-                            [np.sum(arrayed == i, axis=0)  \
-                            for i in list("CATG")],
-                            dtype='uint32').T
-                        catarr[current, :catg.shape[0], :] = catg
-                        refarr[current] = ref_position
-
-                        ## store the seqdata for tmpchunk
-                        storeseq[counters["name"]] = "".join(list(consens))
-                        counters["name"] += 1
-                        counters["nconsens"] += 1
-                        counters["heteros"] += nheteros
-                    else:
-                        #LOGGER.debug("@haplo")
-                        filters['maxn'] += 1
-                else:
-                    #LOGGER.debug("@hetero")
-                    filters['maxh'] += 1
-            else:
-                #LOGGER.debug("@depth")
-                filters['depth'] += 1
+            except Exception as inst:
+                LOGGER.debug("Reference sequence chrom/pos failed for {}".format(names[0]))
+                LOGGER.debug(inst)
                 
-    ## close infile io
-    clusters.close()
+        ## apply read depth filter
+        if nfilter1(data, reps):
+
+            ## get stacks of base counts from the unique reads and their reps
+            arrayed = seqs[:, :maxlen]
+            
+            ## get consens call for each site, applies paralog-x-site filter
+            #consens = np.apply_along_axis(basecall, 0, arrayed, data)
+            consens = basecaller(
+                arrayed, 
+                reps,
+                data.paramsdict["mindepth_majrule"], 
+                data.paramsdict["mindepth_statistical"],
+                bintable,
+                )
+
+            ## apply a filter to remove low coverage sites/Ns that
+            ## are likely sequence repeat errors. This is only applied to
+            ## clusters that already passed the read-depth filter (1)
+            if "N" in consens:
+                try:
+                    consens, arrayed = removerepeats(consens, arrayed, reps)
+
+                except ValueError as _:
+                    LOGGER.info("Caught a bad chunk w/ all Ns. Skip it.")
+                    continue
 
+            ## get hetero sites
+            hidx = [i for (i, j) in enumerate(consens) \
+                        if j in list("RKSYWM")]
+            nheteros = len(hidx)
+            
+            ## filter for max number of hetero sites
+            if nfilter2(nheteros, maxhet):
+                ## filter for maxN, & minlen
+                if nfilter3(consens, maxn):
+                    ## counter right now
+                    current = counters["nconsens"]
+                    ## get N alleles and get lower case in consens
+                    consens, nhaps = nfilter4(consens, hidx, arrayed, reps)
+                    ## store the number of alleles observed
+                    nallel[current] = nhaps
+
+                    ## store a reduced array with only CATG
+                    catg = site_counts(arrayed, reps)[:, :4].astype(np.uint32)
+                    catarr[current, :catg.shape[0], :] = catg
+                    refarr[current] = ref_position
+
+                    ## store the seqdata for tmpchunk
+                    storeseq[counters["name"]] = "".join(list(consens))
+                    counters["name"] += 1
+                    counters["nconsens"] += 1
+                    counters["heteros"] += nheteros
+                else:
+                    #LOGGER.debug("@haplo")
+                    filters['maxn'] += 1
+            else:
+                #LOGGER.debug("@hetero")
+                filters['maxh'] += 1
+        else:
+            #LOGGER.debug("@depth")
+            filters['depth'] += 1
+            
     ## write final consens string chunk
     if storeseq:
         with open(consenshandle, 'wb') as outfile:
@@ -338,55 +322,112 @@ def newconsensus(data, sample, tmpchunk, optim):
 
 
 
-def basecaller(arrayed, mindepth_majrule, mindepth_statistical, estH, estE):
+## index of each byte as an allele in nbasecaller, in the order of their
+## byte values so ties go to the lowest byte. N and - are not alleles (-1).
+CALLBYTES = np.array([ord(i) for i in "ACGTn"], dtype=np.uint8)
+CALLINDEX = np.zeros(256, dtype=np.int64) - 1
+CALLINDEX[CALLBYTES] = np.arange(CALLBYTES.shape[0])
+
+## max depth of the two alleles in a binomial base call
+MAXBINOM = 500
+
+## binom_tables that were built on this engine, keyed by (estE, estH)
+BINOMTABLES = {}
+MAXBINOMTABLES = 4
+
+
+
+def get_binom_table(estE, estH):
+    """
+    Returns the binom_table() for these estimates, building it only if it is 
+    not already cached on this engine, and whether it was a cache hit. The 
+    table is read-only, use it for any base or genotype call from (base1, 
+    base2) depths up to MAXBINOM instead of calling get_binom().
+    """
+    key = (float(estE), float(estH))
+    if key in BINOMTABLES:
+        return BINOMTABLES[key], True
+
+    ## keep only a few tables (~2MB each) in a long lived engine
+    if len(BINOMTABLES) >= MAXBINOMTABLES:
+        BINOMTABLES.clear()
+    table = binom_table(*key)
+    for arr in table:
+        arr.flags.writeable = False
+    BINOMTABLES[key] = table
+    return table, False
+
+
+
+def binom_table(estE, estH):
+    """
+    Precomputes get_binom() for all pairs of allele depths (base1, base2) 
+    up to MAXBINOM. Returns arrays of (ishet, prob) of shape 
+    (MAXBINOM+1, MAXBINOM+1).
+    """
+    base1, base2 = np.mgrid[0:MAXBINOM+1, 0:MAXBINOM+1]
+    return get_binom(base1, base2, estE, estH)
+
+
+
+def basecaller(arrayed, reps, mindepth_majrule, mindepth_statistical, bintable):
     """
-    call all sites in a locus array.
+    call all sites in a locus array of unique reads, each with reps copies,
+    using the binom_table() of the sample's H and E estimates.
     """
+    cons = nbasecaller(arrayed.view(np.uint8), reps.astype(np.int64), 
+                       mindepth_majrule, mindepth_statistical, 
+                       bintable[0], bintable[1], CALLINDEX, CALLBYTES, 
+                       TRANSARR)
+    return cons.view("S1")
+
+
 
+@numba.jit(nopython=True)
+def nbasecaller(arr, reps, mindepth_majrule, mindepth_statistical, 
+                ishets, probs, callindex, callbytes, transarr):
+    """
+    JIT'd basecaller. Counts the alleles at each site from the unique reads
+    weighted by their reps, and calls the two most common by majority rule 
+    or, if deep enough, by the precomputed binomial test.
+    """
     ## an array to fill with consensus site calls
-    cons = np.zeros(arrayed.shape[1], dtype=np.uint8)
+    cons = np.zeros(arr.shape[1], dtype=np.uint8)
     cons.fill(78)
-    arr = arrayed.view(np.uint8)
-    
+    counts = np.zeros(callbytes.shape[0], dtype=np.int64)
+
     ## iterate over columns
     for col in xrange(arr.shape[1]):
-        ## the site of focus
-        carr = arr[:, col]
-        
-        ## make mask of N and - sites
-        mask = carr == 45
-        mask += carr == 78        
-        marr = carr[~mask]
-        
+        ## allele counts at the site of focus, without N and - sites
+        counts[:] = 0
+        for row in xrange(arr.shape[0]):
+            aidx = callindex[arr[row, col]]
+            if aidx >= 0:
+                counts[aidx] += reps[row]
+
+        ## get allele freqs (first-most, second = p, q)
+        pidx = np.argmax(counts)
+        nump = counts[pidx]
+        counts[pidx] = 0
+        qidx = np.argmax(counts)
+        numq = counts[qidx]
+        pbase = callbytes[pidx]
+        qbase = callbytes[qidx]
+
         ## skip if only empties (e.g., N-)
-        if not marr.shape[0]:
+        if not nump:
             cons[col] = 78
-        
-        ## skip if not variable
-        elif np.all(marr == marr[0]):
-            cons[col] = marr[0]
-        
-        ## estimate variable site call
-        else:
-            ## get allele freqs (first-most, second, third = p, q, r)
-            counts = np.bincount(marr)
-            
-            pbase = np.argmax(counts)
-            nump = counts[pbase]
-            counts[pbase] = 0
 
-            qbase = np.argmax(counts)
-            numq = counts[qbase]
-            counts[qbase] = 0
+        ## skip if not variable
+        elif not numq:
+            cons[col] = pbase
 
-            rbase = np.argmax(counts)
-            numr = counts[rbase]
-            
-            ## based on biallelic depth
+        ## estimate variable site call based on biallelic depth
+        else:
             bidepth = nump + numq 
             if bidepth < mindepth_majrule:
                 cons[col] = 78
-            
+
             else:
                 ## if depth is too high, reduce to sampled int
                 if bidepth > 500:
@@ -398,24 +439,22 @@ def basecaller(arrayed, mindepth_majrule, mindepth_statistical, estH, estE):
 
                 ## make statistical base call  
                 if bidepth >= mindepth_statistical:
-                    ishet, prob = get_binom(base1, base2, estE, estH)
-                    #LOGGER.info("ishet, prob, b1, b2: %s %s %s %s", ishet, prob, base1, base2)
-                    if prob < 0.95:
+                    if probs[base1, base2] < 0.95:
                         cons[col] = 78
                     else:
-                        if ishet:
-                            cons[col] = TRANS[(pbase, qbase)]
+                        if ishets[base1, base2]:
+                            cons[col] = transarr[pbase, qbase]
                         else:
                             cons[col] = pbase
-                
+
                 ## make majrule base call
                 else: #if bidepth >= mindepth_majrule:
                     if nump == numq:
-                        cons[col] = TRANS[(pbase, qbase)]
+                        cons[col] = transarr[pbase, qbase]
                     else:
                         cons[col] = pbase
-    return cons.view("S1")
-            
+    return cons
+
 
 
 TRANS = {
@@ -433,6 +472,11 @@ TRANS = {
          (65, 71): 82,
          }
 
+## TRANS as an array, N for pairs that have no ambiguity code
+TRANSARR = np.zeros((256, 256), dtype=np.uint8) + 78
+for (_base1, _base2), _code in TRANS.items():
+    TRANSARR[_base1, _base2] = _code
+
 
 
 def nfilter1(data, reps):
@@ -467,8 +511,11 @@ def nfilter3(consens, maxn):
 
 
 
-def nfilter4(consens, hidx, arrayed):
-    """ applies max haplotypes filter returns pass and consens"""
+def nfilter4(consens, hidx, arrayed, reps):
+    """ 
+    applies max haplotypes filter returns pass and consens. arrayed holds
+    the unique reads of the cluster, each with reps copies.
+    """
 
     ## if less than two Hs then there is only one allele
     if len(hidx) < 2:
@@ -479,11 +526,14 @@ def nfilter4(consens, hidx, arrayed):
 
     ## remove any reads that have N or - base calls at hetero sites
     ## these cannot be used when calling alleles currently.
-    harray = harray[~np.any(harray == "-", axis=1)]
-    harray = harray[~np.any(harray == "N", axis=1)]
+    keep = ~np.any(harray == "-", axis=1) & ~np.any(harray == "N", axis=1)
+    harray = harray[keep]
+    hreps = reps[keep]
 
     ## get counts of each allele (e.g., AT:2, CG:2)
-    ccx = Counter([tuple(i) for i in harray])
+    ccx = Counter()
+    for hap, rep in itertools.izip(harray, hreps):
+        ccx[tuple(hap)] += rep
 
     ## Two possibilities we would like to distinguish, but we can't. Therefore,
     ## we just throw away low depth third alleles that are within seq. error.
@@ -494,7 +544,7 @@ def nfilter4(consens, hidx, arrayed):
     ## sequencing errors at hetero sites, making a third allele, or a new
     ## allelic combination that is not real.
     if len(ccx) > 2:
-        totdepth = harray.shape[0]
+        totdepth = hreps.sum()
         cutoff = max(1, totdepth // 10)
         alleles = [i for i in ccx if ccx[i] > cutoff]
     else:
@@ -611,6 +661,8 @@ def cleanup(data, sample, statsdicts):
     xfilters = {"depth": 0,
                "maxh": 0,
                "maxn": 0}
+    xbinom = {"binom_hits": 0, 
+              "binom_misses": 0}
 
     ## merge finished consens stats
     for counters, filters in statsdicts:
@@ -619,6 +671,10 @@ def cleanup(data, sample, statsdicts):
             xcounters[key] += counters[key]
         for key in xfilters:
             xfilters[key] += filters[key]
+        for key in xbinom:
+            xbinom[key] += counters.get(key, 0)
+    LOGGER.info("binom table cache for %s: %s hits, %s misses", 
+                sample.name, xbinom["binom_hits"], xbinom["binom_misses"])
 
     ## merge consens read files
     handle1 = os.path.join(data.dirs.consens, sample.name+".consens.gz")
@@ -665,13 +721,28 @@ def chunk_clusters(data, sample):
     ## set optim size for chunks in N clusters. The first few chunks take longer
     ## because they contain larger clusters, so we create 4X as many chunks as
     ## processors so that they are split more evenly.
-    optim = int((sample.stats.clusters_total // data.cpus) + \
-                (sample.stats.clusters_total % data.cpus))
+    ## A cluster store knows how many clusters it has, which need not match 
+    ## the stats (e.g., of a branched Assembly or an older JSON file).
+    instore = has_store(sample)
+    if instore:
+        with h5py.File(store_handle(sample.files.clusters), 'r') as io5:
+            nclusters = int(io5.attrs["nclusters"])
+    else:
+        nclusters = sample.stats.clusters_total
+    optim = max(1, int((nclusters // data.cpus) + (nclusters % data.cpus)))
 
     ## break up the file into smaller tmp files for each engine
     ## chunking by cluster is a bit trickier than chunking by N lines
     chunkslist = []
 
+    ## a cluster store is read in place by newconsensus, so no tmp files.
+    if instore:
+        for num in xrange(-(-nclusters // optim)):
+            chunkhandle = os.path.join(data.dirs.clusts,
+                                    "tmp_"+str(sample.name)+"."+str(num*optim))
+            chunkslist.append((optim, chunkhandle))
+        return chunkslist
+
     ## open to clusters
     with gzip.open(sample.files.clusters, 'rb') as clusters:
         ## create iterator to sample 2 lines at a time
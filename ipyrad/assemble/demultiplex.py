@@ -9,19 +9,20 @@ from __future__ import print_function
 # pylint: disable=C0301
 
 import os
-import io
 import gzip
 import glob
 import time
 import shutil
 import datetime
 import itertools
+import multiprocessing
 import cPickle as pickle
 import numpy as np
 import subprocess as sps
 from ipyrad.core.sample import Sample
 from ipyrad.assemble.util import *
 from collections import defaultdict, Counter
+from Queue import Full
 
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -158,6 +159,7 @@ def make_stats(data, perfile, fsamplehits, fbarhits, fmisses, fdbars):
 
 
     ## Link Sample with this data file to the Assembly object
+    cache = ReadCountCache()
     for sname in snames:
 
         ## make the sample
@@ -165,16 +167,7 @@ def make_stats(data, perfile, fsamplehits, fbarhits, fmisses, fdbars):
         sample.name = sname
 
         ## allow multiple barcodes if its a replicate. 
-        barcodes = []
-        for n in xrange(500):
-            fname = sname+"-technical-replicate-{}".format(n)
-            fbar = data.barcodes.get(fname)
-            if fbar:
-                barcodes.append(fbar)
-        if barcodes:
-            sample.barcode = barcodes
-        else:
-            sample.barcode = data.barcodes[sname]
+        sample.barcode = get_sample_barcode(data, sname)
 
         ## file names        
         if 'pair' in data.paramsdict["datatype"]:
@@ -194,8 +187,11 @@ def make_stats(data, perfile, fsamplehits, fbarhits, fmisses, fdbars):
         if sample.stats["reads_raw"]:
             sample.stats.state = 1
             data.samples[sample.name] = sample
+            for fastq in sample.files.fastqs[0]:
+                cache.set(fastq, sample.stats["reads_raw"])
         else:
             print("Excluded sample: no data found for", sname)
+    cache.save()
 
     ## initiate s1 key for data object
     data.stats_dfs.s1 = data._build_stat("s1")
@@ -203,6 +199,20 @@ def make_stats(data, perfile, fsamplehits, fbarhits, fmisses, fdbars):
 
 
 
+def get_sample_barcode(data, sname):
+    """ a sample's barcode, or list of barcodes if technical replicates """
+    barcodes = []
+    for n in xrange(500):
+        fname = sname+"-technical-replicate-{}".format(n)
+        fbar = data.barcodes.get(fname)
+        if fbar:
+            barcodes.append(fbar)
+    if barcodes:
+        return barcodes
+    return data.barcodes[sname]
+
+
+
 ## EXPERIMENTAL; not yet implemented
 def barmatch2(data, tups, cutters, longbar, matchdict, fnum):
     """
@@ -621,6 +631,407 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
 
 
 
+def get_block_iter(tups, blocksize=int(2**23), start=0, end=None):
+    """
+    returns a generator that yields lists of (array, newlines) tuples, one
+    for each read file, where array is a uint8 array of a large block of
+    complete fastq records and newlines is the index of every newline in it.
+    Files are read in lockstep so each block holds the same records in R1/R2.
+    If end is set only records [start, end) are read, from indexed files.
+    """
+
+    if tups[0].endswith(".gz"):
+        ofunc = gzip.open
+    else:
+        ofunc = open
+
+    ## open handles
+    paths = [i for i in tups[:2] if i]
+    if end is not None:
+        ofiles = [open_fastq_at(i, start) for i in paths]
+    else:
+        ofiles = [ofunc(i, 'rb') for i in paths]
+
+    ## make a generator
+    def feedme(ofiles):
+        lefts = [""] * len(ofiles)
+        eofs = [False] * len(ofiles)
+        remaining = end - start if end is not None else None
+        while remaining != 0:
+            ## top up each buffer to blocksize bytes
+            bufs = []
+            for idx, ofile in enumerate(ofiles):
+                need = blocksize - len(lefts[idx])
+                chunk = ""
+                if (need > 0) and (not eofs[idx]):
+                    chunk = ofile.read(need)
+                    if not chunk:
+                        eofs[idx] = True
+                buf = lefts[idx] + chunk
+                ## terminate a last record that is missing its newline
+                if eofs[idx] and buf and (not buf.endswith("\n")):
+                    buf += "\n"
+                bufs.append(buf)
+
+            ## only pass on complete records that are present in all files
+            arrs = [np.frombuffer(text, dtype=np.uint8) for text in bufs]
+            nls = [np.flatnonzero(arr == 10) for arr in arrs]
+            nrecs = min([nl.shape[0] // 4 for nl in nls])
+            if remaining is not None:
+                nrecs = min(nrecs, remaining)
+                remaining -= nrecs
+            if not nrecs:
+                ## a trailing partial record is dropped, as with izip
+                break
+
+            block = []
+            for idx in xrange(len(ofiles)):
+                cut = nls[idx][4 * nrecs - 1] + 1
+                block.append((arrs[idx][:cut], nls[idx][:4 * nrecs]))
+                lefts[idx] = bufs[idx][cut:]
+            yield block
+
+        for ofile in ofiles:
+            ofile.close()
+
+    return feedme(ofiles)
+
+
+
+def get_barcode_table(matchdict, snames):
+    """
+    Encodes every barcode in matchdict as an int64 (3 bits per base behind a
+    leading 1 so that barcodes of different lengths cannot collide) and
+    returns the barcodes, their sorted keys, and the index of their sample
+    in snames, all in key order. Barcodes with bases other than CATGN can
+    never be matched by a read and are left out.
+    """
+    sidx = {sname: idx for idx, sname in enumerate(snames)}
+    table = []
+    for barcode, sname in matchdict.iteritems():
+        if set(barcode).issubset(BASECODES_STR):
+            key = 1
+            for base in barcode:
+                key = (key * 8) + BASECODES[ord(base)]
+            table.append((key, barcode, sidx[sname]))
+    table.sort()
+
+    keys = np.array([i[0] for i in table], dtype=np.int64)
+    bars = [i[1] for i in table]
+    bsamp = np.array([i[2] for i in table], dtype=np.int64)
+    return bars, keys, bsamp
+
+
+
+def find_block_bcodes(arr, sstart, slen, cutters, longbar):
+    """
+    Vectorized findbcode() for a block of reads. Returns the length of the
+    barcode preceding the last occurrence of a cutter within the search
+    window of each read, or, like findbcode, the length of the whole search
+    window if no cutter was found.
+    """
+    blen = np.zeros(sstart.shape[0], dtype=np.int64)
+    found = np.zeros(sstart.shape[0], dtype=np.bool)
+
+    for cutter in cutters[0]:
+        ## If the cutter is unambiguous there will only be one.
+        if not cutter:
+            continue
+        lcut = len(cutter)
+        cut = np.frombuffer(cutter, dtype=np.uint8)
+        window = np.minimum(slen, longbar[0] + lcut + 1)
+
+        ## search from the right end so the last occurrence wins, as rsplit
+        for pos in xrange(longbar[0] + 1, -1, -1):
+            rows = np.flatnonzero((~found) & (pos + lcut <= window))
+            if not rows.shape[0]:
+                continue
+            wins = arr[sstart[rows][:, None] + pos + np.arange(lcut)]
+            hits = rows[np.all(wins == cut, axis=1)]
+            found[hits] = True
+            blen[hits] = pos
+
+        ## No cutter found (yet), barcode is the whole search window
+        blen[~found] = window[~found]
+    return blen
+
+
+
+def scatter_block(arr, segs, rsamp, nsamples):
+    """
+    Gathers the records of a block into one byte string per sample index in
+    a single fancy-indexing pass. segs is a list of (starts, ends) arrays of
+    the byte ranges to keep from each record, and rsamp the sample index of
+    each record. Records keep their input order within samples.
+    """
+    if not rsamp.shape[0]:
+        return [""] * nsamples
+
+    ## stable sort of records by sample, keeping segments of a record together
+    order = np.argsort(rsamp, kind="mergesort")
+    starts = np.column_stack([i[0][order] for i in segs]).ravel()
+    lens = np.column_stack([(i[1] - i[0])[order] for i in segs]).ravel()
+
+    ## index of every kept byte in output order
+    offs = np.cumsum(lens) - lens
+    idx = np.repeat(starts - offs, lens) + np.arange(offs[-1] + lens[-1])
+    out = arr[idx].tostring()
+
+    ## split into samples
+    rlens = np.sum([i[1] - i[0] for i in segs], axis=0)
+    nbytes = np.bincount(rsamp, weights=rlens, minlength=nsamples).astype(np.int64)
+    ends = np.cumsum(nbytes)
+    return [out[end - nbyte:end] for nbyte, end in zip(nbytes, ends)]
+
+
+
+## called by demux2()
+def barmatch_block(data, tups, cutters, longbar, matchdict, fnum):
+    """
+    Vectorized version of barmatch(). Reads are loaded in large blocks into
+    numpy byte arrays, the barcode window of every read in a block is found
+    and encoded as an integer at once, resolved against an integer table of
+    the (mismatch-expanded) matchdict, and matched reads are trimmed and
+    sorted into per-sample strings in bulk. Writes the same tmp files and
+    stats pickle as barmatch(), and does not support 3rad.
+    """
+    LOGGER.debug("Doing chunk %s", tups[0])
+    blocks = get_block_iter(tups)
+    return match_blocks(data, blocks, cutters, longbar, matchdict, fnum)
+
+
+
+## called by demux_stream()
+def barmatch_stream(data, block, cutters, longbar, matchdict, fnum, tparams=None):
+    """
+    Matches a single block of records that was read by the client and sent
+    to this engine. Instead of writing tmp files the sorted reads are
+    returned to the client, which passes them on to the writer processes,
+    as a list of (sname, kind, R1, R2) items. If tparams then the reads of
+    each sample are also trimmed here with the step 2 native trimmer, and
+    the step 2 counters of each sample are returned too.
+    """
+    filestat, samplestats, chunks = match_blocks(
+        data, [block], cutters, longbar, matchdict, fnum, True)
+
+    items = []
+    trimstats = {}
+    for sname, chunk in chunks.iteritems():
+        if (not tparams) or data._hackersonly["fused_keep_demuxed"]:
+            items.append((sname, "fastqs", chunk[0], chunk[1]))
+        if tparams:
+            edits, trimstats[sname] = trim_sorted(chunk, tparams[sname])
+            items.append((sname, "edits", edits[0], edits[1]))
+    return filestat, samplestats, items, trimstats
+
+
+
+def trim_sorted(chunk, params):
+    """
+    Trims the sorted (R1, R2) reads of one sample in a block with the step 2
+    native trimmer. Returns the trimmed (R1, R2) and the counters.
+    """
+    from .rawedit import native_trim_block
+
+    block = []
+    for reads in chunk[:2 if params["ispair"] else 1]:
+        arr = np.frombuffer(reads, dtype=np.uint8)
+        block.append((arr, np.flatnonzero(arr == 10)))
+    outs, counts = native_trim_block(block, params)
+    return (outs + [""])[:2], counts
+
+
+
+def get_stream_trim_params(data, snames):
+    """
+    Sets up step 2 for the fused step 1/2 mode and returns the native 
+    trimmer params of each sample, built from its barcode.
+    """
+    from .rawedit import setup_edits, get_trim_params
+
+    setup_edits(data)
+    ## single-end gbs adds to the extra adapters for each sample, keep them
+    extras = list(data._hackersonly["p3_adapters_extra"])
+    tparams = {}
+    for sname in snames:
+        sample = Sample(sname)
+        sample.barcode = get_sample_barcode(data, sname)
+        tparams[sname] = get_trim_params(data, sample)
+    data._hackersonly["p3_adapters_extra"] = extras
+    return tparams
+
+
+
+def match_blocks(data, blocks, cutters, longbar, matchdict, fnum, ship=False):
+    """
+    Sorts the reads in an iterable of blocks from get_block_iter() into
+    per-sample tmp files and pickles the stats. Used by barmatch_block()
+    and barmatch_stream(). If ship then nothing is written and the stats
+    are returned together with a dict of {sname: (R1, R2)} sorted reads.
+    """
+
+    ## how many reads to store before writing to disk
+    waitchunk = int(1e6)
+
+    ## pid name for this engine
+    epid = os.getpid()
+
+    ## counters for total reads, those with cutsite, and those that matched
+    filestat = np.zeros(3, dtype=np.int)
+
+    ## sample names in index order
+    snames = set()
+    for sname in data.barcodes:
+        if "-technical-replicate-" in sname:
+            sname = sname.rsplit("-technical-replicate", 1)[0]
+        snames.add(sname)
+    snames = sorted(snames)
+
+    ## same stat dicts as barmatch()
+    samplehits = {sname: 0 for sname in snames}
+    barhits = {barc: 0 for barc in matchdict}
+    misses = {'_': 0}
+    dbars = {sname: set() for sname in snames}
+    dsort1 = {sname: [] for sname in snames}
+    dsort2 = {sname: [] for sname in snames}
+
+    ## integer barcode table
+    bars, keys, bsamp = get_barcode_table(matchdict, snames)
+    if not keys.shape[0]:
+        keys = np.array([-1], dtype=np.int64)
+        bsamp = np.array([0], dtype=np.int64)
+        bars = [""]
+
+    ## barcode and trim settings
+    is2brad = data.paramsdict["datatype"] == '2brad'
+    ispair = 'pair' in data.paramsdict["datatype"]
+    maxbar = longbar[0]
+    lencut = len(cutters[0][0])
+
+    nsince = 0
+    for block in blocks:
+        arr, nls = block[0]
+        lstarts = np.concatenate([[0], nls[:-1] + 1])
+        nreads = nls.shape[0] // 4
+
+        ## record, seq-line, and qual-line bounds. Ends are the newlines.
+        rstart = lstarts[0::4]
+        rend = nls[3::4] + 1
+        sstart = lstarts[1::4]
+        send = nls[1::4]
+        qstart = lstarts[3::4]
+        qend = nls[3::4]
+        ## length of the seq line including its newline, as in barmatch
+        slen = send - sstart + 1
+
+        ## find start and length of the barcode in each read
+        if longbar[1] == 'same':
+            if is2brad:
+                avail = np.maximum(slen - (lencut + 1), 0)
+                blen = np.minimum(avail, maxbar)
+                bstart = sstart + avail - blen
+            else:
+                blen = np.minimum(slen, maxbar)
+                bstart = sstart
+        else:
+            blen = find_block_bcodes(arr, sstart, slen, cutters, longbar)
+            bstart = sstart
+
+        ## encode barcodes of all reads at once
+        bkey = np.ones(nreads, dtype=np.int64)
+        for pos in xrange(maxbar):
+            inbar = blen > pos
+            codes = BASECODES[arr[np.minimum(bstart + pos, arr.shape[0] - 1)]]
+            bkey[inbar] = (bkey[inbar] * 8) + codes[inbar]
+
+        ## find if it matches
+        tidx = np.searchsorted(keys, bkey)
+        tidx[tidx == keys.shape[0]] = 0
+        hit = (keys[tidx] == bkey) & (blen > 0) & (blen <= maxbar)
+        tidx = tidx[hit]
+        rsamp = bsamp[tidx]
+
+        ## record stats
+        nhit = int(hit.sum())
+        filestat[0] += nreads
+        filestat[1] += nhit + int(np.sum((~hit) & (blen > 0)))
+        filestat[2] += nhit
+        misses["_"] += nreads - nhit
+        scounts = np.bincount(rsamp, minlength=len(snames))
+        for sidx in np.flatnonzero(scounts):
+            samplehits[snames[sidx]] += int(scounts[sidx])
+        ## barcode hits are counted twice per read, as in barmatch
+        bcounts = np.bincount(tidx, minlength=keys.shape[0])
+        for bidx in np.flatnonzero(bcounts):
+            barhits[bars[bidx]] += 2 * int(bcounts[bidx])
+            dbars[snames[bsamp[bidx]]].add(bars[bidx])
+
+        ## trim off barcode; for 2brad we trim the barcode AND the synthetic
+        ## overhang from the end of the read
+        hlen = blen[hit]
+        if is2brad:
+            trim = lencut + hlen
+            segs = [(rstart[hit], np.maximum(send[hit] - trim, sstart[hit])),
+                    (send[hit], np.maximum(qend[hit] - trim, qstart[hit])),
+                    (qend[hit], rend[hit])]
+        else:
+            segs = [(rstart[hit], sstart[hit]),
+                    (np.minimum(sstart[hit] + hlen, send[hit] + 1), qstart[hit]),
+                    (np.minimum(qstart[hit] + hlen, qend[hit] + 1), rend[hit])]
+
+        ## append to dsort
+        for sname, chunk in zip(snames,
+                                scatter_block(arr, segs, rsamp, len(snames))):
+            if chunk:
+                dsort1[sname].append(chunk)
+        if ispair and (len(block) > 1):
+            arr2, nls2 = block[1]
+            rstart2 = np.concatenate([[0], nls2[3::4][:-1] + 1])
+            rend2 = nls2[3::4] + 1
+            segs2 = [(rstart2[hit], rend2[hit])]
+            for sname, chunk in zip(snames,
+                                    scatter_block(arr2, segs2, rsamp, len(snames))):
+                if chunk:
+                    dsort2[sname].append(chunk)
+
+        ## write out every waitchunk reads to keep memory low
+        nsince += nreads
+        if (nsince >= waitchunk) and (not ship):
+            writetofile(data, dsort1, 1, epid)
+            if ispair:
+                writetofile(data, dsort2, 2, epid)
+            for sname in snames:
+                dsort1[sname] = []
+                dsort2[sname] = []
+            nsince = 0
+
+    ## send reads and stats back for a single block. Zero barhits are
+    ## dropped since the full match dictionary can be quite large.
+    if ship:
+        barhits = {barc: hits for barc, hits in barhits.iteritems() if hits}
+        samplestats = [samplehits, barhits, misses, dbars]
+        chunks = {}
+        for sname in snames:
+            if dsort1[sname]:
+                chunks[sname] = ("".join(dsort1[sname]), "".join(dsort2[sname]))
+        return filestat, samplestats, chunks
+
+    ## write the remaining reads to file
+    writetofile(data, dsort1, 1, epid)
+    if ispair:
+        writetofile(data, dsort2, 2, epid)
+
+    ## return stats in saved pickle b/c return_queue is too small
+    ## and the size of the match dictionary can become quite large
+    samplestats = [samplehits, barhits, misses, dbars]
+    outname = os.path.join(data.dirs.fastqs, "tmp_{}_{}.p".format(epid, fnum))
+    with open(outname, 'w') as wout:
+        pickle.dump([filestat, samplestats], wout)
+
+    return outname
+
+
+
 def writetofastq(data, dsort, read):
     """ 
     Writes sorted data 'dsort dict' to a tmp files
@@ -685,56 +1096,23 @@ def collate_files(data, sname, tmp1s, tmp2s):
     """ 
     Collate temp fastq files in tmp-dir into 1 gzipped sample.
     """
-    ## out handle
-    out1 = os.path.join(data.dirs.fastqs, "{}_R1_.fastq.gz".format(sname))
-    out = io.BufferedWriter(gzip.open(out1, 'w'))
-
-    ## build cmd
-    cmd1 = ['cat']
-    for tmpfile in tmp1s:
-        cmd1 += [tmpfile]
-
-    ## compression function
-    proc = sps.Popen(['which', 'pigz'], stderr=sps.PIPE, stdout=sps.PIPE).communicate()
-    if proc[0].strip():
-        compress = ["pigz"]
-    else:
-        compress = ["gzip"]
-
-    ## call cmd
-    proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-    proc2 = sps.Popen(compress, stdin=proc1.stdout, stderr=sps.PIPE, stdout=out)
-    err = proc2.communicate()
-    if proc2.returncode:
-        raise IPyradWarningExit("error in collate_files R1 %s", err)
-    proc1.stdout.close()
-    out.close()
-
-    ## then cleanup
-    for tmpfile in tmp1s:
-        os.remove(tmpfile)
-
+    ## out handles and the tmp files that go into them
+    outs = [(os.path.join(data.dirs.fastqs, "{}_R1_.fastq.gz".format(sname)), 
+             tmp1s)]
     if 'pair' in data.paramsdict["datatype"]:
-        ## out handle
-        out2 = os.path.join(data.dirs.fastqs, "{}_R2_.fastq.gz".format(sname))
-        out = io.BufferedWriter(gzip.open(out2, 'w'))
-
-        ## build cmd
-        cmd1 = ['cat']
-        for tmpfile in tmp2s:
-            cmd1 += [tmpfile]
-
-        ## call cmd
-        proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-        proc2 = sps.Popen(compress, stdin=proc1.stdout, stderr=sps.PIPE, stdout=out)
-        err = proc2.communicate()
-        if proc2.returncode:
-            raise IPyradWarningExit("error in collate_files R2 %s", err)
-        proc1.stdout.close()
-        out.close()
+        outs.append(
+            (os.path.join(data.dirs.fastqs, "{}_R2_.fastq.gz".format(sname)), 
+             tmp2s))
+
+    ## concatenate and compress in parallel blocks
+    for outname, tmps in outs:
+        with bgzopen(data, outname, index=True) as out:
+            for tmpfile in tmps:
+                with open(tmpfile, 'rb') as infile:
+                    shutil.copyfileobj(infile, out, int(2**24))
 
         ## then cleanup
-        for tmpfile in tmp2s:
+        for tmpfile in tmps:
             os.remove(tmpfile)
 
 
@@ -912,31 +1290,50 @@ def estimate_optim(data, testfile, ipyclient):
     return inputreads
 
 
-def run2(data, ipyclient, force):
+def run2(data, ipyclient, force, fused=False):
     """
     One input file (or pair) is run on two processors, one for reading 
-    and decompressing the data, and the other for demuxing it.
+    and decompressing the data, and the other for demuxing it. If fused
+    then step 2 is done on the sorted reads too, if the data allow it. 
+    Returns whether step 2 was done.
     """
 
     ## get file handles, name-lens, cutters, and matchdict
     raws, longbar, cutters, matchdict = prechecks2(data, force)
 
+    ## the fused mode needs the streaming path
+    streamable = get_matchfunc(data, longbar) is barmatch_block
+    if fused and not streamable:
+        LOGGER.info("fused step 1/2 mode not supported for this data")
+        fused = False
+
     ## wrap funcs to ensure we can kill tmpfiles
     kbd = 0
     try:
-        ## if splitting files, split files into smaller chunks for demuxing
-        chunkfiles = splitfiles(data, raws, ipyclient)
+        ## stream blocks of reads straight to the engines and writers
+        if (data._hackersonly["demux_stream"] or fused) and streamable:
+            statdicts, trimstats = demux_stream(data, raws, cutters, longbar, 
+                                                matchdict, ipyclient, fused)
+
+        else:
+            ## if splitting files, split files into smaller chunks for demuxing
+            chunkfiles = splitfiles(data, raws, ipyclient)
 
-        ## send chunks to be demux'd
-        statdicts = demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient)
+            ## send chunks to be demux'd
+            statdicts = demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient)
 
-        ## concat tmp files
-        concat_chunks(data, ipyclient)
+            ## concat tmp files
+            concat_chunks(data, ipyclient)
 
         ## build stats from dictionaries
         perfile, fsamplehits, fbarhits, fmisses, fdbars = statdicts    
         make_stats(data, perfile, fsamplehits, fbarhits, fmisses, fdbars)
 
+        ## store step 2 results of the fused mode
+        if fused:
+            from .rawedit import store_fused_results
+            store_fused_results(data, trimstats)
+
 
     except KeyboardInterrupt:
         print("\n  ...interrupted, just a second while we ensure proper cleanup")
@@ -954,6 +1351,8 @@ def run2(data, ipyclient, force):
         else:
             _cleanup_and_die(data)
 
+    return fused
+
 
 def _cleanup_and_die(data):
     """ cleanup func for step 1 """
@@ -1270,6 +1669,211 @@ def demux3(data, raws, cutters, longbar, matchdict):
                      
 
 
+def get_matchfunc(data, longbar):
+    """ 
+    The vectorized block matcher handles all but 3rad data and barcodes too
+    long to be encoded as int64 keys, which use the per-read barmatch().
+    """
+    if ("3rad" in data.paramsdict["datatype"]) or (longbar[0] > 20):
+        return barmatch
+    return barmatch_block
+
+
+
+def demux_stream(data, raws, cutters, longbar, matchdict, ipyclient, fused=False):
+    """
+    Streaming alternative to splitfiles() + demux2() + concat_chunks(). The
+    client reads and decompresses each raw file (pair) once and sends blocks
+    of records directly to engines running barmatch_stream(), so matching
+    overlaps with decompression and no chunk files are written to disk. The
+    sorted reads come back to the client and are handed to writer processes
+    which own the gzipped sample files, so there are no tmp files to collate.
+    Blocks in flight and writer buffers are bounded by demux_max_memory.
+    If fused then the engines also do the step 2 filtering of the reads and
+    the writers write the edits files, so step 1 outputs are only written
+    if _hackersonly["fused_keep_demuxed"]. Returns the step 1 stats and the
+    step 2 counters of each sample (empty unless fused).
+    """
+
+    ## parallel stuff, limit to 1/4 of available cores for RAM limits.
+    start = time.time()
+    printstr = ' sorting reads         | {} | s1 |'
+    if fused:
+        printstr = ' sorting and trimming  | {} | s1 |'
+    targets = ipyclient.ids[::4]
+    lbview = ipyclient.load_balanced_view(targets=targets)
+
+    ## sample names
+    snames = set()
+    for sname in data.barcodes:
+        if "-technical-replicate-" in sname:
+            sname = sname.rsplit("-technical-replicate", 1)[0]
+        snames.add(sname)
+    snames = sorted(snames)
+    tparams = None
+    if fused:
+        tparams = get_stream_trim_params(data, snames)
+
+    ## split the memory ceiling (MB) between blocks held by the client 
+    ## (R1 and R2 of a block, and its sorted copy) and the writer buffers
+    blocksize = data._hackersonly["demux_stream_blocksize"]
+    ceiling = int(data._hackersonly["demux_max_memory"] * 1e6)
+    maxjobs = min(2 * len(targets), (ceiling // 2) // (4 * blocksize))
+    maxjobs = max(1, maxjobs)
+    bufsize = max(int(1e5), (ceiling // 2) // len(snames))
+
+    ## stats for each file and sample
+    perfile = {}
+    fdbars = {}
+    fsamplehits = Counter()
+    fbarhits = Counter()
+    fmisses = Counter()
+    statdicts = perfile, fsamplehits, fbarhits, fmisses, fdbars
+    trimstats = defaultdict(Counter)
+
+    ## store async results by block number
+    filesort = {}
+    total = 0
+    done = 0
+
+    ## start writers, each one owns the files of a subset of samples
+    nwriters = max(1, min(data._hackersonly["demux_writers"], len(snames)))
+    ispair = 'pair' in data.paramsdict["datatype"]
+    queues = []
+    writers = []
+    for _ in xrange(nwriters):
+        queue = multiprocessing.Queue(maxsize=4 * len(snames))
+        proc = multiprocessing.Process(target=writer, 
+            args=(data, queue, bufsize, ispair))
+        proc.start()
+        queues.append(queue)
+        writers.append(proc)
+    widx = {sname: idx % nwriters for idx, sname in enumerate(snames)}
+
+    def collect(filesort):
+        """ handle finished jobs and return how many finished """
+        fin = [i for i, j in filesort.items() if j[1].ready()]
+        for key in fin:
+            handle, async = filesort.pop(key)
+            if not async.successful():
+                raise IPyradWarningExit(async.exception())
+            filestats, samplestats, items, tstats = async.result()
+            mergestats(filestats, samplestats, handle, statdicts)
+            for sname, counts in tstats.iteritems():
+                trimstats[sname].update(counts)
+            for item in items:
+                putwriter(queues[widx[item[0]]], writers[widx[item[0]]], item)
+        return len(fin)
+
+    try:
+        ## read blocks and send them off, waiting when too many are in flight
+        for tups in raws:
+            handle = os.path.splitext(os.path.basename(tups[0]))[0]
+            perfile[handle] = np.zeros(3, dtype=np.int)
+            for block in get_block_iter(tups, blocksize):
+                args = (data, block, cutters, longbar, matchdict, total, tparams)
+                filesort[total] = (handle, lbview.apply(barmatch_stream, *args))
+                total += 1
+                while len(filesort) >= maxjobs:
+                    done += collect(filesort)
+                    elapsed = datetime.timedelta(seconds=int(time.time()-start))
+                    progressbar(total, done, printstr.format(elapsed), spacer=data._spacer)
+                    time.sleep(0.1)
+
+        ## wait for the remaining jobs to finish
+        while 1:
+            done += collect(filesort)
+            elapsed = datetime.timedelta(seconds=int(time.time()-start))
+            progressbar(total, done, printstr.format(elapsed), spacer=data._spacer)
+            if not filesort:
+                print("")
+                break
+            time.sleep(0.1)
+
+        ## tell writers to finish up and wait for them
+        for queue, proc in zip(queues, writers):
+            putwriter(queue, proc, None)
+        for proc in writers:
+            proc.join()
+            if proc.exitcode:
+                raise IPyradWarningExit(
+                    " demux writer process failed with code {}".format(proc.exitcode))
+
+    finally:
+        for proc in writers:
+            if proc.is_alive():
+                proc.terminate()
+
+    return statdicts, trimstats
+
+
+
+def writer(data, queue, bufsize, ispair):
+    """
+    Writer process for demux_stream(). Owns the gzipped fastq files of the 
+    samples sent to it. Batches of (sname, kind, R1, R2) records are buffered
+    per sample and kind ("fastqs" for step 1 or "edits" for step 2 files) and
+    written once a buffer holds bufsize bytes. R1 and R2 are always flushed 
+    together so pairs stay in order. None ends it.
+    """
+    outs = {}
+    bufs = {}
+    sizes = Counter()
+    names = {
+        "fastqs": (data.dirs.fastqs, "{}_R1_.fastq.gz", "{}_R2_.fastq.gz"),
+        "edits": (getattr(data.dirs, "edits", ""), 
+                  "{}.trimmed_R1_.fastq.gz", "{}.trimmed_R2_.fastq.gz"),
+        }
+
+    def flush(key):
+        """ write buffered reads of a sample and kind to its files """
+        if key not in outs:
+            odir, name1, name2 = names[key[1]]
+            outs[key] = [bgzopen(data, os.path.join(odir, 
+                         name1.format(key[0])), index=True)]
+            if ispair:
+                outs[key].append(bgzopen(data, os.path.join(odir, 
+                         name2.format(key[0])), index=True))
+        for out, buf in zip(outs[key], bufs[key]):
+            out.write("".join(buf))
+        bufs[key] = [[], []]
+        sizes[key] = 0
+
+    while 1:
+        item = queue.get()
+        if item is None:
+            break
+        sname, kind, chunk1, chunk2 = item
+        buf = bufs.setdefault((sname, kind), [[], []])
+        buf[0].append(chunk1)
+        buf[1].append(chunk2)
+        sizes[(sname, kind)] += len(chunk1) + len(chunk2)
+        if sizes[(sname, kind)] >= bufsize:
+            flush((sname, kind))
+
+    ## write what is left and close files
+    for key in bufs:
+        if sizes[key]:
+            flush(key)
+    for key in outs:
+        for out in outs[key]:
+            out.close()
+
+
+
+def putwriter(queue, proc, item):
+    """ put an item on a writer queue, but don't hang if the writer died """
+    while 1:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Full:
+            if not proc.is_alive():
+                raise IPyradWarningExit(
+                    " demux writer process died with code {}".format(proc.exitcode))
+
+
+
 def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
     """ 
     Submit chunks to be sorted by the barmatch() function then 
@@ -1281,6 +1885,8 @@ def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
     printstr = ' sorting reads         | {} | s1 |'
     lbview = ipyclient.load_balanced_view(targets=ipyclient.ids[::4])
 
+    matchfunc = get_matchfunc(data, longbar)
+
     ## store statcounters and async results in dicts
     perfile = {}
     filesort = {}
@@ -1297,7 +1903,7 @@ def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
             args = (data, rawtuple, cutters, longbar, matchdict, fidx)
 
             ## submit the job
-            async = lbview.apply(barmatch, *args)
+            async = lbview.apply(matchfunc, *args)
             filesort[total] = (handle, async)
             total += 1
 
@@ -1483,6 +2089,13 @@ def putstats(pfile, handle, statdicts):
     with open(pfile, 'r') as infile:
         filestats, samplestats = pickle.load(infile)
 
+    return mergestats(filestats, samplestats, handle, statdicts)
+
+
+
+def mergestats(filestats, samplestats, handle, statdicts):
+    """ adds the stats of one chunk or block to the statdicts """
+
     ## get dicts from statdicts tuple
     perfile, fsamplehits, fbarhits, fmisses, fdbars = statdicts
 
@@ -1495,7 +2108,9 @@ def putstats(pfile, handle, statdicts):
     fsamplehits.update(samplehits)
     fbarhits.update(barhits)
     fmisses.update(misses)
-    fdbars.update(dbars)
+    ## union of observed barcodes, chunks can see different subsets
+    for sname in dbars:
+        fdbars.setdefault(sname, set()).update(dbars[sname])
 
     ## repack the tuple and return
     statdicts = perfile, fsamplehits, fbarhits, fmisses, fdbars
@@ -1602,6 +2217,11 @@ def zcat_make_temps(data, raws, num, tmpdir, optim, njobs, start):
 
 
 ## GLOBALS
+## 3-bit codes used to encode barcodes as ints, all other characters are 7
+BASECODES_STR = "CATGN"
+BASECODES = np.zeros(256, dtype=np.int64) + 7
+BASECODES[[ord(i) for i in BASECODES_STR]] = np.arange(1, 6)
+
 NO_BARS = """\
     Barcodes file not found. You entered: '{}'
     """
@@ -5,17 +5,18 @@
 from __future__ import print_function
 
 import scipy.stats
+import scipy.special
 import scipy.optimize
 import numpy as np
 import numba
 import itertools
 import datetime
 import time
-import gzip
 import io
 import os
 
 from ipyrad.assemble.cluster_within import get_quick_depths
+from ipyrad.assemble.clust_store import iter_clusters
 
 from collections import Counter
 from util import *
@@ -28,6 +29,12 @@ from util import *
 
 
 
+## bounds of H and E for the optimizer. E close to 1 (every read is an error)
+## can fit better than the real error rate, so E is kept below 0.5.
+HEBOUNDS = (1e-9, 0.5)
+
+
+
 def likelihood1(errors, bfreqs, ustacks):
     """
     Probability homozygous. """
@@ -119,6 +126,171 @@ def nget_diploid_lik(pstart, bfreqs, ustacks, counts):
 
 
 
+def lik_terms(bfreqs, ustacks):
+    """
+    Precomputes the parts of the likelihood that don't depend on H or E, 
+    once per sample. For each stack and base (homozygous) or pair of bases 
+    (heterozygous), the likelihood is exp(a + k*log(p) + m*log(1-p)), with
+    p = E for homozygous and p = 2E/3 for heterozygous sites. Returns arrays
+    (a1, k1, m1) of shape (nstacks, 4) and (a2, k2, m2) of shape (nstacks, 6).
+    """
+    ustacks = ustacks.astype(np.float64)
+    tots = ustacks.sum(axis=1)[:, None]
+    lgam = scipy.special.gammaln
+    lchoose = lambda n, k: lgam(n + 1.) - lgam(k + 1.) - lgam(n - k + 1.)
+
+    with np.errstate(divide="ignore"):
+        ## homozygous: bfreq * binom.pmf(tot - u, tot, E)
+        a1 = np.log(bfreqs)[None, :] + lchoose(tots, ustacks)
+        k1 = tots - ustacks
+        m1 = ustacks
+
+        ## heterozygous: 2*bf[j]*bf[k] / four * binom.pmf(tot-uj-uk, tot, 0.5)
+        ##               * binom.pmf(uj, uj+uk, 2E/3)
+        jdx, kdx = np.array(list(itertools.combinations(range(4), 2))).T
+        one = np.log(2. * bfreqs[jdx] * bfreqs[kdx])
+        four = np.log(1. - np.sum(bfreqs**2))
+        upair = ustacks[:, jdx] + ustacks[:, kdx]
+        a2 = one[None, :] - four + lchoose(tots, tots - upair) + \
+             tots * np.log(0.5) + lchoose(upair, ustacks[:, jdx])
+        k2 = ustacks[:, jdx]
+        m2 = ustacks[:, kdx]
+    return a1, k1, m1, a2, k2, m2
+
+
+
+@numba.jit(nopython=True)
+def nlik_grad(hetero, errors, a1, k1, m1, a2, k2, m2, counts):
+    """
+    JIT'd negative log likelihood of [H,E] and its gradient, from the terms
+    of lik_terms(). Stacks with a likelihood of zero are skipped.
+    """
+    score = 0.
+    dhet = 0.
+    derr = 0.
+    lerr = np.log(errors)
+    lnerr = np.log(1. - errors)
+    perr = 2. * errors / 3.
+    lperr = np.log(perr)
+    lnperr = np.log(1. - perr)
+
+    for idx in xrange(a1.shape[0]):
+        ## homozygous likelihood and its derivative over E
+        lik1 = 0.
+        dlik1 = 0.
+        for bdx in xrange(4):
+            term = np.exp(a1[idx, bdx] + k1[idx, bdx] * lerr + \
+                          m1[idx, bdx] * lnerr)
+            lik1 += term
+            dlik1 += term * (k1[idx, bdx] / errors - \
+                             m1[idx, bdx] / (1. - errors))
+
+        ## heterozygous likelihood and its derivative over E
+        lik2 = 0.
+        dlik2 = 0.
+        if hetero > 0.:
+            for pdx in xrange(6):
+                term = np.exp(a2[idx, pdx] + k2[idx, pdx] * lperr + \
+                              m2[idx, pdx] * lnperr)
+                lik2 += term
+                dlik2 += term * (k2[idx, pdx] / perr - \
+                                 m2[idx, pdx] / (1. - perr)) * (2. / 3.)
+
+        lik = (1. - hetero) * lik1 + hetero * lik2
+        if lik > 0.:
+            score -= counts[idx] * np.log(lik)
+            dhet -= counts[idx] * (lik2 - lik1) / lik
+            derr -= counts[idx] * ((1. - hetero) * dlik1 + hetero * dlik2) / lik
+
+    return score, dhet, derr
+
+
+
+def get_diploid_lik_grad(pstart, terms, counts):
+    """ Log likelihood score and gradient given values [H,E] """
+    score, dhet, derr = nlik_grad(pstart[0], pstart[1], *(terms+(counts,)))
+    return score, np.array([dhet, derr])
+
+
+
+def get_haploid_lik_grad(pstart, terms, counts):
+    """ Log likelihood score and gradient given values [E] with H=0 """
+    score, _, derr = nlik_grad(0., pstart[0], *(terms+(counts,)))
+    return score, np.array([derr])
+
+
+
+@numba.jit(nopython=True, parallel=True)
+def nlik_grad_pooled(hets, errors, a1, k1, m1, a2, k2, m2, counts, offsets):
+    """
+    JIT'd negative log likelihood and gradient of a shared E and one H per
+    sample, for the terms of many samples stacked together, where sample i 
+    has rows offsets[i] to offsets[i+1]. Samples are run in parallel.
+    """
+    nsamples = offsets.shape[0] - 1
+    scores = np.zeros(nsamples)
+    dhets = np.zeros(nsamples)
+    derrs = np.zeros(nsamples)
+    for sidx in numba.prange(nsamples):
+        start = offsets[sidx]
+        end = offsets[sidx + 1]
+        score, dhet, derr = nlik_grad(
+            hets[sidx], errors, a1[start:end], k1[start:end], m1[start:end],
+            a2[start:end], k2[start:end], m2[start:end], counts[start:end])
+        scores[sidx] = score
+        dhets[sidx] = dhet
+        derrs[sidx] = derr
+    return scores.sum(), dhets, derrs.sum()
+
+
+
+def get_pooled_lik_grad(params, terms, counts, offsets, haploid):
+    """ 
+    Log likelihood score and gradient given [E, H1, H2, ...] for pooled 
+    samples, or [E] with all H=0 if haploid.
+    """
+    nsamples = offsets.shape[0] - 1
+    if haploid:
+        hets = np.zeros(nsamples)
+    else:
+        hets = params[1:]
+    score, dhets, derr = nlik_grad_pooled(
+        hets, params[0], *(terms+(counts, offsets)))
+    if haploid:
+        return score, np.array([derr])
+    return score, np.concatenate([[derr], dhets])
+
+
+
+def pooled_optim(tables, haploid=False):
+    """
+    Fits one error rate shared by samples and a heterozygosity for each, 
+    from the (bfreqs, ustacks, counts) of each sample. Returns an array of
+    H estimates, one per sample, and the E estimate.
+    """
+    ## stack the likelihood terms of all samples
+    terms = [lik_terms(bfreqs, ustacks) for bfreqs, ustacks, _ in tables]
+    terms = tuple(np.concatenate(i) for i in zip(*terms))
+    counts = np.concatenate([i[2] for i in tables])
+    offsets = np.concatenate([[0], np.cumsum([i[2].shape[0] for i in tables])])
+
+    ## start from the usual values
+    nsamples = len(tables)
+    pstart = np.array([0.001] + ([] if haploid else [0.01] * nsamples))
+    res = scipy.optimize.minimize(get_pooled_lik_grad, pstart,
+                                  (terms, counts, offsets, haploid),
+                                  method="L-BFGS-B",
+                                  jac=True,
+                                  bounds=[HEBOUNDS] * pstart.shape[0],
+                                  options={"maxiter": 200})
+    LOGGER.info("pooled H/E estimate of %s samples: %s evaluations, %s", 
+                nsamples, res.nfev, res.message)
+    if haploid:
+        return np.zeros(nsamples), res.x[0]
+    return res.x[1:], res.x[0]
+
+
+
 def get_haploid_lik(errors, bfreqs, ustacks, counts):
     """ Log likelihood score given values [E]. """
     hetero = 0.
@@ -156,7 +328,7 @@ def recal_hidepth(data, sample):
     ## if old value not the same as current value then recalc
     if 1: #not sample.stats_dfs.s3["hidepth_min"] == majrdepth:
         LOGGER.info(" mindepth setting changed: recalculating clusters_hidepth and maxlen")
-        ## get arrays of data
+        ## get arrays of data, read from the depths file written in step 3
         maxlens, depths = get_quick_depths(data, sample)
 
         ## calculate how many are hidepth
@@ -195,10 +367,6 @@ def stackarray(data, sample):
     ## only use clusters with depth > mindepth_statistical for param estimates
     sample, _, _, nhidepth, maxlen = recal_hidepth(data, sample)
 
-    ## get clusters file    
-    clusters = gzip.open(sample.files.clusters)
-    pairdealer = itertools.izip(*[iter(clusters)]*2)
-
     ## we subsample, else use first 10000 loci.
     dims = (nhidepth, maxlen, 4)
     stacked = np.zeros(dims, dtype=np.uint64)
@@ -212,60 +380,74 @@ def stackarray(data, sample):
         pass
     #LOGGER.info("cutlens: %s", cutlens)
 
-    ## fill stacked
+    ## fill stacked, from the cluster store if there is one, else clustS.gz
     nclust = 0
-    done = 0
-    while not done:
-        try:
-            done, chunk = clustdealer(pairdealer, 1)
-        except IndexError:
-            raise IPyradError("  clustfile formatting error in %s", chunk)
-
-        if chunk:
-            piece = chunk[0].strip().split("\n")
-            names = piece[0::2]
-            seqs = piece[1::2]
-            ## pull replicate read info from seqs
-            reps = [int(sname.split(";")[-2][5:]) for sname in names]
-            
-            ## double reps if the read was fully merged... (TODO: Test this!)
-            #merged = ["_m1;s" in sname for sname in names]
-            #if any(merged):
-            #    reps = [i*2 if j else i for i, j in zip(reps, merged)]
-
-            ## get all reps
-            sseqs = [list(seq) for seq in seqs]
-            arrayed = np.concatenate(
-                          [[seq]*rep for seq, rep in zip(sseqs, reps)])
-            
-            ## enforce minimum depth for estimates
-            if arrayed.shape[0] >= data.paramsdict["mindepth_statistical"]:
-                ## remove edge columns and select only the first 500 
-                ## derep reads, just like in step 5
-                arrayed = arrayed[:500, cutlens[0]:cutlens[1]]
-                ## remove cols that are pair separator
-                arrayed = arrayed[:, ~np.any(arrayed == "n", axis=0)]
-                ## remove cols that are all Ns after converting -s to Ns
-                arrayed[arrayed == "-"] = "N"
-                arrayed = arrayed[:, ~np.all(arrayed == "N", axis=0)]
-                ## store in stacked dict
-
-                catg = np.array(\
-                    [np.sum(arrayed == i, axis=0) for i in list("CATG")], 
-                    dtype=np.uint64).T
-
-                stacked[nclust, :catg.shape[0], :] = catg
-                nclust += 1
+    for _, reps, seqs in iter_clusters(sample):
+        ## double reps if the read was fully merged... (TODO: Test this!)
+        #merged = ["_m1;s" in sname for sname in names]
+        #if any(merged):
+        #    reps = [i*2 if j else i for i, j in zip(reps, merged)]
+
+        ## enforce minimum depth for estimates
+        if reps.sum() >= data.paramsdict["mindepth_statistical"]:
+            ## remove edge columns and select only the first 500 
+            ## derep reads, just like in step 5, by capping the weights
+            reps = np.minimum(reps, np.maximum(0, 500 - (reps.cumsum() - reps)))
+            counts = site_counts(seqs[:, cutlens[0]:cutlens[1]], reps)
+            ## remove cols that are pair separator
+            keep = counts[:, SITECODES.index("n")] == 0
+            ## remove cols that are all Ns or -s
+            keep &= counts[:, :4].sum(axis=1) + counts[:, len(SITECODES)] > 0
+            ## store in stacked dict
+            catg = counts[keep, :4].astype(np.uint64)
+
+            stacked[nclust, :catg.shape[0], :] = catg
+            nclust += 1
 
     ## drop the empty rows in case there are fewer loci than the size of array
     newstack = stacked[stacked.sum(axis=2) > 0]
     assert not np.any(newstack.sum(axis=1) == 0), "no zero rows"
-    clusters.close()
 
     return newstack
 
 
 
+def get_stack_table(data, sample):
+    """ 
+    Stacks the clusters of a sample and compresses them into unique site 
+    patterns. Returns (bfreqs, ustacks, counts): base frequencies, unique 
+    stacks (CATG counts), and the number of sites with each pattern.
+    """
+    ## get array of all clusters data
+    stacked = stackarray(data, sample)
+
+    ## get base frequencies
+    bfreqs = stacked.sum(axis=0) / float(stacked.sum())
+    #bfreqs = bfreqs**2
+    #LOGGER.debug(bfreqs)
+    if np.isnan(bfreqs).any():
+        raise IPyradWarningExit(" Bad stack in getfreqs; {} {}"\
+               .format(sample.name, bfreqs))
+
+    ## put into array, count array items as Byte strings
+    tstack = Counter([j.tostring() for j in stacked])
+
+    ## get keys back as arrays and store vals as separate arrays
+    ustacks = np.array([np.fromstring(i, dtype=np.uint64) \
+                        for i in tstack.iterkeys()])
+
+    ## make bi-allelic only
+    #tris = np.where(np.sum(ustacks > 0, axis=1) > 2)
+    #for tri in tris:
+    #    minv = np.min(ustacks[tri][ustacks[tri] > 0])
+    #    delv = np.where(ustacks[tri] == minv)[0][0]
+    #    ustacks[tri, delv] = 0
+
+    counts = np.array(tstack.values(), dtype=np.float64)
+    return bfreqs, ustacks, counts
+
+
+
 def optim(data, sample):
     """ func scipy optimize to find best parameters"""
 
@@ -277,54 +459,36 @@ def optim(data, sample):
     success = False
 
     try:
-        ## get array of all clusters data
-        stacked = stackarray(data, sample)
-
-        ## get base frequencies
-        bfreqs = stacked.sum(axis=0) / float(stacked.sum())
-        #bfreqs = bfreqs**2
-        #LOGGER.debug(bfreqs)
-        if np.isnan(bfreqs).any():
-            raise IPyradWarningExit(" Bad stack in getfreqs; {} {}"\
-                   .format(sample.name, bfreqs))
-
-        ## put into array, count array items as Byte strings
-        tstack = Counter([j.tostring() for j in stacked])
-
-        ## get keys back as arrays and store vals as separate arrays
-        ustacks = np.array([np.fromstring(i, dtype=np.uint64) \
-                            for i in tstack.iterkeys()])
-
-        ## make bi-allelic only
-        #tris = np.where(np.sum(ustacks > 0, axis=1) > 2)
-        #for tri in tris:
-        #    minv = np.min(ustacks[tri][ustacks[tri] > 0])
-        #    delv = np.where(ustacks[tri] == minv)[0][0]
-        #    ustacks[tri, delv] = 0
-
-        counts = np.array(tstack.values())
-        ## cleanup
-        del tstack
+        ## get unique site patterns and their counts
+        bfreqs, ustacks, counts = get_stack_table(data, sample)
+
+        ## terms of the likelihood that don't change during optimization
+        terms = lik_terms(bfreqs, ustacks)
+        bounds = [HEBOUNDS]
 
         ## if data are haploid fix H to 0
         if int(data.paramsdict["max_alleles_consens"]) == 1:
             pstart = np.array([0.001], dtype=np.float64)
             hetero = 0.
-            errors = scipy.optimize.fmin(get_haploid_lik, pstart,
-                                         (bfreqs, ustacks, counts),
-                                         maxfun=50,
-                                         maxiter=50,
-                                         disp=False,
-                                         full_output=False)
+            res = scipy.optimize.minimize(get_haploid_lik_grad, pstart,
+                                          (terms, counts),
+                                          method="L-BFGS-B",
+                                          jac=True,
+                                          bounds=bounds,
+                                          options={"maxiter": 50})
+            errors = res.x[0]
         ## or do joint diploid estimates
         else:
             pstart = np.array([0.01, 0.001], dtype=np.float64)
-            hetero, errors = scipy.optimize.fmin(nget_diploid_lik, pstart,
-                                                (bfreqs, ustacks, counts),
-                                                maxfun=50,
-                                                maxiter=50,
-                                                disp=False,
-                                                full_output=False)
+            res = scipy.optimize.minimize(get_diploid_lik_grad, pstart,
+                                          (terms, counts),
+                                          method="L-BFGS-B",
+                                          jac=True,
+                                          bounds=bounds*2,
+                                          options={"maxiter": 50})
+            hetero, errors = res.x
+        LOGGER.info("%s H/E estimate: %s evaluations, %s", sample.name, 
+                    res.nfev, res.message)
         success = True
 
     except IPyradError as inst:
@@ -339,6 +503,119 @@ def optim(data, sample):
 
 
 
+def pooled_stack_table(data, sample):
+    """ 
+    get_stack_table() for the pooled estimate, returns None if the sample 
+    has no clusters with depth sufficient for statistical basecalling.
+    """
+    try:
+        return get_stack_table(data, sample)
+    except IPyradError:
+        LOGGER.debug("Found sample with no clusters hidepth - %s", sample.name)
+        return None
+
+
+
+def get_pooled_groups(data, samples):
+    """ 
+    Groups of samples that share an error rate in the pooled estimate. All 
+    samples if _hackersonly["pooled_estimate"] is True, or one group per 
+    population if it is "populations", plus one for samples in none.
+    """
+    if data._hackersonly["pooled_estimate"] != "populations":
+        return {"all": samples}
+
+    if not data.populations:
+        raise IPyradWarningExit("""
+    pooled_estimate "populations" requires populations. Link them first with
+    data._link_populations(popdict).""")
+    groups = {}
+    for pop, (_, names) in data.populations.iteritems():
+        group = [i for i in samples if i.name in names]
+        if group:
+            groups[pop] = group
+    grouped = set(i.name for group in groups.values() for i in group)
+    ungrouped = [i for i in samples if i.name not in grouped]
+    if ungrouped:
+        groups["unassigned"] = ungrouped
+    return groups
+
+
+
+def submit_pooled(data, subsamples, ipyclient):
+    """
+    Pooled alternative to submit(). The site pattern tables of the samples
+    are built in parallel, then each group of samples gets one error rate
+    and a heterozygosity for each sample, fit jointly.
+    """
+    lbview = ipyclient.load_balanced_view()
+    haploid = int(data.paramsdict["max_alleles_consens"]) == 1
+    groups = get_pooled_groups(data, subsamples)
+
+    ## build the tables, sorted by cluster size like submit()
+    subsamples.sort(key=lambda x: x.stats.clusters_hidepth, reverse=True)
+    jobs = {}
+    for sample in subsamples:
+        jobs[sample.name] = lbview.apply(pooled_stack_table, *(data, sample))
+
+    start = time.time() 
+    printstr = " inferring [H, E]      | {} | s4 |"
+    try:
+        kbd = 0
+        ## wait for the tables, then fit each group when it has its tables
+        fits = {}
+        while 1:
+            for group, gsamples in groups.iteritems():
+                if (group not in fits) and \
+                    all([jobs[i.name].ready() for i in gsamples]):
+                    for sample in gsamples:
+                        if not jobs[sample.name].successful():
+                            LOGGER.error("  Sample %s failed with error %s", 
+                                sample.name, jobs[sample.name].exception())
+                            raise IPyradWarningExit(jobs[sample.name].result())
+                    tables = [jobs[i.name].result() for i in gsamples]
+                    fitted = [i for i, j in zip(gsamples, tables) if j]
+                    tables = [i for i in tables if i]
+                    async = None
+                    if tables:
+                        async = lbview.apply(pooled_optim, *(tables, haploid))
+                    fits[group] = (fitted, async)
+
+            fin = [i.ready() for i in jobs.values()]
+            fin += [(i[1] is None) or i[1].ready() for i in fits.values()]
+            fin += [False] * (len(groups) - len(fits))
+            elapsed = datetime.timedelta(seconds=int(time.time() - start))
+            progressbar(len(fin), sum(fin), printstr.format(elapsed), spacer=data._spacer)
+            time.sleep(0.1)
+            if len(fin) == sum(fin):
+                print("")
+                break
+
+        ## cleanup, samples without tables get default values
+        for group, (fitted, async) in fits.iteritems():
+            if async and not async.successful():
+                LOGGER.error("  Pooled estimate of %s failed with error %s", 
+                             group, async.exception())
+                raise IPyradWarningExit(async.result())
+            if async:
+                hests, eest = async.result()
+                LOGGER.info("pooled estimate %s: E=%s", group, eest)
+                for sample, hest in zip(fitted, hests):
+                    sample_cleanup(data.samples[sample.name], hest, eest, True)
+            for sample in groups[group]:
+                if sample not in fitted:
+                    sample_cleanup(data.samples[sample.name], 0.01, 0.001, False)
+
+    except KeyboardInterrupt as kbd:
+        pass
+
+    finally:
+        assembly_cleanup(data)
+        if kbd:
+            raise KeyboardInterrupt
+
+
+
 def run(data, samples, force, ipyclient):
     """ calls the main functions """
 
@@ -370,8 +647,11 @@ def run(data, samples, force, ipyclient):
                 subsamples.append(sample)
 
     if subsamples:
-        ## submit jobs to parallel client
-        submit(data, subsamples, ipyclient)
+        ## submit jobs to parallel client, pooled estimates if set
+        if data._hackersonly["pooled_estimate"]:
+            submit_pooled(data, subsamples, ipyclient)
+        else:
+            submit(data, subsamples, ipyclient)
 
 
 
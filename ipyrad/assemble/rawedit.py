@@ -14,10 +14,14 @@ from __future__ import print_function
 
 import os
 import io
+import re
+import json
 import time
 import datetime
 import numpy as np
+from collections import Counter
 from .util import *
+from .demultiplex import get_block_iter, scatter_block
 
 try:
     import subprocess32 as sps
@@ -30,6 +34,9 @@ LOGGER = logging.getLogger(__name__)
 ## shortcut name for os.path.join
 OPJ = os.path.join
 
+## what the cutadapt on this engine supports, see cutadapt_has_json()
+CUTADAPT_INFO = {}
+
 
 
 
@@ -46,71 +53,46 @@ def assembly_cleanup(data):
 
 
 
-def parse_single_results(data, sample, res1):
-    """ parse results from cutadapt into sample data"""
-
-    ## set default values 
-    #sample.stats_dfs.s2["reads_raw"] = 0
-    sample.stats_dfs.s2["trim_adapter_bp_read1"] = 0
-    sample.stats_dfs.s2["trim_quality_bp_read1"] = 0
-    sample.stats_dfs.s2["reads_filtered_by_Ns"] = 0
-    sample.stats_dfs.s2["reads_filtered_by_minlen"] = 0
-    sample.stats_dfs.s2["reads_passed_filter"] = 0
+def parse_single_report(res1):
+    """ parse counters from a cutadapt report for single reads """
 
     ## parse new values from cutadapt results output
+    counters = {}
     lines = res1.strip().split("\n")
     for line in lines:
 
         if "Total reads processed:" in line:
             value = int(line.split()[3].replace(",", ""))
-            sample.stats_dfs.s2["reads_raw"] = value
+            counters["reads_raw"] = value
 
         if "Reads with adapters:" in line:
             value = int(line.split()[3].replace(",", ""))
-            sample.stats_dfs.s2["trim_adapter_bp_read1"] = value
+            counters["trim_adapter_bp_read1"] = value
 
         if "Quality-trimmed" in line:
             value = int(line.split()[1].replace(",", ""))
-            sample.stats_dfs.s2["trim_quality_bp_read1"] = value
+            counters["trim_quality_bp_read1"] = value
 
         if "Reads that were too short" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_minlen"] = value
+            counters["reads_filtered_by_minlen"] = value
 
         if "Reads with too many N" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_Ns"] = value
+            counters["reads_filtered_by_Ns"] = value
    
         if "Reads written (passing filters):" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["reads_passed_filter"] = value
+            counters["reads_passed_filter"] = value
 
-    ## save to stats summary
-    if sample.stats_dfs.s2.reads_passed_filter:
-        sample.stats.state = 2
-        sample.stats.reads_passed_filter = sample.stats_dfs.s2.reads_passed_filter
-        sample.files.edits = [
-            (OPJ(data.dirs.edits, sample.name+".trimmed_R1_.fastq.gz"), 0)]
-        ## write the long form output to the log file.
-        LOGGER.info(res1)
-
-    else:
-        print("{}No reads passed filtering in Sample: {}".format(data._spacer, sample.name))
+    return counters
 
 
 
-def parse_pair_results(data, sample, res):
-    """ parse results from cutadapt for paired data"""
-    LOGGER.info("in parse pair mod results\n%s", res)   
-    ## set default values
-    sample.stats_dfs.s2["trim_adapter_bp_read1"] = 0
-    sample.stats_dfs.s2["trim_adapter_bp_read2"] = 0    
-    sample.stats_dfs.s2["trim_quality_bp_read1"] = 0
-    sample.stats_dfs.s2["trim_quality_bp_read2"] = 0    
-    sample.stats_dfs.s2["reads_filtered_by_Ns"] = 0
-    sample.stats_dfs.s2["reads_filtered_by_minlen"] = 0
-    sample.stats_dfs.s2["reads_passed_filter"] = 0
+def parse_pair_report(res):
+    """ parse counters from a cutadapt report for paired data"""
 
+    counters = {}
     lines = res.strip().split("\n")
     qprimed = 0
     for line in lines:
@@ -122,61 +104,162 @@ def parse_pair_results(data, sample, res):
         if "Read 1:" in line:
             if qprimed:
                 value = int(line.split()[2].replace(",", ""))
-                sample.stats_dfs.s2["trim_quality_bp_read1"] = value
+                counters["trim_quality_bp_read1"] = value
 
         if "Read 2:" in line:
             if qprimed:
                 value = int(line.split()[2].replace(",", ""))
-                sample.stats_dfs.s2["trim_quality_bp_read2"] = value
+                counters["trim_quality_bp_read2"] = value
                 qprimed = 0
 
         if "Read 1 with adapter:" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["trim_adapter_bp_read1"] = value
+            counters["trim_adapter_bp_read1"] = value
 
         if "Read 2 with adapter:" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["trim_adapter_bp_read2"] = value
+            counters["trim_adapter_bp_read2"] = value
 
         if "Total read pairs processed:" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["reads_raw"] = value
+            counters["reads_raw"] = value
 
         if "Pairs that were too short" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_minlen"] = value
+            counters["reads_filtered_by_minlen"] = value
 
         if "Pairs with too many N" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_Ns"] = value
+            counters["reads_filtered_by_Ns"] = value
 
         if "Pairs written (passing filters):" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["reads_passed_filter"] = value
+            counters["reads_passed_filter"] = value
+
+    return counters
+
+
+
+def parse_json_report(report):
+    """ parse counters from a cutadapt JSON report (cutadapt >= 3.5) """
+
+    reads = report["read_counts"]
+    bps = report["basepair_counts"]
+    return {"reads_raw": reads["input"],
+            "trim_adapter_bp_read1": reads["read1_with_adapter"] or 0,
+            "trim_adapter_bp_read2": reads["read2_with_adapter"] or 0,
+            "trim_quality_bp_read1": bps["quality_trimmed_read1"] or 0,
+            "trim_quality_bp_read2": bps["quality_trimmed_read2"] or 0,
+            "reads_filtered_by_Ns": reads["filtered"]["too_many_n"] or 0,
+            "reads_filtered_by_minlen": reads["filtered"]["too_short"] or 0,
+            "reads_passed_filter": reads["output"]}
+
+
+
+def cutadapt_has_json():
+    """ 
+    whether the cutadapt on this engine writes JSON reports (>= 3.5). 
+    Checked once per engine process.
+    """
+    if "json" not in CUTADAPT_INFO:
+        try:
+            out = sps.check_output(["cutadapt", "--version"], stderr=sps.STDOUT)
+            version = tuple(int(i) for i in re.findall(r"\d+", out)[:2])
+        except (OSError, sps.CalledProcessError, ValueError):
+            version = ()
+        CUTADAPT_INFO["json"] = version >= (3, 5)
+    return CUTADAPT_INFO["json"]
+
+
+
+def get_cutadapt_json(data, sample, chunk=None):
+    """ JSON report file for a cutadapt run, or "" if not supported """
+    if not cutadapt_has_json():
+        return ""
+    return get_trim_outfiles(data, sample, chunk)[0]\
+           .replace(".fastq.gz", ".cutadapt.json")
+
+
+
+def get_cutadapt_counters(res, jsonfile, ispair):
+    """
+    Returns the counters of a cutadapt run from its JSON report if it wrote
+    one, else parsed from its text report, which is only logged here.
+    """
+    LOGGER.info(res)
+    if jsonfile and os.path.exists(jsonfile):
+        with open(jsonfile, 'r') as infile:
+            counters = parse_json_report(json.load(infile))
+        os.remove(jsonfile)
+        return counters
+    if ispair:
+        return parse_pair_report(res)
+    return parse_single_report(res)
+
+
+
+def store_trim_results(data, sample, counters):
+    """ store summed step 2 counters into sample data """
+
+    for key in ["reads_raw", 
+                "trim_adapter_bp_read1",
+                "trim_adapter_bp_read2",
+                "trim_quality_bp_read1",
+                "trim_quality_bp_read2",
+                "reads_filtered_by_Ns",
+                "reads_filtered_by_minlen",
+                "reads_passed_filter"]:
+        sample.stats_dfs.s2[key] = counters.get(key, 0)
 
     ## save to stats summary
     if sample.stats_dfs.s2.reads_passed_filter:
         sample.stats.state = 2
         sample.stats.reads_passed_filter = sample.stats_dfs.s2.reads_passed_filter
-        sample.files.edits = [(
-             OPJ(data.dirs.edits, sample.name+".trimmed_R1_.fastq.gz"), 
-             OPJ(data.dirs.edits, sample.name+".trimmed_R2_.fastq.gz")
-             )]
-
+        edits = get_trim_outfiles(data, sample) + [0]
+        sample.files.edits = [tuple(edits[:2])]
     else:
-        print("No reads passed filtering in Sample: {}".format(sample.name))
+        print("{}No reads passed filtering in Sample: {}"\
+              .format(data._spacer, sample.name))
 
 
 
-def cutadaptit_single(data, sample):
-    """ 
-    Applies quality and adapter filters to reads using cutadapt. If the ipyrad
-    filter param is set to 0 then it only filters to hard trim edges and uses
-    mintrimlen. If filter=1, we add quality filters. If filter=2 we add
-    adapter filters. 
+def get_trim_outfiles(data, sample, chunk=None):
+    """ trimmed output file(s) of a sample, or of one chunk of it """
+    suffix = ".fastq.gz"
+    if chunk:
+        suffix = ".chunk{}.fastq.gz".format(chunk[0])
+    outfiles = [OPJ(data.dirs.edits, sample.name+".trimmed_R1_"+suffix)]
+    if "pair" in data.paramsdict["datatype"]:
+        outfiles.append(OPJ(data.dirs.edits, sample.name+".trimmed_R2_"+suffix))
+    return outfiles
+
+
+
+def get_trim_chunks(data, sample):
     """
+    Returns the read ranges [(idx, start, end), ...] to trim a sample in, or
+    [None] to trim it whole. Samples with more than trim_chunk_size reads 
+    are split if their inputs have a fastq index.
+    """
+    chunksize = int(data._hackersonly["trim_chunk_size"])
+    counts = [fastq_index_count(i) for i in sample.files.concat[0][:2] if i]
+    if (not chunksize) or (None in counts) or (len(set(counts)) > 1):
+        return [None]
+    if counts[0] <= chunksize:
+        return [None]
 
-    sname = sample.name
+    nchunks = int(np.ceil(counts[0] / float(chunksize)))
+    bounds = np.linspace(0, counts[0], nchunks + 1).astype(np.int64)
+    return [(idx, int(bounds[idx]), int(bounds[idx + 1])) \
+            for idx in xrange(nchunks)]
+
+
+
+def get_adapter_single(data, sample):
+    """
+    Returns the 3' adapter to search for in single-end reads. For gbs data
+    with barcodes this also adds the incomplete adapter to p3_adapters_extra.
+    """
     ## if (GBS, ddRAD) we look for the second cut site + adapter. For single-end
     ## data we don't bother trying to remove the second barcode since it's not
     ## as critical as with PE data.
@@ -209,6 +292,22 @@ def cutadaptit_single(data, sample):
                 fullcomp(data.paramsdict["restriction_overhang"][1])[::-1] \
               + data._hackersonly["p3_adapter"]
 
+    return adapter
+
+
+
+def cutadaptit_single(data, sample, chunk=None):
+    """ 
+    Applies quality and adapter filters to reads using cutadapt. If the ipyrad
+    filter param is set to 0 then it only filters to hard trim edges and uses
+    mintrimlen. If filter=1, we add quality filters. If filter=2 we add
+    adapter filters. If chunk is set, only its read range is streamed to
+    cutadapt and written to chunk output files.
+    """
+
+    sname = sample.name
+    adapter = get_adapter_single(data, sample)
+
     ## get length trim parameter from new or older version of ipyrad params
     trim5r1 = trim3r1 = []
     if data.paramsdict.get("trim_reads"):
@@ -225,6 +324,14 @@ def cutadaptit_single(data, sample):
         trimlen = data.paramsdict.get("edit_cutsites")
         trim5r1 = ["--cut", str(trimlen[0])]
 
+    ## cutadapt reads a chunk from a pipe and writes plain text to a pipe 
+    ## that we compress in parallel
+    finput_r1 = sample.files.concat[0][0]
+    if chunk:
+        infifos, ihandle = fifo_feed([finput_r1], chunk[1], chunk[2])
+        finput_r1 = infifos[0]
+    fifos, fhandle = fifo_compress(data, get_trim_outfiles(data, sample, chunk))
+
     ## testing new 'trim_reads' setting
     cmdf1 = ["cutadapt"]
     if trim5r1:
@@ -234,8 +341,13 @@ def cutadaptit_single(data, sample):
     cmdf1 += ["--minimum-length", str(data.paramsdict["filter_min_trim_len"]),
               "--max-n", str(data.paramsdict["max_low_qual_bases"]),
               "--trim-n", 
-              "--output", OPJ(data.dirs.edits, sname+".trimmed_R1_.fastq.gz"),
-              sample.files.concat[0][0]]
+              "--output", fifos[0],
+              finput_r1]
+
+    ## ask for a structured report if this cutadapt can write one
+    jsonfile = get_cutadapt_json(data, sample, chunk)
+    if jsonfile:
+        cmdf1[1:1] = ["--json", jsonfile]
 
     if int(data.paramsdict["filter_adapters"]):
         ## NEW: only quality trim the 3' end for SE data.
@@ -258,41 +370,34 @@ def cutadaptit_single(data, sample):
 
     ## do modifications to read1 and write to tmp file
     LOGGER.info(cmdf1)
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
     try:
+        proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
         res1 = proc1.communicate()[0]
     except KeyboardInterrupt:
         proc1.kill()
         raise KeyboardInterrupt
+    finally:
+        fifo_finish(fifos, fhandle)
+        if chunk:
+            fifo_finish(infifos, ihandle)
 
     ## raise errors if found
     if proc1.returncode:
+        if jsonfile and os.path.exists(jsonfile):
+            os.remove(jsonfile)
         raise IPyradWarningExit(" error in {}\n {}".format(" ".join(cmdf1), res1))
 
-    ## return result string to be parsed outside of engine
-    return res1
+    LOGGER.debug("Exiting cutadaptit_single - {}".format(sname))
+    ## return counters, so the report string never leaves the engine
+    return get_cutadapt_counters(res1, jsonfile, False)
 
 
 
-## BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
-def cutadaptit_pairs(data, sample):
+def get_adapters_pairs(data, sample):
     """
-    Applies trim & filters to pairs, including adapter detection. If we have
-    barcode information then we use it to trim reversecut+bcode+adapter from 
-    reverse read, if not then we have to apply a more general cut to make sure 
-    we remove the barcode, this uses wildcards and so will have more false 
-    positives that trim a little extra from the ends of reads. Should we add
-    a warning about this when filter_adapters=2 and no barcodes?
+    Returns the (R1, R2) adapters to search for in paired reads, including
+    the revcomp cut site and barcode when barcode info is available.
     """
-    LOGGER.debug("Entering cutadaptit_pairs - {}".format(sample.name))
-    sname = sample.name
-
-    ## applied to read pairs
-    #trim_r1 = str(data.paramsdict["edit_cutsites"][0])
-    #trim_r2 = str(data.paramsdict["edit_cutsites"][1])
-    finput_r1 = sample.files.concat[0][0]
-    finput_r2 = sample.files.concat[0][1]
-
     ## Get adapter sequences. This is very important. For the forward adapter
     ## we don't care all that much about getting the sequence just before the 
     ## Illumina adapter, b/c it will either be random (in RAD), or the reverse
@@ -356,6 +461,31 @@ def cutadaptit_pairs(data, sample):
         adapter1 = data._hackersonly["p3_adapter"]
         adapter2 = fullcomp(data._hackersonly["p5_adapter"])
 
+    return adapter1, adapter2
+
+
+
+## BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
+def cutadaptit_pairs(data, sample, chunk=None):
+    """
+    Applies trim & filters to pairs, including adapter detection. If we have
+    barcode information then we use it to trim reversecut+bcode+adapter from 
+    reverse read, if not then we have to apply a more general cut to make sure 
+    we remove the barcode, this uses wildcards and so will have more false 
+    positives that trim a little extra from the ends of reads. Should we add
+    a warning about this when filter_adapters=2 and no barcodes? If chunk is
+    set, only its read range is streamed to cutadapt.
+    """
+    LOGGER.debug("Entering cutadaptit_pairs - {}".format(sample.name))
+    sname = sample.name
+
+    ## applied to read pairs
+    #trim_r1 = str(data.paramsdict["edit_cutsites"][0])
+    #trim_r2 = str(data.paramsdict["edit_cutsites"][1])
+    finput_r1 = sample.files.concat[0][0]
+    finput_r2 = sample.files.concat[0][1]
+
+    adapter1, adapter2 = get_adapters_pairs(data, sample)
 
     ## parse trim_reads
     trim5r1 = trim5r2 = trim3r1 = trim3r2 = []
@@ -399,14 +529,26 @@ def cutadaptit_pairs(data, sample):
     if trim3r2:
         cmdf1 += trim3r2
 
+    ## cutadapt reads a chunk from pipes and writes plain text to pipes 
+    ## that we compress in parallel
+    if chunk:
+        infifos, ihandle = fifo_feed([finput_r1, finput_r2], chunk[1], chunk[2])
+        finput_r1, finput_r2 = infifos
+    fifos, fhandle = fifo_compress(data, get_trim_outfiles(data, sample, chunk))
+
     cmdf1 += ["--trim-n",
               "--max-n", str(data.paramsdict["max_low_qual_bases"]),
               "--minimum-length", str(data.paramsdict["filter_min_trim_len"]),
-              "-o", OPJ(data.dirs.edits, sname+".trimmed_R1_.fastq.gz"),
-              "-p", OPJ(data.dirs.edits, sname+".trimmed_R2_.fastq.gz"),
+              "-o", fifos[0],
+              "-p", fifos[1],
               finput_r1,
               finput_r2]
 
+    ## ask for a structured report if this cutadapt can write one
+    jsonfile = get_cutadapt_json(data, sample, chunk)
+    if jsonfile:
+        cmdf1[1:1] = ["--json", jsonfile]
+
     ## additional args
     if int(data.paramsdict["filter_adapters"]) < 2:
         ## add a dummy adapter to let cutadapt know whe are not using legacy-mode
@@ -455,23 +597,293 @@ def cutadaptit_pairs(data, sample):
         proc1.kill()
         LOGGER.info("this is where I want it to interrupt")
         raise KeyboardInterrupt()
+    finally:
+        fifo_finish(fifos, fhandle)
+        if chunk:
+            fifo_finish(infifos, ihandle)
 
     ## raise errors if found
     if proc1.returncode:
+        if jsonfile and os.path.exists(jsonfile):
+            os.remove(jsonfile)
         raise IPyradWarningExit(" error [returncode={}]: {}\n{}"\
             .format(proc1.returncode, " ".join(cmdf1), res1))
 
     LOGGER.debug("Exiting cutadaptit_pairs - {}".format(sname))
-    ## return results string to be parsed outside of engine
-    return res1
+    ## return counters, so the report string never leaves the engine
+    return get_cutadapt_counters(res1, jsonfile, True)
 
 
 
-def run2(data, samples, force, ipyclient):
-    """ 
-    Filter for samples that are already finished with this step, allow others
-    to run, pass them to parallel client function to filter with cutadapt. 
+def get_trim_params(data, sample):
     """
+    Collects the trimming and filtering options that cutadaptit_single and
+    cutadaptit_pairs pass to cutadapt into a dict for the native trimmer.
+    List entries hold one value for each read (R1, R2).
+    """
+    ispair = "pair" in data.paramsdict["datatype"]
+    filt = int(data.paramsdict["filter_adapters"])
+
+    ## unconditional 5' cuts, and 3' cuts (<0) or lengths (>0)
+    if data.paramsdict.get("trim_reads"):
+        trimlen = list(data.paramsdict.get("trim_reads")) + [0, 0]
+        cut5 = [int(trimlen[0]), int(trimlen[2])]
+        cut3 = [int(trimlen[1]), int(trimlen[3])]
+    else:
+        ## legacy support
+        trimlen = data.paramsdict.get("edit_cutsites")
+        cut5 = [int(trimlen[0]), int(trimlen[1])]
+        cut3 = [0, 0]
+
+    ## quality trim only the 3' end for SE data, and both ends for pairs
+    qcut5 = qcut3 = 0
+    if filt:
+        qcut3 = 20
+        if ispair:
+            qcut5 = 20
+
+    ## main adapter first, then extras
+    adapters = [[], []]
+    if filt > 1:
+        if ispair:
+            adapter1, adapter2 = get_adapters_pairs(data, sample)
+            adapters[0] = [adapter1] + \
+                sorted(set(data._hackersonly["p3_adapters_extra"]))
+            adapters[1] = [adapter2] + \
+                sorted(set(data._hackersonly["p5_adapters_extra"]))
+        else:
+            adapters[0] = [get_adapter_single(data, sample)] + \
+                sorted(set(data._hackersonly["p3_adapters_extra"]))
+
+    return {"ispair": ispair,
+            "cut5": cut5,
+            "cut3": cut3,
+            "qcut5": qcut5,
+            "qcut3": qcut3,
+            "adapters": adapters,
+            "minlen": int(data.paramsdict["filter_min_trim_len"]),
+            "maxn": int(data.paramsdict["max_low_qual_bases"]),
+            "phred": int(data.paramsdict["phred_Qscore_offset"])}
+
+
+
+def quality_trim(quals, start, end, qcut5, qcut3):
+    """
+    Vectorized BWA-style quality trimming as used by cutadapt (-q 5',3').
+    quals is a (reads, maxlen) array of phred scores, and start/end the
+    current bounds of each read. Both ends are scanned over the whole read,
+    and reads where the two cuts cross are emptied. Returns the new start 
+    and end arrays.
+    """
+    cols = np.arange(quals.shape[1])
+    inside = (cols >= start[:, None]) & (cols < end[:, None])
+    qstart = start
+    qend = end
+
+    ## running sum of (cutoff - qual) from the 5' end. Trimming stops where
+    ## the sum first drops below zero, and cuts after its maximum before that.
+    if qcut5:
+        runs = np.cumsum(np.where(inside, qcut5 - quals, 0), axis=1)
+        stops = inside & (runs < 0)
+        first = np.where(stops.any(axis=1), stops.argmax(axis=1), end)
+        cands = np.where(inside & (cols < first[:, None]), runs, 0)
+        qstart = np.where(cands.max(axis=1) > 0, 
+                          cands.argmax(axis=1) + 1, start)
+
+    ## same from the 3' end, keeping the last position of the maximum
+    if qcut3:
+        runs = np.cumsum(np.where(inside, qcut3 - quals, 0)[:, ::-1], axis=1)[:, ::-1]
+        stops = inside & (runs < 0)
+        last = np.where(stops.any(axis=1), 
+                        cols[-1] - stops[:, ::-1].argmax(axis=1), -1)
+        cands = np.where(inside & (cols > last[:, None]), runs, 0)
+        qend = np.where(cands.max(axis=1) > 0, 
+                        cols[-1] - cands[:, ::-1].argmax(axis=1), end)
+
+    ## empty the reads where the cuts cross
+    qend = np.where(qend <= qstart, qstart, qend)
+    return qstart, qend
+
+
+
+def find_adapter(seqs, start, end, adapter, errate=0.1, minover=3):
+    """
+    Returns the leftmost position in each read at which the adapter, or a
+    prefix of it that runs off the 3' end, matches with at most one mismatch
+    per 1/errate matched bases and at least minover bases. Ns in the adapter
+    match anything, indels are not allowed. Reads with no match return end.
+    """
+    adapt = np.frombuffer(str(adapter).upper(), dtype=np.uint8)
+    alen = adapt.shape[0]
+    acols = np.arange(alen)
+    check = adapt != 78
+
+    ## pad so a window can always be cut from any column
+    nreads, width = seqs.shape
+    padded = np.zeros((nreads, width + alen), dtype=np.uint8)
+    padded[:, :width] = seqs
+
+    pos = end.copy()
+    todo = np.arange(nreads)
+    for col in xrange(width - minover + 1):
+        olap = np.minimum(end[todo] - col, alen)
+        tests = (col >= start[todo]) & (olap >= minover)
+        if not tests.any():
+            continue
+        window = padded[todo, col:col + alen]
+        mism = ((window != adapt) & check & (acols < olap[:, None])).sum(axis=1)
+        hits = tests & (mism <= (olap * errate).astype(np.int64))
+        pos[todo[hits]] = col
+        todo = todo[~hits]
+        if not todo.shape[0]:
+            break
+    return pos
+
+
+
+def native_trim_read(arr, nls, ridx, params):
+    """
+    Trims the records of one read file in a block in the same order as
+    cutadapt: fixed 5'/3' cuts, quality trimming, adapter trimming, --length,
+    then N-end trimming. Returns the (start, end) of the kept part of
+    each read, its number of Ns, the quality-trimmed bp, and the number of
+    reads with adapters.
+    """
+    ## padded (reads, maxlen) arrays of bases and phred scores
+    sstart = nls[0::4] + 1
+    slen = nls[1::4] - sstart
+    qstart = nls[2::4] + 1
+    cols = np.arange(max(1, slen.max()))
+    last = arr.shape[0] - 1
+    seqs = arr[np.minimum(sstart[:, None] + cols, last)]
+    seqs[cols >= slen[:, None]] = 0
+    quals = arr[np.minimum(qstart[:, None] + cols, last)].astype(np.int64) \
+            - params["phred"]
+
+    ## unconditional cuts (-u)
+    start = np.minimum(params["cut5"][ridx], slen)
+    end = slen.copy()
+    if params["cut3"][ridx] < 0:
+        end = np.maximum(start, slen + params["cut3"][ridx])
+
+    ## quality trimming (-q)
+    qstart, qend = quality_trim(quals, start, end, 
+                                params["qcut5"], params["qcut3"])
+    qualbp = int((qstart - start).sum() + (end - qend).sum())
+    start, end = qstart, qend
+
+    ## adapter trimming (-a/-A), trims at the leftmost match of any adapter
+    hits = np.zeros(start.shape[0], dtype=np.bool_)
+    for adapter in params["adapters"][ridx]:
+        pos = find_adapter(seqs, start, end, adapter)
+        hits |= pos < end
+        end = np.minimum(end, pos)
+
+    ## shorten to a fixed length (--length)
+    if params["cut3"][ridx] > 0:
+        end = np.minimum(end, start + params["cut3"][ridx])
+
+    ## trim Ns from both ends (--trim-n)
+    notn = (seqs != 78) & (cols >= start[:, None]) & (cols < end[:, None])
+    anyn = notn.any(axis=1)
+    end = np.where(anyn, cols[-1] + 1 - notn[:, ::-1].argmax(axis=1), start)
+    start = np.where(anyn, notn.argmax(axis=1), start)
+
+    ## count remaining Ns for the filter
+    kept = (cols >= start[:, None]) & (cols < end[:, None])
+    nns = ((seqs == 78) & kept).sum(axis=1)
+    return start, end, nns, qualbp, int(hits.sum())
+
+
+
+def native_trim_block(block, params):
+    """
+    Trims and filters one block of records from get_block_iter(). Pairs are
+    discarded if either read fails a filter, like cutadapt. Returns a string
+    of the passing records for each read file and a dict of counters.
+    """
+    trims = [native_trim_read(arr, nls, ridx, params) \
+             for ridx, (arr, nls) in enumerate(block)]
+
+    ## too short is counted before too many Ns
+    nreads = trims[0][0].shape[0]
+    short = np.zeros(nreads, dtype=np.bool_)
+    manyn = np.zeros(nreads, dtype=np.bool_)
+    for start, end, nns, _, _ in trims:
+        short |= (end - start) < params["minlen"]
+        manyn |= nns > params["maxn"]
+    manyn &= ~short
+    keep = ~(short | manyn)
+
+    counts = {"reads_raw": nreads,
+              "reads_filtered_by_minlen": int(short.sum()),
+              "reads_filtered_by_Ns": int(manyn.sum()),
+              "reads_passed_filter": int(keep.sum())}
+
+    ## gather header, trimmed seq, plus line, trimmed qual of kept records
+    outs = []
+    for ridx, ((arr, nls), trim) in enumerate(zip(block, trims)):
+        counts["trim_quality_bp_read{}".format(ridx + 1)] = trim[3]
+        counts["trim_adapter_bp_read{}".format(ridx + 1)] = trim[4]
+        start = trim[0][keep]
+        end = trim[1][keep]
+        rstart = np.concatenate([[0], nls[3::4][:-1] + 1])[keep]
+        sstart = nls[0::4][keep] + 1
+        send = nls[1::4][keep]
+        qstart = nls[2::4][keep] + 1
+        qend = nls[3::4][keep]
+        segs = [(rstart, sstart),
+                (sstart + start, sstart + end),
+                (send, qstart),
+                (qstart + start, qstart + end),
+                (qend, qend + 1)]
+        rsamp = np.zeros(start.shape[0], dtype=np.int64)
+        outs.append(scatter_block(arr, segs, rsamp, 1)[0])
+    return outs, counts
+
+
+
+def native_trim_blocks(data, blocks, params, outfiles):
+    """
+    Trims an iterable of blocks into (indexed, bgzipped) outfiles and 
+    returns the summed counters.
+    """
+    counters = Counter()
+    ohandles = [bgzopen(data, i, index=True) for i in outfiles]
+    try:
+        for block in blocks:
+            outs, counts = native_trim_block(block, params)
+            counters.update(counts)
+            for ohandle, out in zip(ohandles, outs):
+                ohandle.write(out)
+    finally:
+        for ohandle in ohandles:
+            ohandle.close()
+    return dict(counters)
+
+
+
+def nativetrim(data, sample, chunk=None):
+    """
+    Built-in alternative to cutadaptit_single/pairs used when 
+    data._hackersonly["trim_engine"] is "native". Applies the same trims and
+    filters in numpy to large blocks of reads in this process, and returns
+    a dict of counters instead of a cutadapt report. If chunk is set, only
+    its read range is trimmed into chunk output files.
+    """
+    params = get_trim_params(data, sample)
+    outfiles = get_trim_outfiles(data, sample, chunk)
+    if chunk:
+        blocks = get_block_iter(sample.files.concat[0], 
+                                start=chunk[1], end=chunk[2])
+    else:
+        blocks = get_block_iter(sample.files.concat[0])
+    return native_trim_blocks(data, blocks, params, outfiles)
+
+
+
+def setup_edits(data):
+    """ create the edits dir and set extra adapters for the filters param """
 
     ## create output directories 
     data.dirs.edits = os.path.join(os.path.realpath(
@@ -480,9 +892,6 @@ def run2(data, samples, force, ipyclient):
     if not os.path.exists(data.dirs.edits):
         os.makedirs(data.dirs.edits)
 
-    ## get samples
-    subsamples = choose_samples(samples, force)
-
     ## only allow extra adapters in filters==3, 
     ## and add poly repeats if not in list of adapters
     if int(data.paramsdict["filter_adapters"]) == 3:
@@ -496,13 +905,59 @@ def run2(data, samples, force, ipyclient):
         data._hackersonly["p5_adapters_extra"] = []
         data._hackersonly["p3_adapters_extra"] = []
 
+
+
+def store_fused_results(data, trimstats):
+    """
+    Stores the step 2 counters of the fused step 1/2 mode (see 
+    demultiplex.demux_stream) into the Samples made by step 1.
+    """
+    cache = ReadCountCache()
+    for sname, sample in data.samples.items():
+        store_trim_results(data, sample, trimstats.get(sname, {}))
+        if sample.stats_dfs.s2.reads_passed_filter:
+            for edit in sample.files.edits[0]:
+                cache.set(edit, sample.stats_dfs.s2.reads_passed_filter)
+    cache.save()
+    assembly_cleanup(data)
+
+
+
+def run2(data, samples, force, ipyclient):
+    """ 
+    Filter for samples that are already finished with this step, allow others
+    to run, pass them to parallel client function to filter with cutadapt. 
+    """
+
+    ## create output directories and set adapters
+    setup_edits(data)
+
+    ## get samples
+    subsamples = choose_samples(samples, force)
+
     ## concat is not parallelized (since it's disk limited, generally)
     subsamples = concat_reads(data, subsamples, ipyclient)
 
-    ## cutadapt is parallelized by ncores/2 because cutadapt spawns threads
-    lbview = ipyclient.load_balanced_view(targets=ipyclient.ids[::2])
+    ## cutadapt is parallelized by ncores/2 because cutadapt spawns threads,
+    ## the native trimmer runs in the engine process so it can use them all.
+    engine = data._hackersonly["trim_engine"]
+    if engine not in ["cutadapt", "native"]:
+        raise IPyradWarningExit(
+            "  trim_engine must be 'cutadapt' or 'native', not {}".format(engine))
+    if engine == "native":
+        lbview = ipyclient.load_balanced_view()
+    else:
+        lbview = ipyclient.load_balanced_view(targets=ipyclient.ids[::2])
     run_cutadapt(data, subsamples, lbview)
 
+    ## remember read counts of the edited files
+    cache = ReadCountCache()
+    for sample in subsamples:
+        if sample.stats_dfs.s2.reads_passed_filter:
+            for edit in sample.files.edits[0]:
+                cache.set(edit, sample.stats_dfs.s2.reads_passed_filter)
+    cache.save()
+
     ## cleanup is ...
     assembly_cleanup(data)
 
@@ -568,7 +1023,9 @@ def concat_reads(data, subsamples, ipyclient):
 
 def run_cutadapt(data, subsamples, lbview):
     """
-    sends fastq files to cutadapt
+    sends fastq files to cutadapt (or the native trimmer). Samples deeper 
+    than _hackersonly["trim_chunk_size"] reads are split into read ranges 
+    that are trimmed on separate engines and merged when all are done.
     """
     ## choose cutadapt function based on datatype
     start = time.time()
@@ -576,41 +1033,81 @@ def run_cutadapt(data, subsamples, lbview):
     finished = 0
     rawedits = {}
 
-    ## sort subsamples so that the biggest files get submitted first
-    subsamples.sort(key=lambda x: x.stats.reads_raw, reverse=True)
-    LOGGER.info([i.stats.reads_raw for i in subsamples])
-
-    ## send samples to cutadapt filtering
-    if "pair" in data.paramsdict["datatype"]:
-        for sample in subsamples:
-            rawedits[sample.name] = lbview.apply(cutadaptit_pairs, *(data, sample))
+    if data._hackersonly["trim_engine"] == "native":
+        func = nativetrim
+    elif "pair" in data.paramsdict["datatype"]:
+        func = cutadaptit_pairs
     else:
-        for sample in subsamples:
-            rawedits[sample.name] = lbview.apply(cutadaptit_single, *(data, sample))
+        func = cutadaptit_single
+
+    ## split samples into jobs and sort so the biggest get submitted first
+    jobs = []
+    for sample in subsamples:
+        for chunk in get_trim_chunks(data, sample):
+            if chunk:
+                jobs.append((chunk[2] - chunk[1], sample, chunk))
+            else:
+                jobs.append((sample.stats.reads_raw, sample, chunk))
+    jobs.sort(key=lambda x: x[0], reverse=True)
+    LOGGER.info([(i[1].name, i[0]) for i in jobs])
+
+    ## send samples to cutadapt filtering, or to the native trimmer
+    for _, sample, chunk in jobs:
+        rawedits.setdefault(sample.name, []).append(
+            (chunk, lbview.apply(func, *(data, sample, chunk))))
 
-    ## wait for all to finish
+    ## wait for all to finish, store each sample as soon as it's done and
+    ## drop its results so hub memory stays flat with many samples.
     while 1:
-        finished = sum([i.ready() for i in rawedits.values()])
+        for sname in list(rawedits):
+            results = rawedits[sname]
+            if all([i[1].ready() for i in results]):
+                collect_trim_results(data, data.samples[sname], results)
+                lbview.client.purge_local_results([i[1] for i in results])
+                finished += len(rawedits.pop(sname))
+        ready = sum([i[1].ready() for j in rawedits.values() for i in j])
         elapsed = datetime.timedelta(seconds=int(time.time()-start))
-        progressbar(len(rawedits), finished, printstr.format(elapsed), spacer=data._spacer)
+        progressbar(len(jobs), finished + ready, printstr.format(elapsed), 
+                    spacer=data._spacer)
         time.sleep(0.1)
-        if finished == len(rawedits):
+        if not rawedits:
             print("")
             break
 
-    ## collect results, report failures, and store stats. async = sample.name
-    for async in rawedits:
-        if rawedits[async].successful():
-            res = rawedits[async].result()
 
-            ## if single cleanup is easy
-            if "pair" not in data.paramsdict["datatype"]:
-                parse_single_results(data, data.samples[async], res)
-            else:
-                parse_pair_results(data, data.samples[async], res)
-        else:
+
+def collect_trim_results(data, sample, results):
+    """
+    Sums the counters from a sample's finished (chunk, async) jobs, merges
+    chunk output files in order, and stores the stats. Reports failures.
+    """
+    counters = Counter()
+    failed = False
+    for chunk, job in results:
+        if not job.successful():
             print("  found an error in step2; see ipyrad_log.txt")
-            LOGGER.error("error in run_cutadapt(): %s", rawedits[async].exception())
+            LOGGER.error("error in run_cutadapt(): %s", job.exception())
+            failed = True
+            continue
+
+        ## both engines return dicts of counters
+        counters.update(job.result())
+
+    ## concatenate chunk outputs, or remove them if any chunk failed
+    chunks = sorted([i[0] for i in results if i[0]])
+    if chunks:
+        for ridx, outfile in enumerate(get_trim_outfiles(data, sample)):
+            parts = [get_trim_outfiles(data, sample, i)[ridx] for i in chunks]
+            if failed:
+                for part in parts:
+                    for handle in [part, part+".idx"]:
+                        if os.path.exists(handle):
+                            os.remove(handle)
+            else:
+                bgzf_concat(parts, outfile)
+
+    if not failed:
+        store_trim_results(data, sample, counters)
 
 
 
@@ -554,11 +554,11 @@ def fetch_cluster_pairs(data, samfile, chrom, rstart, rend):
 
 
 
-def ref_build_and_muscle_chunk(data, sample):
+def ref_build_and_muscle_chunk(data, sample, nchunks=10):
     """ 
     1. Run bedtools to get all overlapping regions
     2. Parse out reads from regions using pysam and dump into chunk files. 
-       We measure it out to create 10 chunk files per sample. 
+       We measure it out to create nchunks chunk files per sample. 
     3. If we really wanted to speed this up, though it is pretty fast already, 
        we could parallelize it since we can easily break the regions into 
        a list of chunks. 
@@ -567,16 +567,15 @@ def ref_build_and_muscle_chunk(data, sample):
     ## get regions using bedtools
     regions = bedtools_merge(data, sample).strip().split("\n")
     nregions = len(regions)
-    chunksize = (nregions / 10) + (nregions % 10)
+    chunksize = max(1, -(-nregions // nchunks))
 
     LOGGER.debug("nregions {} chunksize {}".format(nregions, chunksize))
     ## create an output file to write clusters to
     idx = 0
     tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_{}.ali")
     ## remove old files if they exist to avoid append errors
-    for i in range(11):
-        if os.path.exists(tmpfile.format(i)):
-            os.remove(tmpfile.format(i))
+    for oldfile in glob.glob(os.path.join(data.tmpdir, sample.name+"_chunk_*.ali")):
+        os.remove(oldfile)
     fopen = open
 
     ## If reference+denovo we drop the reads back into clust.gz
@@ -11,12 +11,23 @@ parts of the pipeline
 from __future__ import print_function
 import os
 import sys
+import zlib
+import json
+import pipes
+import errno
+import bisect
+import shutil
 import socket
+import struct
 import tempfile
 import itertools
+import threading
 import ipyrad
 import gzip
+import collections
+import numpy as np
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 try:
     import subprocess32 as sps
@@ -958,6 +969,670 @@ def get_threaded_view(ipyclient, split=True):
 
 
 
+## codes of the symbols in aligned reads for site_counts(), any other 
+## character is counted in the last column.
+SITECODES = "CATGN-n"
+_SITEINDEX = np.zeros(256, dtype=np.int64) + len(SITECODES)
+_SITEINDEX[np.fromstring(SITECODES, dtype=np.uint8)] = \
+    np.arange(len(SITECODES))
+
+
+def site_counts(seqs, reps):
+    """
+    Counts each symbol at each site of a cluster from its unique reads, 
+    weighted by their replicate counts, without expanding the replicates.
+    seqs is an array (nreads, nsites) of single characters and reps the
+    count of each read. Returns an int array (nsites, 8) with columns in
+    the order of SITECODES (C, A, T, G, N, -, n) and then other characters.
+    """
+    arr = _SITEINDEX[seqs.view(np.uint8)]
+    nsites = arr.shape[1]
+    arr += (len(SITECODES) + 1) * np.arange(nsites)
+    counts = np.bincount(arr.ravel(), 
+                         weights=np.repeat(reps, nsites).astype(np.float64),
+                         minlength=(len(SITECODES) + 1) * nsites)
+    return counts.reshape(nsites, len(SITECODES) + 1).astype(np.int64)
+
+
+
+def _engine_host():
+    """ Running on remote Engine. Returns hostname, ncpus and RAM (bytes). """
+    try:
+        mem = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        mem = 0
+    return socket.gethostname(), detect_cpus(), mem
+
+
+
+def get_host_inventory(ipyclient):
+    """ 
+    Asks each engine once for its host, and returns an OrderedDict of hosts
+    with their engine ids, number of cpus, and RAM in bytes (0 if unknown),
+    e.g., {a: {eids: [0, 1, 4], ncpus: 8, mem: 3.2e10}, b: {...}}
+    Engines that are busy are skipped, unless all of them are busy, then
+    this waits for all of them.
+    """
+    ## request engine data, skips busy engines.
+    asyncs = collections.OrderedDict()
+    for eid in ipyclient.ids:
+        engine = ipyclient[eid]
+        if not engine.outstanding:
+            asyncs[eid] = engine.apply(_engine_host)
+    if not asyncs:
+        for eid in ipyclient.ids:
+            asyncs[eid] = ipyclient[eid].apply(_engine_host)
+
+    ## group them by host
+    inventory = collections.OrderedDict()
+    for eid, async in asyncs.iteritems():
+        host, ncpus, mem = async.get()
+        inventory.setdefault(host, {"eids": [], "ncpus": ncpus, "mem": mem})
+        inventory[host]["eids"].append(eid)
+    return inventory
+
+
+
+def get_thread_slots(inventory, nthreads):
+    """
+    Splits the engines of each host into slots for jobs that run nthreads 
+    threads, so that the jobs on a host don't use more threads than it has
+    cpus or engines. Every host gets at least one slot. Returns the engine
+    ids to target, one per slot, and logs the plan.
+    """
+    targets = []
+    for host, hinfo in inventory.iteritems():
+        eids = hinfo["eids"]
+        ncores = min(len(eids), hinfo["ncpus"]) or len(eids)
+        nslots = max(1, ncores // max(1, nthreads))
+        stride = len(eids) // nslots
+        targets.extend(eids[::stride][:nslots])
+        LOGGER.info("thread plan: host %s; %s engines, %s cpus; %s slots "\
+                    "of %s threads on engines %s", host, len(eids), 
+                    hinfo["ncpus"], nslots, nthreads, eids[::stride][:nslots])
+    return targets
+
+
+
+## max uncompressed size of a BGZF block, as in htslib, so that even
+## incompressible data fits into the 16-bit block size field.
+BGZF_BLOCKSIZE = 65280
+
+
+def bgzf_block(data, level=6):
+    """ 
+    Compresses a string of up to BGZF_BLOCKSIZE bytes into a single BGZF 
+    block: a complete gzip member with a 'BC' extra field holding its size.
+    An empty string gives the standard 28 byte BGZF EOF block.
+    """
+    cobj = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = cobj.compress(data) + cobj.flush()
+    ## header (18) + cdata + trailer (8), minus 1
+    bsize = len(cdata) + 25
+    header = struct.pack("<BBBBIBBHBBHH", 
+                         31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize)
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + trailer
+
+
+
+class BgzfWriter(object):
+    """
+    A file-like gzip writer that compresses data into independent BGZF 
+    blocks on a pool of threads (zlib releases the GIL). The output is
+    standard multi-member gzip that zcat and gzip.open read as usual.
+    If index is set the data are treated as fastq and a sidecar index
+    (name.idx) is written on close with the total number of records and
+    the virtual offset of every index'th record, see read_fastq_index().
+    """
+    def __init__(self, name, mode="wb", compresslevel=6, threads=2, index=0):
+        self.name = name
+        self.level = compresslevel
+        self.threads = max(1, int(threads))
+        self.handle = open(name, mode)
+        self.buffer = []
+        self.buffered = 0
+        self.closed = False
+
+        ## fastq index, only for new files. A stale index would be wrong.
+        if os.path.exists(name+".idx") and ("a" not in mode):
+            os.remove(name+".idx")
+        self.index = 0
+        if index and ("a" not in mode):
+            self.index = int(index)
+        self.entries = [(0, 0)]
+        self.nlines = 0
+        self.nextline = (4 * self.index) - 1
+        self.coffset = 0
+
+        ## compress this many blocks at a time
+        self.batch = 4 * self.threads
+        self.pool = None
+        if self.threads > 1:
+            self.pool = ThreadPool(self.threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        """ buffers data and compresses full batches of blocks """
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.batch * BGZF_BLOCKSIZE:
+            self._compress(final=False)
+
+    def _compress(self, final):
+        """ compress and write buffered data, keep a partial last block """
+        data = "".join(self.buffer)
+        nblocks = len(data) // BGZF_BLOCKSIZE
+        if final and (len(data) % BGZF_BLOCKSIZE):
+            nblocks += 1
+        blocks = [data[i*BGZF_BLOCKSIZE:(i+1)*BGZF_BLOCKSIZE] \
+                  for i in xrange(nblocks)]
+        rest = data[nblocks*BGZF_BLOCKSIZE:]
+        self.buffer = [rest]
+        self.buffered = len(rest)
+
+        ## blocks come back in input order
+        if self.pool:
+            cblocks = self.pool.map(lambda x: bgzf_block(x, self.level), blocks)
+        else:
+            cblocks = [bgzf_block(i, self.level) for i in blocks]
+        self.handle.write("".join(cblocks))
+
+        ## index the start of every index'th record by its virtual offset,
+        ## (block file offset << 16 | offset within uncompressed block).
+        for block, cblock in zip(blocks, cblocks):
+            if self.index:
+                nlines = block.count("\n")
+                while self.nextline < self.nlines + nlines:
+                    pos = -1
+                    for _ in xrange(self.nextline - self.nlines + 1):
+                        pos = block.find("\n", pos + 1)
+                    if pos + 1 < len(block):
+                        voffset = (self.coffset << 16) | (pos + 1)
+                    else:
+                        voffset = (self.coffset + len(cblock)) << 16
+                    self.entries.append(((self.nextline + 1) // 4, voffset))
+                    self.nextline += 4 * self.index
+                self.nlines += nlines
+            self.coffset += len(cblock)
+
+    def flush(self):
+        """ writes everything buffered so far as whole blocks """
+        self._compress(final=True)
+        self.handle.flush()
+
+    def close(self):
+        """ write remaining data and the EOF block, then close """
+        if self.closed:
+            return
+        self._compress(final=True)
+        self.handle.write(bgzf_block("", self.level))
+        self.handle.close()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        self.closed = True
+
+        ## write the sidecar index
+        if self.index:
+            nrecords = self.nlines // 4
+            with open(self.name+".idx", 'w') as out:
+                out.write("{}\t{}\t{}\t{}\n".format(FASTQ_INDEX_HEADER, 
+                    nrecords, self.index, os.path.getsize(self.name)))
+                for record, voffset in self.entries:
+                    if record < nrecords:
+                        out.write("{}\t{}\n".format(record, voffset))
+
+
+
+FASTQ_INDEX_HEADER = "#bgzf_fastq_index"
+
+
+def read_fastq_index(path):
+    """
+    Returns (nrecords, step, entries) from the sidecar index of a BGZF fastq
+    file written by BgzfWriter, where entries is a list of (record, virtual
+    offset) for every step'th record (per part, for merged files). Returns 
+    None if there is no index or if it does not match the file.
+    """
+    handle = path+".idx"
+    if not os.path.exists(handle):
+        return None
+    with open(handle, 'r') as infile:
+        header = infile.readline().strip().split("\t")
+        if (header[0] != FASTQ_INDEX_HEADER) or \
+           (int(header[3]) != os.path.getsize(path)):
+            return None
+        entries = [tuple(int(i) for i in line.split()) for line in infile \
+                   if line.strip()]
+    return int(header[1]), int(header[2]), entries
+
+
+
+def fastq_index_count(path):
+    """ number of records in an indexed fastq file, or None if not indexed """
+    index = read_fastq_index(path)
+    if index:
+        return index[0]
+    return None
+
+
+
+def open_fastq_at(path, start):
+    """
+    Returns an open gzip handle of an indexed BGZF fastq file positioned at
+    the beginning of record start. Decompression starts at the closest 
+    indexed record before start, so engines can read disjoint ranges of the 
+    same file concurrently.
+    """
+    index = read_fastq_index(path)
+    if not index:
+        raise IPyradError("no valid fastq index for {}".format(path))
+    nrecords, step, entries = index
+
+    ## entries are sorted but not always evenly spaced (see bgzf_concat)
+    idx = bisect.bisect_right([i[0] for i in entries], start) - 1
+    record, voffset = entries[max(0, idx)]
+    raw = open(path, 'rb')
+    raw.seek(voffset >> 16)
+    infile = gzip.GzipFile(fileobj=raw, mode='rb')
+    ## let the gzip handle close the raw file too
+    infile.myfileobj = raw
+    infile.read(voffset & 0xffff)
+    for _ in xrange(4 * (start - record)):
+        infile.readline()
+    return infile
+
+
+
+def iter_fastq_range(path, start, end):
+    """
+    Yields the lines of records [start, end) of an indexed BGZF fastq file.
+    """
+    end = min(end, fastq_index_count(path) or 0)
+    if start >= end:
+        return
+    with open_fastq_at(path, start) as infile:
+        for _ in xrange(4 * (end - start)):
+            yield infile.readline()
+
+
+
+def read_fastq_range(path, start, end, chunksize=int(2**20)):
+    """
+    Yields the data of records [start, end) of an indexed BGZF fastq file in
+    strings of about chunksize bytes. Faster than iter_fastq_range().
+    """
+    end = min(end, fastq_index_count(path) or 0)
+    if start >= end:
+        return
+    nlines = 4 * (end - start)
+    with open_fastq_at(path, start) as infile:
+        while nlines:
+            chunk = infile.read(chunksize)
+            if not chunk:
+                break
+            count = chunk.count("\n")
+            if count >= nlines:
+                pos = -1
+                for _ in xrange(nlines):
+                    pos = chunk.find("\n", pos + 1)
+                chunk = chunk[:pos + 1]
+                count = nlines
+            nlines -= count
+            yield chunk
+
+
+
+def bgzopen(data, name, mode="wb", index=False):
+    """
+    Returns a BgzfWriter for name using the Assembly's compression level
+    (_hackersonly["compression_level"]) and threads setting. If index then
+    a fastq index is written every _hackersonly["fastq_index_step"] reads.
+    """
+    step = 0
+    if index:
+        step = data._hackersonly["fastq_index_step"]
+    return BgzfWriter(name, mode, 
+                      compresslevel=data._hackersonly["compression_level"],
+                      threads=data._ipcluster["threads"],
+                      index=step)
+
+
+
+def fifo_compress(data, outfiles):
+    """
+    Makes a named pipe for each gzip outfile that an external program (e.g.,
+    cutadapt) can write plain text into, and starts a thread for each that
+    compresses the stream into outfile with bgzopen(). Returns the pipe names
+    and a handle to pass to fifo_finish() once the program has exited.
+    """
+    ## keep pipes on local disk, network filesystems may not support them
+    tmpdir = tempfile.mkdtemp(prefix="ipyrad-fifo-")
+    fifos = []
+    threads = []
+    errors = []
+
+    def drain(fifo, outfile):
+        """ read from the pipe until the writer closes it """
+        try:
+            with open(fifo, 'rb') as infile:
+                with bgzopen(data, outfile, index=True) as out:
+                    shutil.copyfileobj(infile, out, 16 * BGZF_BLOCKSIZE)
+        except Exception as inst:
+            errors.append(inst)
+
+    for idx, outfile in enumerate(outfiles):
+        fifo = os.path.join(tmpdir, "{}.fastq".format(idx))
+        os.mkfifo(fifo)
+        thread = threading.Thread(target=drain, args=(fifo, outfile))
+        thread.daemon = True
+        thread.start()
+        fifos.append(fifo)
+        threads.append(thread)
+
+    return fifos, (tmpdir, threads, errors)
+
+
+
+def fifo_feed(paths, start, end):
+    """
+    Makes a named pipe for each indexed fastq file in paths that an external
+    program (e.g., cutadapt) can read records [start, end) from as plain
+    text, and starts a thread for each that writes them. Returns the pipe 
+    names and a handle to pass to fifo_finish().
+    """
+    tmpdir = tempfile.mkdtemp(prefix="ipyrad-fifo-")
+    fifos = []
+    threads = []
+    errors = []
+
+    def feed(fifo, path):
+        """ write to the pipe until the range is done """
+        try:
+            with open(fifo, 'wb') as out:
+                for chunk in read_fastq_range(path, start, end):
+                    out.write(chunk)
+        except (IOError, OSError) as inst:
+            ## the reader went away, it reports its own error
+            if inst.errno != errno.EPIPE:
+                errors.append(inst)
+        except Exception as inst:
+            errors.append(inst)
+
+    for idx, path in enumerate(paths):
+        fifo = os.path.join(tmpdir, "{}.fastq".format(idx))
+        os.mkfifo(fifo)
+        thread = threading.Thread(target=feed, args=(fifo, path))
+        thread.daemon = True
+        thread.start()
+        fifos.append(fifo)
+        threads.append(thread)
+
+    return fifos, (tmpdir, threads, errors)
+
+
+
+def fifo_finish(fifos, handle):
+    """ 
+    wait for the fifo_compress() or fifo_feed() threads to finish and 
+    remove pipes 
+    """
+    tmpdir, threads, errors = handle
+    for fifo, thread in zip(fifos, threads):
+        ## unblock a thread still waiting for the other end to open its pipe
+        if thread.is_alive():
+            for flag in [os.O_WRONLY, os.O_RDONLY]:
+                try:
+                    os.close(os.open(fifo, flag | os.O_NONBLOCK))
+                except OSError:
+                    pass
+        thread.join()
+    shutil.rmtree(tmpdir)
+    if errors:
+        raise IPyradError("error streaming fastq data: {}".format(errors[0]))
+
+
+
+def bgzf_concat(parts, outname):
+    """
+    Concatenates BGZF files into outname by copying their blocks, keeping 
+    only the last EOF block, and removes the parts. If every part has a
+    fastq index then their entries are shifted and merged into an index 
+    for outname.
+    """
+    eof = bgzf_block("")
+    indexes = [read_fastq_index(i) for i in parts]
+    entries = []
+    nrecords = 0
+    coffset = 0
+    with open(outname, 'wb') as out:
+        for part, index in zip(parts, indexes):
+            size = os.path.getsize(part)
+            with open(part, 'rb') as infile:
+                infile.seek(max(0, size - len(eof)))
+                if infile.read() == eof:
+                    size -= len(eof)
+                infile.seek(0)
+                remaining = size
+                while remaining:
+                    chunk = infile.read(min(remaining, 16 * BGZF_BLOCKSIZE))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            if all(indexes):
+                entries += [(record + nrecords, voffset + (coffset << 16)) \
+                            for record, voffset in index[2]]
+                nrecords += index[0]
+            coffset += size
+        out.write(eof)
+
+    if os.path.exists(outname+".idx"):
+        os.remove(outname+".idx")
+    if parts and all(indexes):
+        with open(outname+".idx", 'w') as out:
+            out.write("{}\t{}\t{}\t{}\n".format(FASTQ_INDEX_HEADER, 
+                nrecords, indexes[0][1], os.path.getsize(outname)))
+            for record, voffset in entries:
+                out.write("{}\t{}\n".format(record, voffset))
+
+    for part in parts:
+        for handle in [part, part+".idx"]:
+            if os.path.exists(handle):
+                os.remove(handle)
+
+
+
+
+## persistent read counts, shared by all Assemblies of this user
+READCOUNT_CACHE = os.path.join(os.path.expanduser("~"), ".ipyrad", "readcounts.json")
+
+
+class ReadCountCache(object):
+    """
+    Persistent cache of the number of reads in fastq files, keyed on their
+    real path and only valid while file size and mtime are unchanged, so
+    that re-linking files, or linking them to a branched or merged Assembly,
+    does not have to recount reads. Filled by steps 1 and 2 and by counting.
+    """
+    def __init__(self, handle=READCOUNT_CACHE):
+        self.handle = handle
+        self.counts = {}
+        self.updates = {}
+        if os.path.exists(handle):
+            try:
+                with open(handle, 'r') as infile:
+                    self.counts = json.load(infile)
+            except (IOError, ValueError) as inst:
+                LOGGER.warning("could not read readcount cache %s", inst)
+
+    def get(self, path):
+        """ cached number of reads in path or None """
+        if not path or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        entry = self.counts.get(os.path.realpath(path))
+        if entry and (entry[0] == stat.st_size) and (entry[1] == stat.st_mtime):
+            return entry[2]
+        return None
+
+    def set(self, path, nreads):
+        """ store the number of reads in path """
+        if not path or not os.path.exists(path):
+            return
+        stat = os.stat(path)
+        entry = [stat.st_size, stat.st_mtime, int(nreads)]
+        self.counts[os.path.realpath(path)] = entry
+        self.updates[os.path.realpath(path)] = entry
+
+    def save(self):
+        """ 
+        write new entries to the cache file. Re-reads it first so entries
+        written by other processes since loading are kept.
+        """
+        if not self.updates:
+            return
+        try:
+            if not os.path.exists(os.path.dirname(self.handle)):
+                os.makedirs(os.path.dirname(self.handle))
+            counts = {}
+            if os.path.exists(self.handle):
+                try:
+                    with open(self.handle, 'r') as infile:
+                        counts = json.load(infile)
+                except ValueError:
+                    pass
+            counts.update(self.updates)
+            ## drop entries for files that no longer exist
+            counts = {i: j for i, j in counts.iteritems() if os.path.exists(i)}
+            tmphandle = self.handle+".{}".format(os.getpid())
+            with open(tmphandle, 'w') as out:
+                json.dump(counts, out)
+            os.rename(tmphandle, self.handle)
+            self.counts = counts
+            self.updates = {}
+        except (IOError, OSError) as inst:
+            LOGGER.warning("could not write readcount cache %s", inst)
+
+
+
+## summary of AlignService.stats() for the logs
+ALIGNSTATS = "{nclusters} clusters in {total:.2f}s, mean {mean:.4f}s, "\
+             "slowest {max:.4f}s ({max_size} seqs)"
+
+
+class AlignService(object):
+    """
+    Pool of long-lived bash workers that run muscle on batches of clusters.
+    Each cluster (fasta string) is written to a temp file, so nothing is
+    shell-escaped, and each alignment on stdout is followed by its run time
+    (from bash's time) and a NUL byte, so results are read in blocks rather
+    than line by line. Run times are kept to report timing stats.
+    """
+    def __init__(self, nworkers=1, batchsize=100, tmpdir=None, binary=None):
+        self.binary = binary or ipyrad.bins.muscle
+        self.batchsize = max(1, batchsize)
+        self.tmpdir = tempfile.mkdtemp(prefix="align-", dir=tmpdir)
+        self.times = []
+        self.sizes = []
+        self.workers = []
+        for widx in xrange(max(1, nworkers)):
+            proc = sps.Popen(["bash"], stdin=sps.PIPE, stdout=sps.PIPE,
+                             close_fds=True)
+            ## report the run time of each 'time' call as \x01seconds
+            proc.stdin.write("TIMEFORMAT=$'\\x01%3R'\n")
+            self.workers.append({"proc": proc, "idx": widx, "buffer": ""})
+
+
+    def align(self, fastas):
+        """
+        Yields the muscle alignment of each fasta string in fastas, in order.
+        An empty string is yielded for clusters that muscle failed to align.
+        """
+        fastas = iter(fastas)
+        idle = collections.deque(self.workers)
+        busy = collections.deque()
+        while 1:
+            ## keep each idle worker busy with a new batch
+            while idle:
+                batch = list(itertools.islice(fastas, self.batchsize))
+                if not batch:
+                    break
+                worker = idle.popleft()
+                self._send(worker, batch)
+                busy.append((worker, len(batch)))
+
+            ## yield the results of the oldest batch
+            if not busy:
+                break
+            worker, nbatch = busy.popleft()
+            for result in self._recv(worker, nbatch):
+                yield result
+            idle.append(worker)
+
+
+    def _send(self, worker, batch):
+        """ writes batch to temp files and sends the muscle calls """
+        cmds = []
+        for bidx, fasta in enumerate(batch):
+            path = os.path.join(self.tmpdir, "{}_{}.fa".format(worker["idx"], bidx))
+            with open(path, 'wb') as out:
+                out.write(fasta+"\n")
+            cmds.append("{{ time {} -quiet -in {} < /dev/null 2>&3; }} 3>&2 2>&1; "
+                        "printf '\\0'\n"\
+                        .format(pipes.quote(self.binary), pipes.quote(path)))
+            self.sizes.append(fasta.count(">"))
+        worker["proc"].stdin.write("".join(cmds))
+        worker["proc"].stdin.flush()
+
+
+    def _recv(self, worker, nbatch):
+        """ reads nbatch NUL-framed alignments from the worker's stdout """
+        results = []
+        fd = worker["proc"].stdout.fileno()
+        while len(results) < nbatch:
+            block = os.read(fd, 2**16)
+            if not block:
+                raise IPyradError("alignment worker exited unexpectedly")
+            frames = (worker["buffer"] + block).split("\0")
+            worker["buffer"] = frames.pop()
+            for frame in frames:
+                align, runtime = frame.rsplit("\x01", 1)
+                results.append(align)
+                self.times.append(float(runtime))
+        return results
+
+
+    def stats(self):
+        """ returns a dict of per-cluster timing stats """
+        if not self.times:
+            return {"nclusters": 0, "total": 0., "mean": 0., "max": 0.,
+                    "max_size": 0}
+        imax = max(xrange(len(self.times)), key=self.times.__getitem__)
+        return {"nclusters": len(self.times),
+                "total": sum(self.times),
+                "mean": sum(self.times) / len(self.times),
+                "max": self.times[imax],
+                "max_size": self.sizes[imax]}
+
+
+    def close(self):
+        """ shuts down the workers and removes the temp files """
+        for worker in self.workers:
+            worker["proc"].stdin.close()
+            worker["proc"].stdout.close()
+            worker["proc"].wait()
+        self.workers = []
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+
 ##############################################################
 def detect_cpus():
     """
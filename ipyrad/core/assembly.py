@@ -223,7 +223,22 @@ class Assembly(object):
                         ("aligner", "bwa"),
                         ("min_SE_refmap_overlap", 10),
                         ("refmap_merge_PE", True),
-                        ("bwa_args", "")
+                        ("bwa_args", ""),
+                        ("demux_stream", False),
+                        ("demux_stream_blocksize", int(2**25)),
+                        ("demux_writers", 1),
+                        ("demux_max_memory", 4000),
+                        ("compression_level", 6),
+                        ("fastq_index_step", 10000),
+                        ("trim_engine", "cutadapt"),
+                        ("trim_chunk_size", int(4e6)),
+                        ("fused_steps12", False),
+                        ("fused_keep_demuxed", False),
+                        ("clust_aligner", "muscle"),
+                        ("align_tasks_per_engine", 4),
+                        ("clust_max_memory", 0),
+                        ("clust_store", False),
+                        ("pooled_estimate", False)
         ])
 
     def __str__(self):
@@ -420,8 +435,11 @@ class Assembly(object):
         if force:
             self.samples = {}
 
-        ## track parallel jobs
+        ## track parallel jobs, and skip counting files with cached counts
         linkjobs = {}
+        linkpaths = {}
+        cached = {}
+        cache = ReadCountCache()
         if ipyclient:
             lbview = ipyclient.load_balanced_view()
 
@@ -478,9 +496,13 @@ class Assembly(object):
                     gzipped = bool(fastqtuple[0].endswith(".gz"))
                     nreads = 0
                     for alltuples in self.samples[sname].files.fastqs:
-                        nreads += _zbufcountlines(alltuples[0], gzipped)
-                    self.samples[sname].stats.reads_raw = nreads/4
-                    self.samples[sname].stats_dfs.s1["reads_raw"] = nreads/4
+                        nfile = cache.get(alltuples[0])
+                        if nfile is None:
+                            nfile = _zbufcountlines(alltuples[0], gzipped)/4
+                            cache.set(alltuples[0], nfile)
+                        nreads += nfile
+                    self.samples[sname].stats.reads_raw = nreads
+                    self.samples[sname].stats_dfs.s1["reads_raw"] = nreads
                     self.samples[sname].state = 1
 
                     LOGGER.debug("Got reads for sample - {} {}".format(sname,\
@@ -495,8 +517,13 @@ class Assembly(object):
                     gzipped = bool(fastqtuple[0].endswith(".gz"))
                     for sidx, tup in enumerate(self.samples[sname].files.fastqs):
                         key = sname+"_{}".format(sidx)
-                        linkjobs[key] = lbview.apply(_bufcountlines,
-                                                    *(tup[0], gzipped))
+                        nfile = cache.get(tup[0])
+                        if nfile is not None:
+                            cached[key] = 4 * nfile
+                        else:
+                            linkpaths[key] = tup[0]
+                            linkjobs[key] = lbview.apply(_zbufcountlines,
+                                                        *(tup[0], gzipped))
                     LOGGER.debug("sent count job for {}".format(sname))
                     #created += createdinc
                     linked += linkedinc
@@ -516,18 +543,25 @@ class Assembly(object):
                     print("")
                     break
 
-            ## collect link job results
+            ## collect link job results and cached counts
             sampdict = {i:0 for i in self.samples}
             for result in linkjobs:
                 sname = result.rsplit("_", 1)[0]
                 nreads = linkjobs[result].result()
+                cache.set(linkpaths[result], nreads/4)
                 sampdict[sname] += nreads
+            for result in cached:
+                sname = result.rsplit("_", 1)[0]
+                sampdict[sname] += cached[result]
 
             for sname in sampdict:
                 self.samples[sname].stats.reads_raw = sampdict[sname]/4
                 self.samples[sname].stats_dfs.s1["reads_raw"] = sampdict[sname]/4
                 self.samples[sname].state = 1
 
+        ## store new counts for next time
+        cache.save()
+
         ## print if data were linked
         #print("  {} new Samples created in '{}'.".format(created, self.name))
         if linked:
@@ -942,8 +976,12 @@ class Assembly(object):
 
 
 
-    def _step1func(self, force, ipyclient):
-        """ hidden wrapped function to start step 1 """
+    def _step1func(self, force, ipyclient, fused=False):
+        """ 
+        hidden wrapped function to start step 1. If fused then reads are
+        also filtered (step 2) while demultiplexing when possible. Returns 
+        whether step 2 was done.
+        """
 
         ## check input data files
         sfiles = self.paramsdict["sorted_fastq_path"]
@@ -975,7 +1013,7 @@ class Assembly(object):
                 if glob.glob(sfiles):
                     self._link_fastqs(ipyclient=ipyclient, force=force)
                 else:
-                    assemble.demultiplex.run2(self, ipyclient, force)
+                    return assemble.demultiplex.run2(self, ipyclient, force, fused)
 
         ## Creating new Samples
         else:
@@ -985,7 +1023,8 @@ class Assembly(object):
 
             ## otherwise do the demultiplexing
             else:
-                assemble.demultiplex.run2(self, ipyclient, force)
+                return assemble.demultiplex.run2(self, ipyclient, force, fused)
+        return False
 
 
 
@@ -1293,12 +1332,17 @@ class Assembly(object):
 
             ## has many fixed arguments right now, but we may add these to
             ## hackerz_only, or they may be accessed in the API.
+            ## steps 1 and 2 can be fused into a single pass over the data
+            fused = False
             if '1' in steps:
-                self._step1func(force, ipyclient)
+                fused = self._step1func(force, ipyclient, fused=('2' in steps)\
+                                        and self._hackersonly["fused_steps12"])
                 self.save()
                 ipyclient.purge_everything()
+                if fused and self._headers:
+                    print("\n  Step 2: Filtering reads (done in step 1)")
 
-            if '2' in steps:
+            if ('2' in steps) and (not fused):
                 self._step2func(samples=None, force=force, ipyclient=ipyclient)
                 self.save()
                 ipyclient.purge_everything()
@@ -1590,6 +1634,11 @@ def _bufcountlines(filename, gzipped):
     """
     fast line counter. Used to quickly sum number of input reads when running
     link_fastqs to append files. """
+    ## O(1) for block-gzipped fastqs with an index from step 1 or 2
+    nrecords = fastq_index_count(filename)
+    if nrecords is not None:
+        return 4 * nrecords
+
     if gzipped:
         fin = gzip.open(filename)
     else:
@@ -1608,6 +1657,10 @@ def _bufcountlines(filename, gzipped):
 ## This is much faster than bufcountlines for really big files
 def _zbufcountlines(filename, gzipped):
     """ faster line counter """
+    nrecords = fastq_index_count(filename)
+    if nrecords is not None:
+        return 4 * nrecords
+
     if gzipped:
         cmd1 = ["gunzip", "-c", filename]
     else:
@@ -9,6 +9,7 @@ import toyplot
 #import toyplot.pdf
 import numpy as np
 from collections import OrderedDict
+from ipyrad.assemble.cluster_within import get_quick_depths
 
 
 # pylint: disable=E1101
@@ -16,7 +17,10 @@ from collections import OrderedDict
 
 def depthplot(data, samples=None, dims=(None,None), canvas=(None,None), 
               xmax=50, log=False, outprefix=None, use_maxdepth=False):
-    """ plots histogram of coverages across clusters"""
+    """ 
+    plots histogram of coverages across clusters. Depths are read from the
+    depths array that step 3 writes next to each clustS file.
+    """
 
     ## select samples to be plotted, requires depths info
     if not samples:
@@ -44,16 +48,18 @@ def depthplot(data, samples=None, dims=(None,None), canvas=(None,None),
 
     ## get all of the data arrays
     for panel, sample in enumerate(subsamples):
+        ## depth of each cluster
+        _, depths = get_quick_depths(data, subsamples[sample])
+
         ## statistical called bins
-        statdat = subsamples[sample].depths
+        statdat = depths
         statdat = statdat[statdat >= data.paramsdict["mindepth_statistical"]]
         if use_maxdepth:
-            statdat = {i:j for (i, j) in statdat if \
-                                        i < data.paramsdict["maxdepth"]}
+            statdat = statdat[statdat < data.paramsdict["maxdepth"]]
         sdat = np.histogram(statdat, range(50))
 
         ## majrule called bins
-        statdat = subsamples[sample].depths
+        statdat = depths
         statdat = statdat[statdat < data.paramsdict["mindepth_statistical"]]
         statdat = statdat[statdat >= data.paramsdict["mindepth_majrule"]]
         if use_maxdepth:
@@ -61,7 +67,7 @@ def depthplot(data, samples=None, dims=(None,None), canvas=(None,None),
         mdat = np.histogram(statdat, range(50))
 
         ## excluded bins
-        tots = data.samples[sample].depths
+        tots = depths
         tots = tots[tots < data.paramsdict["mindepth_majrule"]]
         if use_maxdepth:
             tots = tots[tots < data.paramsdict["maxdepth"]]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+
+""" checks rawedit.quality_trim() against cutadapt's quality_trim_index """
+
+import numpy as np
+from ipyrad.assemble.rawedit import quality_trim
+
+
+
+def quality_trim_index(quals, cutoff_front, cutoff_back):
+    """ scalar copy of cutadapt's quality_trim_index for phred scores """
+    start = 0
+    stop = len(quals)
+
+    ## 5' end
+    total = 0
+    maxqual = 0
+    for idx in xrange(len(quals)):
+        total += cutoff_front - quals[idx]
+        if total < 0:
+            break
+        if total > maxqual:
+            maxqual = total
+            start = idx + 1
+
+    ## 3' end
+    total = 0
+    maxqual = 0
+    for idx in reversed(xrange(len(quals))):
+        total += cutoff_back - quals[idx]
+        if total < 0:
+            break
+        if total > maxqual:
+            maxqual = total
+            stop = idx
+
+    if start >= stop:
+        start, stop = 0, 0
+    return start, stop
+
+
+
+def check(quals, start, end, qcut5, qcut3):
+    """ compares the kept bases of each read to the scalar reference """
+    qstart, qend = quality_trim(quals, start, end, qcut5, qcut3)
+    for ridx in xrange(quals.shape[0]):
+        read = quals[ridx, start[ridx]:end[ridx]]
+        rstart, rstop = quality_trim_index(read, qcut5, qcut3)
+        if rstart == rstop:
+            assert qstart[ridx] == qend[ridx]
+        else:
+            assert qstart[ridx] == start[ridx] + rstart
+            assert qend[ridx] == start[ridx] + rstop
+
+
+
+def test_pairs():
+    """ both ends, as for paired data, on low quality reads """
+    rng = np.random.RandomState(123)
+    quals = rng.randint(0, 41, size=(2000, 150))
+    start = np.zeros(2000, dtype=np.int64)
+    end = np.zeros(2000, dtype=np.int64) + 150
+    check(quals, start, end, 20, 20)
+
+
+
+def test_single():
+    """ 3' end only, as for single end data """
+    rng = np.random.RandomState(321)
+    quals = rng.randint(10, 41, size=(2000, 100))
+    start = np.zeros(2000, dtype=np.int64)
+    end = np.zeros(2000, dtype=np.int64) + 100
+    check(quals, start, end, 0, 20)
+
+
+
+def test_bounds():
+    """ reads of different lengths that were already cut at the 5' end """
+    rng = np.random.RandomState(7)
+    quals = rng.randint(0, 41, size=(2000, 120))
+    start = rng.randint(0, 10, size=2000)
+    end = rng.randint(60, 121, size=2000)
+    check(quals, start, end, 20, 20)